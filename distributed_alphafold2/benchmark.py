@@ -0,0 +1,510 @@
+from pathlib import Path
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import statistics
+import subprocess
+
+# Benchmarks of the structure homology search and the AlphaFold2 distributor that run without FATCAT, USalign,
+# real proteomes or Slurm. Synthetic proteomes and fasta files are generated into the benchmark directory once
+# and reused, the stub tools write output in the format of the real tools after a configurable delay, and every
+# case runs in a child process whose wall time, CPU time and max RSS are taken from wait4. Results are appended
+# as JSON lines tagged with the git commit, so `compare` can put two commits side by side.
+SCRIPT_DIR = Path(__file__).resolve().parent
+SEARCH_SCRIPT = SCRIPT_DIR / 'fatcat_tmalign_proteome_search.py'
+DISTRIBUTE_SCRIPT = SCRIPT_DIR / 'distribute_alphafold2.py'
+DEFAULT_RESULTS_FILE = 'benchmark_results.jsonl'
+STUB_STARTUP_ENV_VAR = 'BENCHMARK_STUB_STARTUP_SECONDS'
+STUB_PER_STRUCTURE_ENV_VAR = 'BENCHMARK_STUB_SECONDS_PER_STRUCTURE'
+DISTRIBUTE_MODES = {
+    'batch': [],
+    'array': ['--array'],
+    'plan': ['--plan'],
+    'plan_array': ['--plan', '--array'],
+}
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+STUB_HEADER = f'''#!{sys.executable}
+import os, sys, time, zlib
+
+def value(key):
+    return (zlib.crc32(key.encode()) % 10000) / 10000
+
+def n_residues(pdb_path):
+    with open(pdb_path) as f:
+        return sum(1 for line in f if line.startswith('ATOM') and line[12:16] == ' CA ')
+
+def wait(n_alignments):
+    time.sleep(float(os.environ.get('{STUB_STARTUP_ENV_VAR}', 0)) + n_alignments * float(os.environ.get('{STUB_PER_STRUCTURE_ENV_VAR}', 0)))
+
+def read_list(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+'''
+
+# FATCATSearch.pl <query> <database list> -i1 <query dir> -i2 <proteome dir> -q
+FATCAT_STUB = STUB_HEADER + '''
+args = sys.argv[1:]
+query, entries = args[0], read_list(args[1])
+query_dir, proteome_dir = args[args.index('-i1') + 1], args[args.index('-i2') + 1]
+wait(len(entries))
+query_length = n_residues(os.path.join(query_dir, query))
+out = sys.stdout
+for entry in entries:
+    key = query + entry
+    length = n_residues(os.path.join(proteome_dir, entry + '.pdb'))
+    align_length = max(1, int(min(query_length, length) * (0.3 + 0.7 * value(key + 'l'))))
+    out.write(f'Align {query} {query_length} with {entry}.pdb {length}\\n')
+    out.write(f'P-value {value(key + "p") / 100:.2e} Afp-num {int(value(key + "a") * 20000)} Identity {100 * value(key + "i"):.2f}% Similarity {100 * value(key + "s"):.2f}%\\n')
+    out.write(f'Twists {int(value(key + "t") * 4)} ini-len {align_length} ini-rmsd {2 * value(key + "r"):.2f} opt-equ {align_length} opt-rmsd {4 * value(key + "o"):.2f} '
+              f'chain-rmsd {5 * value(key + "c"):.2f} Score {600 * value(key + "x"):.2f} align-len {align_length + 4} gaps 4 (3.00%)\\n')
+    out.write('\\n')
+'''
+
+# USalign <query> -dir2 <proteome dir> <database list> ... or USalign -dir1 <query dir> <query list> -dir2 ...
+USALIGN_STUB = STUB_HEADER + '''
+args = sys.argv[1:]
+if '-dir1' in args:
+    query_dir = args[args.index('-dir1') + 1]
+    queries = [(query + '.pdb', os.path.join(query_dir, query + '.pdb')) for query in read_list(args[args.index('-dir1') + 2])]
+else:
+    queries = [(args[0], args[0])]
+proteome_dir = args[args.index('-dir2') + 1]
+entries = read_list(args[args.index('-dir2') + 2])
+wait(len(queries) * len(entries))
+lengths = {entry: n_residues(os.path.join(proteome_dir, entry + '.pdb')) for entry in entries}
+out = sys.stdout
+out.write('#PDBchain1\\tPDBchain2\\tTM1\\tTM2\\tRMSD\\tID1\\tID2\\tIDali\\tL1\\tL2\\tLali\\n')
+for query, query_path in queries:
+    query_length = n_residues(query_path)
+    for entry in entries:
+        key = query + entry
+        out.write(f'{query}:A\\t{entry}.pdb:A\\t{value(key + "1"):.4f}\\t{value(key + "2"):.4f}\\t{1 + 5 * value(key + "3"):.2f}\\t{value(key + "4"):.3f}\\t'
+                  f'{value(key + "5"):.3f}\\t{value(key + "6"):.3f}\\t{query_length}\\t{lengths[entry]}\\t{int(min(query_length, lengths[entry]) * value(key + "7"))}\\n')
+'''
+
+SBATCH_STUB = f'''#!{sys.executable}
+import os, sys, time, fcntl
+bench_dir = os.environ['BENCHMARK_SLURM_DIR']
+time.sleep(float(os.environ.get('{STUB_STARTUP_ENV_VAR}', 0)))
+with open(os.path.join(bench_dir, 'sbatch.log'), 'a+') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    f.seek(0)
+    job_id = 1000 + sum(1 for _ in f)
+    f.write(os.getcwd() + ' ' + ' '.join(sys.argv[1:]) + '\\n')
+print(job_id)
+'''
+
+# Nothing is ever queued or accounted for, reconciling only looks for finished models
+EMPTY_STUB = f'''#!{sys.executable}
+'''
+
+
+def main():
+    args, parser = parse_arguments()
+
+    try:
+        if args.command == 'parse_worker':
+            run_parse_worker(args.tool, args.aln_file)
+            return None
+        if args.command == 'compare':
+            n_regressions = compare_results(args.results, args.base, args.head, args.threshold)
+            sys.exit(1 if n_regressions else 0)
+
+        bench_dir = Path(args.bench_dir).resolve()
+        bench_dir.mkdir(parents=True, exist_ok=True)
+        if args.command == 'search':
+            records = benchmark_search(bench_dir, args.proteome_sizes, args.workers, args.queries, args.startup_latency,
+                                       args.structure_latency, args.repeat, args.stage_metrics, args.extra_args)
+        elif args.command == 'parse':
+            records = benchmark_parse(bench_dir, args.lines, args.repeat)
+        else:
+            records = benchmark_distribute(bench_dir, args.fasta_files, args.modes, args.startup_latency, args.repeat)
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+    save_results(args.results, records)
+    print(f"Saved {len(records)} benchmark results to {args.results}.")
+    return None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the structure homology search and the AlphaFold2 distributor with stub tools and synthetic data')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_common_arguments(subparser):
+        subparser.add_argument('-b', '--bench_dir', metavar='bench_dir', type=str, default='./benchmark_data', help='Directory for the synthetic data, stub tools and outputs, reused between runs. Default: ./benchmark_data')
+        subparser.add_argument('-r', '--results', metavar='results', type=str, default=DEFAULT_RESULTS_FILE, help=f'JSON lines file the results are appended to. Default: {DEFAULT_RESULTS_FILE}')
+        subparser.add_argument('--repeat', metavar='repeat', type=int, default=3, help='Runs per case, the median is reported. Default: 3')
+
+    search = subparsers.add_parser('search', help='End to end throughput of fatcat_tmalign_proteome_search.py across proteome sizes and worker counts')
+    add_common_arguments(search)
+    search.add_argument('--proteome_sizes', metavar='proteome_sizes', type=int, nargs='+', default=[500, 5000], help='Structures per synthetic proteome. Default: 500 5000')
+    search.add_argument('--workers', metavar='workers', type=int, nargs='+', default=[1, 4, 16], help='Worker counts to run every proteome size with. Default: 1 4 16')
+    search.add_argument('--queries', metavar='queries', type=int, default=8, help='Number of synthetic queries. Default: 8')
+    search.add_argument('--startup_latency', metavar='startup_latency', type=float, default=0.05, help='Seconds every stub tool run waits before writing output. Default: 0.05')
+    search.add_argument('--structure_latency', metavar='structure_latency', type=float, default=0.0002, help='Seconds the stub tools wait per aligned structure. Default: 0.0002')
+    search.add_argument('--stage_metrics', action='store_true', help='Run the search with --metrics and store the total time of every stage with the result.')
+    search.add_argument('--extra_args', metavar='extra_args', type=str, nargs=argparse.REMAINDER, default=[], help='Further arguments for the search script, given last, EX: --extra_args --shards 4 --cascade_top_k 50')
+
+    parse = subparsers.add_parser('parse', help='Parse speed of parse_fatcat_file and parse_tmalign_file on large outputs')
+    add_common_arguments(parse)
+    parse.add_argument('--lines', metavar='lines', type=int, nargs='+', default=[1000000], help='Lines of synthetic tool output to parse. Default: 1000000')
+
+    distribute = subparsers.add_parser('distribute', help='Submission throughput of distribute_alphafold2.py with a fake sbatch')
+    add_common_arguments(distribute)
+    distribute.add_argument('--fasta_files', metavar='fasta_files', type=int, nargs='+', default=[1000], help='Number of synthetic fasta files. Default: 1000')
+    distribute.add_argument('--modes', metavar='modes', type=str, nargs='+', choices=list(DISTRIBUTE_MODES), default=list(DISTRIBUTE_MODES), help=f'Submission modes to run: {", ".join(DISTRIBUTE_MODES)}. Default: all')
+    distribute.add_argument('--startup_latency', metavar='startup_latency', type=float, default=0.01, help='Seconds every fake sbatch call takes. Default: 0.01')
+
+    compare = subparsers.add_parser('compare', help='Compare the results of two commits')
+    compare.add_argument('-r', '--results', metavar='results', type=str, default=DEFAULT_RESULTS_FILE, help=f'JSON lines file with the results. Default: {DEFAULT_RESULTS_FILE}')
+    compare.add_argument('--base', metavar='base', type=str, help='Commit to compare against. Default: the second to last commit in the results')
+    compare.add_argument('--head', metavar='head', type=str, help='Commit to compare. Default: the last commit in the results')
+    compare.add_argument('--threshold', metavar='threshold', type=float, default=0.1, help='Relative slowdown or memory growth reported as a regression, exits with 1 if there is one. Default: 0.1')
+
+    parse_worker = subparsers.add_parser('parse_worker')
+    parse_worker.add_argument('tool', choices=('fatcat', 'tm_align'))
+    parse_worker.add_argument('aln_file')
+
+    args = parser.parse_args()
+    if getattr(args, 'repeat', 1) < 1:
+        parser.error('--repeat must be at least 1.')
+    return args, parser
+
+
+def write_executable(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, 0o755)
+    return path
+
+
+def install_search_stubs(bench_dir):
+    # Laid out like the FATCAT and USalign github directories the search script expects
+    fatcat_install_dir = bench_dir / 'tools' / 'FATCAT-dist'
+    tm_align_install_dir = bench_dir / 'tools' / 'USalign'
+    write_executable(fatcat_install_dir / 'FATCATMain' / 'FATCATSearch.pl', FATCAT_STUB)
+    write_executable(tm_align_install_dir / 'USalign', USALIGN_STUB)
+    return fatcat_install_dir, tm_align_install_dir
+
+
+def install_slurm_stubs(bench_dir):
+    bin_dir = bench_dir / 'tools' / 'slurm'
+    write_executable(bin_dir / 'sbatch', SBATCH_STUB)
+    write_executable(bin_dir / 'squeue', EMPTY_STUB)
+    write_executable(bin_dir / 'sacct', EMPTY_STUB)
+    return bin_dir
+
+
+def structure_length(rng):
+    # Roughly the length distribution of a proteome: mostly 100-600 residues with a long tail
+    return max(30, min(2700, int(rng.lognormvariate(5.7, 0.6))))
+
+
+def write_synthetic_pdb(pdb_path, n_residues, rng):
+    # A CA trace as a random walk with 3.8 A steps, pLDDT like values in the B-factor column
+    x = y = z = 0.0
+    lines = []
+    for residue in range(1, n_residues + 1):
+        dx, dy, dz = rng.gauss(0, 1), rng.gauss(0, 1), rng.gauss(0, 1)
+        norm = max((dx * dx + dy * dy + dz * dz) ** 0.5, 1e-6)
+        x, y, z = x + 3.8 * dx / norm, y + 3.8 * dy / norm, z + 3.8 * dz / norm
+        lines.append(f"ATOM  {residue:>5}  CA  ALA A{residue:>4}    {x:>8.3f}{y:>8.3f}{z:>8.3f}  1.00{rng.uniform(40, 98):>6.2f}           C\n")
+    lines.append('END\n')
+    with open(pdb_path, 'w') as f:
+        f.writelines(lines)
+    return pdb_path
+
+
+def make_synthetic_structures(structure_dir, n_structures, prefix, seed):
+    # Generated once per size and seed, a finished marker makes interrupted generations start over
+    done_marker = structure_dir / '.generated'
+    if done_marker.exists():
+        return structure_dir
+    if structure_dir.exists():
+        shutil.rmtree(structure_dir)
+    structure_dir.mkdir(parents=True)
+    rng = random.Random(seed)
+    for i in range(n_structures):
+        write_synthetic_pdb(structure_dir / f'{prefix}{i:06d}.pdb', structure_length(rng), rng)
+    done_marker.touch()
+    return structure_dir
+
+
+def make_synthetic_proteomes(bench_dir, n_structures):
+    # The search takes a directory of proteome directories
+    proteomes_dir = bench_dir / 'data' / f'proteomes_{n_structures}'
+    make_synthetic_structures(proteomes_dir / 'synthetic', n_structures, 'AF-S', seed=n_structures)
+    return proteomes_dir
+
+
+def make_synthetic_fasta_files(fasta_dir, n_fasta_files, seed=0):
+    done_marker = fasta_dir / '.generated'
+    if done_marker.exists():
+        return fasta_dir
+    if fasta_dir.exists():
+        shutil.rmtree(fasta_dir)
+    fasta_dir.mkdir(parents=True)
+    rng = random.Random(seed)
+    for i in range(n_fasta_files):
+        sequence = ''.join(rng.choice(AMINO_ACIDS) for _ in range(structure_length(rng)))
+        with open(fasta_dir / f'target_{i:06d}.fasta', 'w') as f:
+            f.write(f'>target_{i:06d}\n')
+            f.writelines(sequence[start:start + 60] + '\n' for start in range(0, len(sequence), 60))
+    done_marker.touch()
+    return fasta_dir
+
+
+def run_measured(invocation, log_file, env=None, cwd=None):
+    # wait4 reports the CPU time of the child and its reaped descendants, and the max RSS of the largest of them
+    started = time.perf_counter()
+    with open(log_file, 'w') as log:
+        process = subprocess.Popen(invocation, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=cwd)
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+        except KeyboardInterrupt:
+            process.kill()
+            process.wait()
+            raise
+    seconds = time.perf_counter() - started
+    return_code = os.waitstatus_to_exitcode(status)
+    if return_code != 0:
+        raise Exception(f"'{' '.join(map(str, invocation))}' failed with exit code {return_code}, see {log_file}")
+    return {
+        'seconds': seconds,
+        'cpu_seconds': rusage.ru_utime + rusage.ru_stime,
+        'max_rss_mb': rusage.ru_maxrss / 1024,
+    }
+
+
+def summarize_runs(runs):
+    seconds = [run['seconds'] for run in runs]
+    return {
+        'seconds': statistics.median(seconds),
+        'min_seconds': min(seconds),
+        'max_seconds': max(seconds),
+        'cpu_seconds': statistics.median(run['cpu_seconds'] for run in runs),
+        'max_rss_mb': max(run['max_rss_mb'] for run in runs),
+        'runs': len(runs),
+    }
+
+
+def benchmark_search(bench_dir, proteome_sizes, workers_list, n_queries, startup_latency, structure_latency, repeat, stage_metrics=False, extra_args=()):
+    fatcat_install_dir, tm_align_install_dir = install_search_stubs(bench_dir)
+    query_dir = make_synthetic_structures(bench_dir / 'data' / f'queries_{n_queries}', n_queries, 'query_', seed=-n_queries)
+    env = dict(os.environ, **{STUB_STARTUP_ENV_VAR: str(startup_latency), STUB_PER_STRUCTURE_ENV_VAR: str(structure_latency)})
+
+    records = []
+    for n_structures in proteome_sizes:
+        proteomes_dir = make_synthetic_proteomes(bench_dir, n_structures)
+        for workers in workers_list:
+            case = {'proteome_size': n_structures, 'queries': n_queries, 'workers': workers,
+                    'startup_latency': startup_latency, 'structure_latency': structure_latency, 'extra_args': ' '.join(extra_args)}
+            output_name = bench_dir / 'output' / f'search_{n_structures}_{workers}.csv'
+            output_name.parent.mkdir(parents=True, exist_ok=True)
+            invocation = [sys.executable, str(SEARCH_SCRIPT), '-q', str(query_dir), '-p', str(proteomes_dir), '-f', str(fatcat_install_dir),
+                          '-t', str(tm_align_install_dir), '-o', str(output_name), '--force_overwrite', '-w', str(workers), *extra_args]
+            metrics_file = bench_dir / 'output' / f'search_{n_structures}_{workers}_metrics.jsonl'
+            if stage_metrics:
+                invocation += ['--metrics', str(metrics_file)]
+
+            runs = []
+            for _ in range(repeat):
+                runs.append(run_measured(invocation, bench_dir / 'output' / 'search.log', env=env))
+            result = summarize_runs(runs)
+            result['pairs_per_second'] = n_queries * n_structures / result['seconds']
+            if stage_metrics:
+                from metrics import summarize_metrics
+                result['stages'] = {row['stage']: row['total_seconds'] for row in summarize_metrics(metrics_file)}
+            records.append(make_record('search', case, result))
+            print(f"search {n_structures} structures x {n_queries} queries, {workers} workers: {result['seconds']:.2f} s, "
+                  f"{result['pairs_per_second']:.0f} pairs/s, {result['max_rss_mb']:.0f} MB max RSS")
+    return records
+
+
+def write_synthetic_fatcat_output(aln_path, n_lines, seed=0):
+    # Four lines per record like FATCATSearch.pl -q
+    rng = random.Random(seed)
+    with open(aln_path, 'w') as f:
+        for i in range(n_lines // 4):
+            length, align_length = rng.randint(50, 1500), rng.randint(20, 400)
+            f.write(f'Align query.pdb 350 with AF-S{i:07d}.pdb {length}\n')
+            f.write(f'P-value {rng.random() / 100:.2e} Afp-num {rng.randint(0, 20000)} Identity {100 * rng.random():.2f}% Similarity {100 * rng.random():.2f}%\n')
+            f.write(f'Twists {rng.randint(0, 3)} ini-len {align_length} ini-rmsd {2 * rng.random():.2f} opt-equ {align_length} opt-rmsd {4 * rng.random():.2f} '
+                    f'chain-rmsd {5 * rng.random():.2f} Score {600 * rng.random():.2f} align-len {align_length + 4} gaps 4 (3.00%)\n')
+            f.write('\n')
+    return aln_path
+
+
+def write_synthetic_tmalign_output(aln_path, n_lines, seed=0):
+    # One header line and one record per line like USalign -outfmt 2
+    rng = random.Random(seed)
+    with open(aln_path, 'w') as f:
+        f.write('#PDBchain1\tPDBchain2\tTM1\tTM2\tRMSD\tID1\tID2\tIDali\tL1\tL2\tLali\n')
+        for i in range(n_lines - 1):
+            f.write(f'query.pdb:A\tAF-S{i:07d}.pdb:A\t{rng.random():.4f}\t{rng.random():.4f}\t{1 + 5 * rng.random():.2f}\t{rng.random():.3f}\t'
+                    f'{rng.random():.3f}\t{rng.random():.3f}\t350\t{rng.randint(50, 1500)}\t{rng.randint(20, 350)}\n')
+    return aln_path
+
+
+def run_parse_worker(tool, aln_file):
+    # Runs in its own process so the max RSS belongs to this parse only
+    sys.path.insert(0, str(SCRIPT_DIR))
+    from fatcat_tmalign_proteome_search import parse_fatcat_file, parse_tmalign_file
+    started = time.perf_counter()
+    df = parse_fatcat_file(aln_file) if tool == 'fatcat' else parse_tmalign_file(aln_file)
+    print(json.dumps({'parse_seconds': time.perf_counter() - started, 'rows': len(df)}))
+    return None
+
+
+def benchmark_parse(bench_dir, lines_list, repeat):
+    records = []
+    data_dir = bench_dir / 'data'
+    data_dir.mkdir(parents=True, exist_ok=True)
+    for n_lines in lines_list:
+        for tool, write_output in (('fatcat', write_synthetic_fatcat_output), ('tm_align', write_synthetic_tmalign_output)):
+            aln_path = data_dir / f'{tool}_{n_lines}.aln'
+            if not aln_path.exists():
+                write_output(aln_path.with_suffix('.tmp'), n_lines)
+                os.replace(aln_path.with_suffix('.tmp'), aln_path)
+
+            runs = []
+            log_file = bench_dir / 'output' / f'parse_{tool}.log'
+            log_file.parent.mkdir(parents=True, exist_ok=True)
+            for _ in range(repeat):
+                run = run_measured([sys.executable, str(Path(__file__).resolve()), 'parse_worker', tool, str(aln_path)], log_file)
+                with open(log_file, 'r') as f:
+                    run.update(json.loads(f.read().strip().splitlines()[-1]))
+                runs.append(run)
+            # The time of the parse itself, without starting Python and importing pandas
+            result = summarize_runs([dict(run, seconds=run['parse_seconds']) for run in runs])
+            result['rows'] = runs[0]['rows']
+            result['lines_per_second'] = n_lines / result['seconds']
+            result['mb_per_second'] = os.path.getsize(aln_path) / 2 ** 20 / result['seconds']
+            records.append(make_record('parse', {'tool': tool, 'lines': n_lines}, result))
+            print(f"parse {tool} {n_lines} lines: {result['seconds']:.2f} s, {result['lines_per_second']:.0f} lines/s, {result['max_rss_mb']:.0f} MB max RSS")
+    return records
+
+
+def benchmark_distribute(bench_dir, fasta_files_list, modes, startup_latency, repeat):
+    bin_dir = install_slurm_stubs(bench_dir)
+    sif_file = bench_dir / 'tools' / 'alphafold.sif'
+    sif_file.touch()
+    slurm_dir = bench_dir / 'output' / 'slurm'
+    env = dict(os.environ, PATH=f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}", USER=os.environ.get('USER', 'benchmark'),
+               BENCHMARK_SLURM_DIR=str(slurm_dir), **{STUB_STARTUP_ENV_VAR: str(startup_latency)})
+
+    records = []
+    for n_fasta_files in fasta_files_list:
+        fasta_dir = make_synthetic_fasta_files(bench_dir / 'data' / f'fasta_{n_fasta_files}', n_fasta_files)
+        for mode in modes:
+            runs = []
+            for _ in range(repeat):
+                # Every run starts from an empty output directory, otherwise the ledger skips all targets
+                alpha_out_dir = bench_dir / 'output' / f'alphafold_{n_fasta_files}_{mode}'
+                for directory in (alpha_out_dir, slurm_dir):
+                    shutil.rmtree(directory, ignore_errors=True)
+                slurm_dir.mkdir(parents=True)
+                invocation = [sys.executable, str(DISTRIBUTE_SCRIPT), '-f', str(fasta_dir), '-o', str(alpha_out_dir), '-s', str(sif_file),
+                              '-r', str(SCRIPT_DIR / 'run.sh'), *DISTRIBUTE_MODES[mode]]
+                run = run_measured(invocation, bench_dir / 'output' / 'distribute.log', env=env)
+                with open(slurm_dir / 'sbatch.log', 'r') as f:
+                    run['sbatch_calls'] = sum(1 for _ in f)
+                reconcile = run_measured([sys.executable, str(DISTRIBUTE_SCRIPT), 'reconcile', '-o', str(alpha_out_dir)],
+                                         bench_dir / 'output' / 'reconcile.log', env=env)
+                run['reconcile_seconds'] = reconcile['seconds']
+                runs.append(run)
+            result = summarize_runs(runs)
+            result['sbatch_calls'] = runs[0]['sbatch_calls']
+            result['reconcile_seconds'] = statistics.median(run['reconcile_seconds'] for run in runs)
+            result['targets_per_second'] = n_fasta_files / result['seconds']
+            records.append(make_record('distribute', {'fasta_files': n_fasta_files, 'mode': mode, 'startup_latency': startup_latency}, result))
+            print(f"distribute {n_fasta_files} fasta files ({mode}): {result['seconds']:.2f} s, {result['sbatch_calls']} sbatch calls, "
+                  f"reconcile {result['reconcile_seconds']:.2f} s, {result['max_rss_mb']:.0f} MB max RSS")
+    return records
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR, check=True, capture_output=True, text=True).stdout.strip()
+        changes = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=SCRIPT_DIR, check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+    return commit, bool(changes)
+
+
+def make_record(benchmark, case, result):
+    commit, dirty = git_commit()
+    record = {
+        'benchmark': benchmark,
+        'case': case,
+        'commit': commit,
+        'dirty': dirty,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': socket.gethostname(),
+        'cpus': os.cpu_count(),
+        'python': sys.version.split()[0],
+    }
+    record.update(result)
+    return record
+
+
+def save_results(results_file, records):
+    with open(results_file, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+    return None
+
+
+def load_results(results_file):
+    with open(results_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def case_key(record):
+    return record['benchmark'], json.dumps(record['case'], sort_keys=True)
+
+
+def compare_results(results_file, base=None, head=None, threshold=0.1):
+    # The latest result of every case is compared, the commits default to the last two in the results file
+    records = load_results(results_file)
+    commits = list(dict.fromkeys(record['commit'] for record in records))
+    if base is None or head is None:
+        if len(commits) < 2:
+            raise Exception(f"'{results_file}' only has results of {len(commits)} commit(s), run the benchmarks on another commit first.")
+        base = commits[-2] if base is None else base
+        head = commits[-1] if head is None else head
+
+    latest = {base: {}, head: {}}
+    for record in records:
+        for commit in latest:
+            if record['commit'].startswith(commit) or commit.startswith(record['commit']):
+                latest[commit][case_key(record)] = record
+
+    n_regressions = 0
+    print(f"{'benchmark':<12}{'case':<90}{base + ' s':>12}{head + ' s':>12}{'ratio':>8}{'RSS ratio':>11}")
+    for key in sorted(set(latest[base]) & set(latest[head])):
+        base_record, head_record = latest[base][key], latest[head][key]
+        ratio = head_record['seconds'] / base_record['seconds']
+        rss_ratio = head_record['max_rss_mb'] / base_record['max_rss_mb'] if base_record['max_rss_mb'] else 1.0
+        regression = ratio > 1 + threshold or rss_ratio > 1 + threshold
+        n_regressions += regression
+        case = ' '.join(f'{name}={value}' for name, value in json.loads(key[1]).items() if value not in ('', None))
+        print(f"{key[0]:<12}{case:<90}{base_record['seconds']:>12.3f}{head_record['seconds']:>12.3f}{ratio:>8.2f}{rss_ratio:>11.2f}"
+              + ('  REGRESSION' if regression else ''))
+    missing = set(latest[base]) ^ set(latest[head])
+    if missing:
+        print(f"{len(missing)} cases were only run on one of the two commits.")
+    print(f"{n_regressions} regressions over {threshold:.0%}.")
+    return n_regressions
+
+
+if __name__ == '__main__':
+    main()
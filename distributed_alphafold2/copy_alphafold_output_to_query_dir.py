@@ -1,43 +1,223 @@
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 import os
+import json
+import fcntl
+import errno
 import argparse
+from sequence_registry import REGISTRY_DIR_NAME, ALIAS_MODES, populate_aliases
+from proteome_index import write_atomically
+
+# Every harvest records the model file it placed for each target in a manifest in the query directory, together
+# with the size and mtime of the files it was chosen from. Incremental harvests skip targets whose files did not
+# change, so a rerun over tens of thousands of targets only stats files instead of copying them again.
+MANIFEST_FILE_NAME = '.harvest_manifest.json'
+PLDDT_FILE_NAME = 'plddt.csv'
+LINK_MODES = ('copy', 'hardlink', 'symlink', 'reflink')
+SELECT_MODELS = ('ranked_0', 'ranking_debug')
+FICLONE = 0x40049409
 
 
 def main():
     args, parser = parse_arguments()
-    
+
     alphafold_out_dir = Path(args.alphafold_out_dir)
     query_file_dir = Path(args.query_file_dir)
-    copy_alphafold_output_to_query_dir(query_file_dir, alphafold_out_dir)
-    
+
+    # Fasta files deduplicated by distribute_alphafold2.py --deduplicate get the result of their canonical sequence first
+    if (alphafold_out_dir / REGISTRY_DIR_NAME).exists():
+        populate_aliases(alphafold_out_dir, args.alias_mode)
+    copy_alphafold_output_to_query_dir(query_file_dir, alphafold_out_dir, incremental=args.incremental, link_mode=args.link_mode,
+                                       select_model=args.select_model, plddt_sidecar=args.plddt_sidecar, workers=args.workers)
+
     return None
-    
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Copy AlphaFold2 output (ranked_0.pdb) to query directory')
     parser.add_argument('-q', '--query_file_dir', metavar='query_file_dir', type=str, help='Directory the PDB files will be saved to EX: ./query_dir/')
     parser.add_argument('-a', '--alphafold_out_dir', metavar='alphafold_out_dir', type=str, help='Directory the AlphaFold output files are saved to EX: ./alphafold_output_dir/')
+    parser.add_argument('--alias_mode', metavar='alias_mode', type=str, choices=ALIAS_MODES, default='symlink', help='How fasta files deduplicated by distribute_alphafold2.py --deduplicate get the canonical result: symlink or copy. Default: symlink')
+    parser.add_argument('--incremental', action='store_true', help=f'Skip targets whose model files did not change since the last harvest into query_file_dir (recorded in {MANIFEST_FILE_NAME}).')
+    parser.add_argument('--link_mode', metavar='link_mode', type=str, choices=LINK_MODES, default='copy', help='How models are placed in query_file_dir: copy, hardlink, symlink or reflink (copy on write clone, falls back to copy where the file system cannot clone). Default: copy')
+    parser.add_argument('--select_model', metavar='select_model', type=str, choices=SELECT_MODELS, default='ranked_0', help='Harvest ranked_0.pdb, or the best model listed in ranking_debug.json (relaxed if available, otherwise unrelaxed). Default: ranked_0')
+    parser.add_argument('--plddt_sidecar', action='store_true', help=f'Write the mean pLDDT and ranking confidence of every harvested model to query_file_dir/{PLDDT_FILE_NAME}.')
+    parser.add_argument('-w', '--workers', metavar='workers', type=int, default=16, help='Number of output directories scanned in parallel. Default: 16')
     args = parser.parse_args()
     return args, parser
 
-def copy_alphafold_output_to_query_dir(query_file_dir: Path, alphafold_out_dir: Path):
-    
+def copy_alphafold_output_to_query_dir(query_file_dir: Path, alphafold_out_dir: Path, incremental: bool = False, link_mode: str = 'copy',
+                                       select_model: str = 'ranked_0', plddt_sidecar: bool = False, workers: int = 16):
+
     if not query_file_dir.exists():
         os.makedirs(query_file_dir)
-    for pdb_dir in alphafold_out_dir.iterdir():
-        if pdb_dir.is_dir():
-            for file in pdb_dir.iterdir():
-                if file.is_file():
-                    if file.name == 'ranked_0.pdb':
-                        shutil.copy(file, query_file_dir / f'{pdb_dir.name}.pdb')
-                else:
-                    if file.is_dir():
-                        if file.name == pdb_dir.name:
-                            for subfile in file.iterdir():
-                                if subfile.is_file():
-                                    if subfile.name == 'ranked_0.pdb':
-                                        shutil.copy(subfile, query_file_dir / f'{pdb_dir.name}.pdb')
-                        
+    manifest = load_manifest(query_file_dir)
+
+    # Absolute paths keep the manifest valid when harvesting from another working directory
+    alphafold_out_dir = os.path.abspath(alphafold_out_dir)
+    with os.scandir(alphafold_out_dir) as entries:
+        pdb_dirs = [entry.path for entry in entries if entry.is_dir() and not entry.name.startswith('.')]
+
+    def harvest(pdb_dir):
+        name = os.path.basename(pdb_dir)
+        return name, harvest_target(pdb_dir, query_file_dir / f'{name}.pdb', manifest.get(name) if incremental else None, link_mode, select_model)
+
+    n_harvested, n_unchanged = 0, 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for name, (entry, harvested) in executor.map(harvest, pdb_dirs):
+            if entry is None:
+                continue
+            manifest[name] = entry
+            n_harvested += harvested
+            n_unchanged += not harvested
+
+    write_atomically(query_file_dir / MANIFEST_FILE_NAME, json.dumps(manifest, indent=1, sort_keys=True))
+    if plddt_sidecar:
+        write_plddt_sidecar(query_file_dir, manifest)
+    print(f"Harvested {n_harvested} models, {n_unchanged} unchanged.")
+    return None
+
+
+def load_manifest(query_file_dir):
+    manifest_file = query_file_dir / MANIFEST_FILE_NAME
+    if not manifest_file.exists():
+        return {}
+    try:
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError):
+        return {}
+
+
+def find_model_dir(pdb_dir):
+    # Single jobs write to <pdb_dir>/<name>/, packed jobs to <pdb_dir>/ itself
+    name = os.path.basename(pdb_dir)
+    for model_dir in (os.path.join(pdb_dir, name), pdb_dir):
+        try:
+            with os.scandir(model_dir) as entries:
+                files = {entry.name: entry.stat() for entry in entries if entry.name in ('ranked_0.pdb', 'ranking_debug.json')
+                         or (entry.name.startswith(('relaxed_', 'unrelaxed_')) and entry.name.endswith('.pdb'))}
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        if 'ranked_0.pdb' in files or 'ranking_debug.json' in files:
+            return model_dir, files
+    return None, {}
+
+
+def file_signature(files, file_names):
+    return [[file_name, files[file_name].st_size, files[file_name].st_mtime_ns] for file_name in file_names if file_name in files]
+
+
+def harvest_target(pdb_dir, destination, previous_entry, link_mode, select_model):
+    model_dir, files = find_model_dir(pdb_dir)
+    if model_dir is None:
+        return None, False
+
+    if previous_entry is not None and previous_entry['link_mode_requested'] == link_mode and previous_entry['select_model'] == select_model \
+            and os.path.dirname(previous_entry['source']) == model_dir \
+            and previous_entry['signature'] == file_signature(files, [name for name, _, _ in previous_entry['signature']]) \
+            and os.path.lexists(destination):
+        return previous_entry, False
+
+    ranking = None
+    if 'ranking_debug.json' in files:
+        with open(os.path.join(model_dir, 'ranking_debug.json'), 'r') as f:
+            ranking = json.load(f)
+    model_file = select_model_file(files, ranking, select_model)
+    if model_file is None:
+        return None, False
+
+    source = os.path.join(model_dir, model_file)
+    entry = {
+        'source': source,
+        'signature': file_signature(files, ['ranking_debug.json', model_file]),
+        'select_model': select_model,
+        'link_mode_requested': link_mode,
+        'link_mode': place_file(source, destination, link_mode),
+    }
+    entry.update(model_confidence(source, ranking))
+    return entry, True
+
+
+def select_model_file(files, ranking, select_model):
+    if select_model == 'ranking_debug' and ranking is not None:
+        best_model = ranking['order'][0]
+        for model_file in (f'relaxed_{best_model}.pdb', f'unrelaxed_{best_model}.pdb'):
+            if model_file in files:
+                return model_file
+    if 'ranked_0.pdb' in files:
+        return 'ranked_0.pdb'
+    return None
+
+
+def model_confidence(model_path, ranking):
+    # ranking_debug.json holds the mean pLDDT of every model (monomers) or its iptm+ptm (multimers); order[0] is
+    # the model behind ranked_0.pdb. A pLDDT it does not hold is read from the B-factor column of the CA atoms.
+    if ranking is None:
+        mean_plddt = mean_ca_bfactor(model_path)
+        return {'model': os.path.basename(model_path)[:-len('.pdb')], 'mean_plddt': mean_plddt, 'ranking_confidence': mean_plddt}
+
+    best_model = ranking['order'][0]
+    if 'ranked_0' not in os.path.basename(model_path):
+        best_model = os.path.basename(model_path).split('relaxed_', 1)[1][:-len('.pdb')]
+    mean_plddt = ranking.get('plddts', {}).get(best_model)
+    if mean_plddt is None:
+        mean_plddt = mean_ca_bfactor(model_path)
+    ranking_confidence = ranking.get('iptm+ptm', {}).get(best_model)
+    return {'model': best_model, 'mean_plddt': mean_plddt, 'ranking_confidence': mean_plddt if ranking_confidence is None else ranking_confidence}
+
+
+def mean_ca_bfactor(model_path):
+    plddts = []
+    with open(model_path, 'r') as f:
+        for line in f:
+            if line.startswith('ATOM') and line[12:16].strip() == 'CA':
+                plddts.append(float(line[60:66]))
+    return sum(plddts) / len(plddts) if plddts else None
+
+
+def place_file(source, destination, link_mode):
+    # Returns the link mode that was actually used, hardlinks and reflinks fall back to copying where the file
+    # system does not support them
+    if os.path.lexists(destination):
+        os.unlink(destination)
+    if link_mode == 'symlink':
+        os.symlink(os.path.abspath(source), destination)
+        return 'symlink'
+    if link_mode == 'hardlink':
+        try:
+            os.link(source, destination)
+            return 'hardlink'
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    if link_mode == 'reflink':
+        try:
+            reflink_file(source, destination)
+            return 'reflink'
+        except OSError as e:
+            if os.path.lexists(destination):
+                os.unlink(destination)
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                raise
+    shutil.copy(source, destination)
+    return 'copy'
+
+
+def reflink_file(source, destination):
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+
+def write_plddt_sidecar(query_file_dir, manifest):
+    lines = ['query,model,mean_plddt,ranking_confidence\n']
+    for name, entry in sorted(manifest.items()):
+        mean_plddt = '' if entry['mean_plddt'] is None else entry['mean_plddt']
+        ranking_confidence = '' if entry['ranking_confidence'] is None else entry['ranking_confidence']
+        lines.append(f"{name},{entry['model']},{mean_plddt},{ranking_confidence}\n")
+    write_atomically(query_file_dir / PLDDT_FILE_NAME, ''.join(lines))
+    return None
+
+
 if __name__ == '__main__':
     main()
-
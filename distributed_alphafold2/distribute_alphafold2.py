@@ -2,17 +2,45 @@
 import os
 import argparse
 import shutil
+import subprocess
 import sys
+import time
 import traceback
+from collections import deque
+from job_planner import (DEFAULT_LENGTH_TIERS, DEFAULT_PACK_SIZE, DEFAULT_PACK_MAX_RESIDUES, read_fasta_length, parse_length_tiers,
+                         plan_jobs, print_job_plan, apply_job_resources, fasta_paths_value)
+from sequence_registry import ALIAS_MODES, register_targets, populate_aliases, find_result_dir
+from job_ledger import (open_ledger, ledger_exists, get_targets, record_planned, record_submitted, select_targets_to_submit,
+                        reconcile_ledger, print_ledger_status)
+from metrics import enable_metrics, stage_timer, print_metrics_summary
+
+COMMANDS = ('submit', 'status', 'reconcile', 'resubmit_failed')
 
 # Enable command line arguments for the directory containing the fasta data and the directory into which the AlphaFold2 results will be saved
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Distribute AlphaFold2')
+    parser.add_argument('command', nargs='?', choices=COMMANDS, default='submit', help='submit the fasta files (default), print the job states recorded in the ledger (status), update them from squeue, sacct and the AlphaFold2 output (reconcile), or resubmit the failed targets (resubmit_failed).')
     parser.add_argument('-f', '--fasta_file_dir', metavar='fasta_file_dir', type=str, help='Directory containing the fasta files EX: ./fasta_files/')
     parser.add_argument('-o', '--alphafold_out_dir', metavar='alphafold_out_dir', type=str, help='Path to the output directory for AlphaFold2 results EX: ./alphafold_out_dir/')
     parser.add_argument('-s', '--sif_file', metavar='sif_file', type=str, help='Path to the AlphaFold2 singularity image file EX: ./sif_file/alphafold.sif')
     parser.add_argument('-r', '--run_script', metavar='run_script', type=str, help='Path to the run script EX: ./run.sh')
+    parser.add_argument('--feature_script', metavar='feature_script', type=str, help='Split every job into a CPU job that runs this feature script template and writes features.pkl, and a GPU inference job (the run script, default ./run_inference.sh) that starts once the feature job finished successfully. EX: ./run_features.sh')
     parser.add_argument('--force_overwrite', action='store_true', help='Force overwrite of existing results if they exist to rerun AlphaFold2 for all fasta files.')
+    parser.add_argument('--array', action='store_true', help='Submit all fasta files as one Slurm job array instead of one sbatch per fasta file.')
+    parser.add_argument('--array_throttle', metavar='array_throttle', type=int, help='Maximum number of array tasks running at the same time (sbatch --array=...%%N).')
+    parser.add_argument('--max_array_size', metavar='max_array_size', type=int, default=1000, help='Largest job array to submit, bigger batches are split into several arrays (Slurm MaxArraySize). Default: 1000')
+    parser.add_argument('--plan', action='store_true', help='Plan jobs by sequence length: pack short sequences into multi target jobs and give every length tier its own time and memory.')
+    parser.add_argument('--length_tiers', metavar='length_tiers', type=str, nargs='+', default=DEFAULT_LENGTH_TIERS, help=f'Length tiers used by --plan as max_length=time_per_target/memory. Default: {" ".join(DEFAULT_LENGTH_TIERS)}')
+    parser.add_argument('--pack_size', metavar='pack_size', type=int, default=DEFAULT_PACK_SIZE, help=f'Maximum number of fasta files packed into one job from the shortest length tier. Default: {DEFAULT_PACK_SIZE}')
+    parser.add_argument('--pack_max_residues', metavar='pack_max_residues', type=int, default=DEFAULT_PACK_MAX_RESIDUES, help=f'Maximum total number of residues in one packed job. Default: {DEFAULT_PACK_MAX_RESIDUES}')
+    parser.add_argument('--dry_run', action='store_true', help='Print the jobs that would be submitted without creating directories or submitting anything.')
+    parser.add_argument('--deduplicate', action='store_true', help='Only submit one job per unique sequence, including sequences already distributed to alphafold_out_dir by earlier runs. Fasta files with a duplicate sequence get the result of the canonical one.')
+    parser.add_argument('--alias_mode', metavar='alias_mode', type=str, choices=ALIAS_MODES, default='symlink', help='How duplicate fasta files get the canonical result with --deduplicate: symlink or copy. Default: symlink')
+    parser.add_argument('--max_in_flight', metavar='max_in_flight', type=int, help='Keep submitting as a long running daemon with at most this many jobs pending or running, topping up the queue as jobs finish. With --feature_script the feature and inference jobs of a target count separately.')
+    parser.add_argument('--poll_interval', metavar='poll_interval', type=float, default=60, help='Seconds between scheduler polls with --max_in_flight. Default: 60')
+    parser.add_argument('--max_retries', metavar='max_retries', type=int, default=3, help='How often a failed or rejected job is retried with --max_in_flight. Default: 3')
+    parser.add_argument('--metrics', metavar='metrics', type=str, help='Write the time spent listing, deduplicating, planning and building the runs, every sbatch call and every squeue/sacct query to this JSON lines file, and print a summary at the end. EX: ./submit_metrics.jsonl')
+    parser.add_argument('--retry_backoff', metavar='retry_backoff', type=float, default=300, help='Seconds to wait before the first retry with --max_in_flight, doubled with every further retry. Default: 300')
     args = parser.parse_args()
     return args, parser
 
@@ -20,20 +48,38 @@ def parse_arguments():
 def main():
     # Parse command line arguments
     args, parser = parse_arguments()
+    metrics_file = enable_metrics(args.metrics) if args.metrics else None
     
     try:
+        if args.command in ('status', 'reconcile'):
+            alpha_out_dir = ensure_correct_alpha_out_dir(args, parser)
+            report_job_states(alpha_out_dir, reconcile=args.command == 'reconcile')
+            return None
+        
         fasta_file_dir, alpha_out_dir, force_overwrite, sif_file, run_script = ensure_correct_script_input(args, parser)
+        submission_settings = ensure_correct_submission_settings(args, parser)
         current_directory = os.getcwd()
 
-        # Distribute AlphaFold2
-        distribute_alphafold_to_all_fasta_files(fasta_file_dir, alpha_out_dir, force_overwrite, sif_file, run_script, current_directory) 
+        if args.command == 'resubmit_failed':
+            given_up_targets = resubmit_failed_targets(alpha_out_dir, sif_file, run_script, **submission_settings)
+        else:
+            # Distribute AlphaFold2
+            given_up_targets = distribute_alphafold_to_all_fasta_files(fasta_file_dir, alpha_out_dir, force_overwrite, sif_file, run_script, current_directory, **submission_settings)
         
-        print("AlphaFold2 distributed successfully.")
+        # The submit daemon abandons targets that failed more than --max_retries times
+        if given_up_targets:
+            print(f"Gave up on {len(given_up_targets)} targets: {', '.join(given_up_targets)}. Fix them and run resubmit_failed.")
+            sys.exit(1)
+        if args.command != 'resubmit_failed':
+            print("AlphaFold2 distributed successfully.")
     
     except Exception as e:
         print(f"{traceback.format_exc()}")
         parser.print_help()
         sys.exit(1)
+    finally:
+        if metrics_file is not None:
+            print_metrics_summary(metrics_file)
     
     return None
 
@@ -41,15 +87,15 @@ def main():
 def ensure_correct_script_input(args, parser):
     if args.fasta_file_dir:
         fasta_file_dir = args.fasta_file_dir
+    elif args.command == 'resubmit_failed':
+        # The failed targets and their fasta files are taken from the ledger
+        fasta_file_dir = None
     else:
         parser.print_help()
         print("\nPlease provide the directory containing the fasta files using --fasta_file_dir or -f.")
         sys.exit(1)
         
-    if args.alphafold_out_dir:
-        alpha_out_dir = os.path.abspath(args.alphafold_out_dir)
-    else:
-        raise Exception(f"\nPlease provide the directory where the AlphaFold2 results will be saved using --alphafold_out_dir or -o.")
+    alpha_out_dir = ensure_correct_alpha_out_dir(args, parser)
     
     if args.sif_file:
         sif_file = os.path.abspath(args.sif_file)
@@ -60,6 +106,8 @@ def ensure_correct_script_input(args, parser):
     
     if args.run_script:
         run_script = os.path.abspath(args.run_script)
+    elif args.feature_script and os.path.exists('run_inference.sh'):
+        run_script = os.path.abspath('run_inference.sh')
     elif os.path.exists('run.sh'):
         run_script = os.path.abspath('run.sh')
     else:
@@ -71,14 +119,74 @@ def ensure_correct_script_input(args, parser):
     return fasta_file_dir, alpha_out_dir, force_overwrite, sif_file, run_script
 
 
-def distribute_alphafold_to_all_fasta_files(fasta_file_dir: str, alpha_out_dir: str, force_overwrite: bool, sif_file: str, run_script: str, current_directory: str):
+def ensure_correct_alpha_out_dir(args, parser):
+    if args.alphafold_out_dir:
+        alpha_out_dir = os.path.abspath(args.alphafold_out_dir)
+    else:
+        raise Exception(f"\nPlease provide the directory where the AlphaFold2 results will be saved using --alphafold_out_dir or -o.")
+    return alpha_out_dir
+
+
+def ensure_correct_submission_settings(args, parser):
+    if args.array_throttle is not None and args.array_throttle < 1:
+        raise Exception("\nThe array throttle must be at least 1.")
+    if args.max_array_size < 1:
+        raise Exception("\nThe maximum array size must be at least 1.")
+    if (args.array_throttle is not None) and (not args.array):
+        raise Exception("\n--array_throttle can only be used together with --array.")
+    
+    if args.pack_size < 1:
+        raise Exception("\nThe pack size must be at least 1.")
+    
+    feature_script = None
+    if args.feature_script:
+        feature_script = os.path.abspath(args.feature_script)
+        if not os.path.exists(feature_script):
+            raise Exception(f"Feature script '{feature_script}' does not exist.")
+    
+    throttle = None
+    if args.max_in_flight is not None:
+        if args.max_in_flight < 1:
+            raise Exception("\nThe maximum number of jobs in flight must be at least 1.")
+        if args.array:
+            raise Exception("\n--max_in_flight submits jobs one at a time and cannot be combined with --array, use --array_throttle instead.")
+        if args.poll_interval < 0 or args.max_retries < 0 or args.retry_backoff < 0:
+            raise Exception("\n--poll_interval, --max_retries and --retry_backoff cannot be negative.")
+        throttle = {
+            'max_in_flight': args.max_in_flight,
+            'poll_interval': args.poll_interval,
+            'max_retries': args.max_retries,
+            'retry_backoff': args.retry_backoff,
+        }
+    
+    return {
+        'array': args.array,
+        'array_throttle': args.array_throttle,
+        'max_array_size': args.max_array_size,
+        'plan': args.plan,
+        'length_tiers': args.length_tiers,
+        'pack_size': args.pack_size,
+        'pack_max_residues': args.pack_max_residues,
+        'dry_run': args.dry_run,
+        'deduplicate': args.deduplicate,
+        'alias_mode': args.alias_mode,
+        'throttle': throttle,
+        'feature_script': feature_script,
+    }
+
+
+def distribute_alphafold_to_all_fasta_files(fasta_file_dir: str, alpha_out_dir: str, force_overwrite: bool, sif_file: str, run_script: str, current_directory: str,
+                                            array: bool = False, array_throttle: int = None, max_array_size: int = 1000,
+                                            plan: bool = False, length_tiers: list = None, pack_size: int = DEFAULT_PACK_SIZE, pack_max_residues: int = DEFAULT_PACK_MAX_RESIDUES,
+                                            dry_run: bool = False, deduplicate: bool = False, alias_mode: str = 'symlink', throttle: dict = None,
+                                            feature_script: str = None):
     
     # Check if fasta_file_dir exists
     if not os.path.exists(fasta_file_dir):
         raise Exception(f"Directory '{fasta_file_dir}' does not exist.")
     
     # Check if alpha_out_dir exists, if not create it
-    if not os.path.exists(alpha_out_dir):
+    if not os.path.exists(alpha_out_dir) and not dry_run:
         os.makedirs(alpha_out_dir)
     
     # Check if sif_file exists
@@ -89,126 +197,425 @@ def distribute_alphafold_to_all_fasta_files(fasta_file_dir: str, alpha_out_dir:
     if not os.path.exists(run_script):
         raise Exception(f"Run script '{run_script}' does not exist.")
     
-    build_each_fasta_a_run(fasta_file_dir, alpha_out_dir, current_directory, force_overwrite, sif_file, run_script)
+    with stage_timer('list_targets') as fields:
+        targets = list_fasta_targets(fasta_file_dir, alpha_out_dir)
+        fields['files'] = len(targets)
+    alias_targets = []
+    if deduplicate:
+        with stage_timer('deduplicate', files=len(targets)):
+            targets, alias_targets = register_targets(alpha_out_dir, targets, dry_run)
+    
+    # The ledger decides which targets still need a job, a dry run only reads an existing one
+    connection = open_ledger(alpha_out_dir) if (not dry_run) or ledger_exists(alpha_out_dir) else None
+    targets, skipped_targets = select_targets_to_submit(connection, alpha_out_dir, targets, force_overwrite)
+    if skipped_targets:
+        print(f"Skipping {len(skipped_targets)} fasta files that are already submitted, running or done, use --force_overwrite to rerun them.")
+    
+    jobs = plan_submission(targets, alpha_out_dir, plan, length_tiers, pack_size, pack_max_residues, dry_run)
+    if dry_run:
+        for target in alias_targets:
+            print(f"{target['name']}: same sequence as {target['canonical']}, not submitted")
+        return []
     
-    launch_batch_jobs(fasta_file_dir, alpha_out_dir)
+    with stage_timer('build', files=len(targets)):
+        build_each_fasta_a_run(targets, alpha_out_dir, sif_file, run_script)
     
+    if deduplicate:
+        # Aliases of sequences that finished in earlier runs are populated right away, the others once the
+        # canonical prediction is finished (copy_alphafold_output_to_query_dir.py populates them when harvesting)
+        populated = populate_aliases(alpha_out_dir, alias_mode)
+        print(f"{len(alias_targets)} fasta files share their sequence with another fasta file and are not submitted, {len(populated)} of them were populated from finished results.")
+    
+    given_up_targets = submit_jobs(connection, jobs, alpha_out_dir, sif_file, run_script, array, array_throttle, max_array_size, plan, throttle, feature_script)
+    
+    return given_up_targets
+
+
+def plan_submission(targets, alpha_out_dir, plan, length_tiers, pack_size, pack_max_residues, dry_run):
+    if plan:
+        with stage_timer('plan', files=len(targets)):
+            jobs, tiers = plan_fasta_jobs(targets, alpha_out_dir, length_tiers, pack_size, pack_max_residues)
+        print_job_plan(jobs, tiers)
+    else:
+        jobs = targets_as_jobs(targets)
+        if dry_run:
+            for job in jobs:
+                print(f"{job['name']}: {job['fasta_file']} -> {job['out_dir']}")
+    return jobs
+
+
+def submit_jobs(connection, jobs, alpha_out_dir, sif_file, run_script, array, array_throttle, max_array_size, plan, throttle=None, feature_script=None):
+    # Returns the targets the submit daemon gave up on, the other submission modes do not wait for their jobs
+    record_planned(connection, [target for job in jobs for target in job['targets']])
+    given_up_targets = []
+    if array:
+        launch_array_jobs(jobs, alpha_out_dir, sif_file, run_script, array_throttle, max_array_size, connection, feature_script)
+    elif throttle is not None:
+        given_up_targets = run_submit_daemon(connection, jobs, alpha_out_dir, sif_file, run_script, feature_script=feature_script, **throttle)
+    elif plan or feature_script:
+        launch_planned_jobs(jobs, sif_file, run_script, connection, feature_script)
+    else:
+        launch_batch_jobs(jobs, connection)
+    return given_up_targets
+
+
+def run_submit_daemon(connection, jobs, alpha_out_dir, sif_file, run_script, max_in_flight, poll_interval=60, max_retries=3, retry_backoff=300, feature_script=None):
+    # Keeps at most max_in_flight Slurm jobs pending or running, with a feature script the feature and the inference
+    # job of a target count as two until its features.pkl is written. Every poll reconciles the ledger with the
+    # scheduler, retries failed jobs (and submissions sbatch rejected) after an exponential backoff and tops up
+    # the queue. Stopping the daemon loses nothing, the ledger knows every submitted job. Returns the names of the
+    # targets given up on after max_retries retries.
+    waiting = deque((job, 0.0) for job in jobs)
+    attempts = {job['name']: 0 for job in jobs}
+    submitted = {}
+    given_up = []
+    while True:
+        reconcile_ledger(connection, alpha_out_dir)
+        rows = {row['name']: row for row in get_targets(connection)}
+        
+        for job_name, job in list(submitted.items()):
+            target_states = [rows[target['name']]['state'] for target in job['targets']]
+            if any(state in ('submitted', 'running') for state in target_states):
+                continue
+            del submitted[job_name]
+            failed_targets = [target for target in job['targets'] if rows[target['name']]['state'] == 'failed']
+            if failed_targets:
+                schedule_retry(waiting, attempts, given_up, retry_job(job, failed_targets, alpha_out_dir), max_retries, retry_backoff, 'failed')
+        
+        in_flight = count_jobs_in_flight(rows, feature_script)
+        now = time.time()
+        for _ in range(len(waiting)):
+            if in_flight >= max_in_flight:
+                break
+            job, not_before = waiting.popleft()
+            if not_before > now:
+                waiting.append((job, not_before))
+                continue
+            attempts[job['name']] += 1
+            n_jobs = 2 if feature_script is not None and job_needs_features(job) else 1
+            try:
+                launch_planned_jobs([job], sif_file, run_script, connection, feature_script)
+            except Exception as e:
+                # Submit limits of the cluster show up as rejected submissions
+                print(f"Submission of {job['name']} was rejected: {e}")
+                schedule_retry(waiting, attempts, given_up, job, max_retries, retry_backoff, 'rejected')
+                break
+            submitted[job['name']] = job
+            in_flight += n_jobs
+        
+        print(f"{time.strftime('%H:%M:%S')} {in_flight} jobs in flight, {len(waiting)} waiting to be submitted.")
+        if not waiting and not submitted:
+            break
+        time.sleep(poll_interval)
+    return [target['name'] for job in given_up for target in job['targets']]
+
+
+def count_jobs_in_flight(rows, feature_script=None):
+    # The ledger only knows the inference job of a target, its feature job is still in flight while features.pkl is missing
+    job_ids = {row['job_id'] for row in rows.values() if row['state'] in ('submitted', 'running')}
+    if feature_script is None:
+        return len(job_ids)
+    feature_job_ids = {row['job_id'] for row in rows.values() if row['state'] in ('submitted', 'running') and
+                       find_result_dir(os.path.dirname(row['out_dir']), row['name'], 'features.pkl') is None}
+    return len(job_ids) + len(feature_job_ids)
+
+
+def schedule_retry(waiting, attempts, given_up, job, max_retries, retry_backoff, reason):
+    if attempts[job['name']] > max_retries:
+        print(f"Giving up on {job['name']}, it {reason} {attempts[job['name']]} times.")
+        given_up.append(job)
+        return None
+    delay = retry_backoff * 2 ** (attempts[job['name']] - 1)
+    print(f"Retrying {job['name']} in {delay:.0f} seconds, it {reason} (attempt {attempts[job['name']]} of {max_retries + 1}).")
+    waiting.append((job, time.time() + delay))
     return None
+
+
+def retry_job(job, failed_targets, alpha_out_dir):
+    # Targets of a packed job that did finish are not run again
+    if len(failed_targets) == len(job['targets']):
+        return job
+    job = dict(job, targets=failed_targets)
+    if len(failed_targets) == 1:
+        job.update({'work_dir': failed_targets[0]['out_dir'], 'out_dir': failed_targets[0]['out_dir']})
+    job['fasta_file'] = fasta_paths_value(job, alpha_out_dir)
+    return job
+
+
+def report_job_states(alpha_out_dir, reconcile=False):
+    if not ledger_exists(alpha_out_dir):
+        raise Exception(f"No job ledger found in '{alpha_out_dir}', nothing was submitted there yet.")
+    connection = open_ledger(alpha_out_dir)
+    if reconcile:
+        changed = reconcile_ledger(connection, alpha_out_dir)
+        print(f"Reconciled {len(changed)} targets with squeue, sacct and the AlphaFold2 output.")
+    print_ledger_status(connection)
+    return None
+
+
+def resubmit_failed_targets(alpha_out_dir, sif_file, run_script, array: bool = False, array_throttle: int = None, max_array_size: int = 1000,
+                            plan: bool = False, length_tiers: list = None, pack_size: int = DEFAULT_PACK_SIZE, pack_max_residues: int = DEFAULT_PACK_MAX_RESIDUES,
+                            dry_run: bool = False, throttle: dict = None, feature_script: str = None, **unused_settings):
+    if not ledger_exists(alpha_out_dir):
+        raise Exception(f"No job ledger found in '{alpha_out_dir}', nothing was submitted there yet.")
+    connection = open_ledger(alpha_out_dir)
+    reconcile_ledger(connection, alpha_out_dir)
     
+    targets = []
+    for row in get_targets(connection, ('failed',)):
+        target = {'name': row['name'], 'fasta_file': row['fasta_file'], 'out_dir': row['out_dir']}
+        target['source_fasta'] = os.path.join(row['out_dir'], row['fasta_file'])
+        targets.append(target)
+    if not targets:
+        print("No failed targets to resubmit.")
+        return []
+    
+    jobs = plan_submission(targets, alpha_out_dir, plan, length_tiers, pack_size, pack_max_residues, dry_run)
+    if dry_run:
+        return []
+    with stage_timer('build', files=len(targets)):
+        build_each_fasta_a_run(targets, alpha_out_dir, sif_file, run_script)
+    given_up_targets = submit_jobs(connection, jobs, alpha_out_dir, sif_file, run_script, array, array_throttle, max_array_size, plan, throttle, feature_script)
+    print(f"Resubmitted {len(targets)} failed targets.")
+    return given_up_targets
+    
+
+def submit_sbatch(script_path, cwd, sbatch_args=()):
+    # sbatch is looked up on PATH, so a stub sbatch can stand in for Slurm when testing
+    invocation = ['sbatch', '--parsable', *sbatch_args, script_path]
+    try:
+        with stage_timer('sbatch', script=os.path.basename(script_path)):
+            completed = subprocess.run(invocation, cwd=cwd, check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        raise Exception(f"sbatch failed for '{script_path}': {e.stderr.strip()}")
+    # --parsable prints "jobid" or "jobid;cluster"
+    return completed.stdout.strip().split(';')[0]
+
+
+def launch_batch_jobs(jobs, connection=None):
+    # Submits the run_<name>.sh scripts generated by build_each_fasta_a_run
+    job_ids = {}
+    for job in jobs:
+        run_script = f"run_{job['name']}.sh"
+        job_ids[job['name']] = submit_sbatch(run_script, job['work_dir'])
+        record_job_id(connection, job, job_ids[job['name']])
+    return job_ids
 
-def launch_batch_jobs(fasta_file_dir, alpha_out_dir):
-    for file_name in os.listdir(fasta_file_dir):
+
+def record_job_id(connection, job, job_id):
+    # Recorded right after every sbatch, so a failed submission halfway through never loses track of a job
+    if connection is not None:
+        record_submitted(connection, {target['name']: job_id for target in job['targets']})
+    return None
+
+
+def list_fasta_targets(fasta_file_dir, alpha_out_dir):
+    targets = []
+    for file_name in sorted(os.listdir(fasta_file_dir)):
         if (file_name.endswith('.fasta')) or (file_name.endswith('.fa')):
             fasta_name = os.path.splitext(file_name)[0]
             fasta_name = fasta_name.replace('(','').replace(')','')
-            dir_path = os.path.join(alpha_out_dir, fasta_name)
-            run_script = f'run_{fasta_name}.sh'
-            os.chdir(dir_path)
-            os.system(f'sbatch {run_script}')
-    return None
+            targets.append({
+                'name': fasta_name,
+                'source_fasta': os.path.join(fasta_file_dir, file_name),
+                'fasta_file': f'{fasta_name}.fasta',
+                'out_dir': os.path.join(alpha_out_dir, fasta_name),
+            })
+    return targets
+
+
+def targets_as_jobs(targets):
+    # Without planning every fasta file is a job of its own that keeps the resources of the run script template
+    return [{
+        'name': target['name'],
+        'targets': [target],
+        'fasta_file': target['fasta_file'],
+        'work_dir': target['out_dir'],
+        'out_dir': target['out_dir'],
+        'time': None,
+        'mem': None,
+    } for target in targets]
+
+
+def plan_fasta_jobs(targets, alpha_out_dir, length_tiers, pack_size, pack_max_residues):
+    for target in targets:
+        target['length'] = read_fasta_length(target['source_fasta'])
+    tiers = parse_length_tiers(length_tiers)
+    return plan_jobs(targets, tiers, alpha_out_dir, pack_size, pack_max_residues), tiers
+
+
+def launch_planned_jobs(jobs, sif_file, run_script, connection=None, feature_script=None):
+    job_ids = {}
+    for job in jobs:
+        run_script_path = generate_job_run_script(job, sif_file, run_script)
+        sbatch_args = []
+        if feature_script is not None and job_needs_features(job):
+            feature_script_path = generate_job_run_script(job, sif_file, feature_script, 'features')
+            feature_job_id = submit_sbatch(feature_script_path, job['work_dir'])
+            # The inference job is cancelled instead of pending forever when its feature job fails
+            sbatch_args = [f'--dependency=afterok:{feature_job_id}', '--kill-on-invalid-dep=yes']
+        job_ids[job['name']] = submit_sbatch(run_script_path, job['work_dir'], sbatch_args)
+        record_job_id(connection, job, job_ids[job['name']])
+    return job_ids
+
+
+def job_needs_features(job):
+    # Targets whose features.pkl already exists go straight to inference
+    return any(find_result_dir(os.path.dirname(target['out_dir']), target['name'], 'features.pkl') is None for target in job['targets'])
 
+
+def write_array_manifest(jobs, manifest_path):
+    # One line per array task: task index, FASTA_FILE value, working directory and AlphaFold2 output directory
+    with open(manifest_path, 'w') as f:
+        for task_index, job in enumerate(jobs):
+            f.write(f"{task_index}\t{job['fasta_file']}\t{job['work_dir']}\t{job['out_dir']}\n")
+    return manifest_path
+
+
+def generate_array_run_script(alpha_out_dir, manifest_path, sif_file, run_script, job_name='alphafold_array', walltime=None, mem=None):
+    with open(run_script, 'r') as f:
+        run_script_content = f.read()
+    run_script_content = fill_run_script(run_script_content, '"$ARRAY_FASTA_FILE"', '"$ARRAY_OUT_DIR"', sif_file, job_name)
+    run_script_content = apply_job_resources(run_script_content, walltime, mem)
+    
+    # Every array task looks up its fasta file and directories in the manifest before the run script body starts.
+    # ARRAY_OFFSET is set when a batch is split into several arrays.
+    lookup_block = [
+        '',
+        '# Look up the fasta file and output directory of this array task',
+        f'ARRAY_MANIFEST={manifest_path}',
+        'ARRAY_INDEX=$((SLURM_ARRAY_TASK_ID + ${ARRAY_OFFSET:-0}))',
+        "ARRAY_LINE=$(awk -F '\\t' -v task=\"$ARRAY_INDEX\" '$1 == task' \"$ARRAY_MANIFEST\")",
+        'ARRAY_FASTA_FILE=$(echo "$ARRAY_LINE" | cut -f 2)',
+        'ARRAY_WORK_DIR=$(echo "$ARRAY_LINE" | cut -f 3)',
+        'ARRAY_OUT_DIR=$(echo "$ARRAY_LINE" | cut -f 4)',
+        'cd "$ARRAY_WORK_DIR" || exit 1',
+    ]
+    lines = run_script_content.split('\n')
+    sbatch_lines = [i for i, line in enumerate(lines) if line.startswith('#SBATCH')]
+    insert_at = sbatch_lines[-1] + 1 if sbatch_lines else 1
+    lines[insert_at:insert_at] = lookup_block
     
-def build_each_fasta_a_run(fasta_file_dir: str, alpha_out_dir: str, current_directory: str, force_overwrite: bool, sif_file, run_script):
-    # Check if directories for each fasta file already exist
-    check_existing_dirs(fasta_file_dir, alpha_out_dir, force_overwrite)
+    array_script_path = os.path.join(alpha_out_dir, f'run_{job_name}.sh')
+    with open(array_script_path, 'w') as f:
+        f.write('\n'.join(lines))
+    return array_script_path
+
+
+def launch_array_jobs(jobs, alpha_out_dir, sif_file, run_script, array_throttle=None, max_array_size=1000, connection=None, feature_script=None):
+    # Array tasks share their resources, so jobs with different time or memory go into separate arrays
+    resource_groups = {}
+    for job in jobs:
+        resource_groups.setdefault((job['time'], job['mem']), []).append(job)
+    
+    job_ids = []
+    for group_index, ((walltime, mem), group_jobs) in enumerate(resource_groups.items()):
+        suffix = f'_{group_index}' if len(resource_groups) > 1 else ''
+        if feature_script is None:
+            job_ids += submit_job_array(group_jobs, alpha_out_dir, suffix, sif_file, run_script, walltime, mem, array_throttle, max_array_size, connection)
+            continue
+        
+        # Task i of an inference array waits for task i of its feature array, jobs that already have their
+        # features go into an inference array of their own
+        need_features = [job for job in group_jobs if job_needs_features(job)]
+        have_features = [job for job in group_jobs if not job_needs_features(job)]
+        if need_features:
+            feature_job_ids = submit_job_array(need_features, alpha_out_dir, f'{suffix}_features', sif_file, feature_script, None, None, array_throttle, max_array_size)
+            job_ids += submit_job_array(need_features, alpha_out_dir, f'{suffix}_inference', sif_file, run_script, walltime, mem, array_throttle, max_array_size, connection,
+                                        dependencies=[f'aftercorr:{feature_job_id}' for feature_job_id in feature_job_ids])
+        if have_features:
+            job_ids += submit_job_array(have_features, alpha_out_dir, f'{suffix}_inference_precomputed', sif_file, run_script, walltime, mem, array_throttle, max_array_size, connection)
+    return job_ids
+
+
+def submit_job_array(jobs, alpha_out_dir, suffix, sif_file, run_script, walltime, mem, array_throttle, max_array_size, connection=None, dependencies=None):
+    manifest_path = write_array_manifest(jobs, os.path.join(alpha_out_dir, f'array_manifest{suffix}.tsv'))
+    array_script_path = generate_array_run_script(alpha_out_dir, manifest_path, sif_file, run_script, f'alphafold_array{suffix}', walltime, mem)
     
+    job_ids = []
+    for chunk_index, offset in enumerate(range(0, len(jobs), max_array_size)):
+        n_tasks = min(max_array_size, len(jobs) - offset)
+        array_range = f'0-{n_tasks - 1}' + (f'%{array_throttle}' if array_throttle else '')
+        sbatch_args = [f'--array={array_range}', f'--export=ALL,ARRAY_OFFSET={offset}']
+        if dependencies is not None:
+            sbatch_args += [f'--dependency={dependencies[chunk_index]}', '--kill-on-invalid-dep=yes']
+        job_ids.append(submit_sbatch(array_script_path, alpha_out_dir, sbatch_args))
+        for task_id, job in enumerate(jobs[offset:offset + n_tasks]):
+            record_job_id(connection, job, f'{job_ids[-1]}_{task_id}')
+        print(f"Submitted array job {job_ids[-1]} for tasks {offset} to {offset + n_tasks - 1} of {os.path.basename(manifest_path)}.")
+    return job_ids
+
+
+def build_each_fasta_a_run(targets, alpha_out_dir: str, sif_file, run_script):
     # Make directories for each fasta file in alpha_out_dir
-    make_directories(fasta_file_dir, alpha_out_dir)
+    make_directories(targets)
     
     # Copy fasta files to the respective directories
-    copy_fasta_files(fasta_file_dir, alpha_out_dir)
+    copy_fasta_files(targets)
     
     # Generate slurm batch run scripts for each fasta file
-    generate_run_scripts(fasta_file_dir, alpha_out_dir, current_directory, sif_file, run_script)
+    generate_run_scripts(targets, sif_file, run_script)
 
 
-def make_directories(fasta_file_dir, alpha_out_dir):
-    
-    for file_name in os.listdir(fasta_file_dir):
-        if (file_name.endswith('.fasta')) or (file_name.endswith('.fa')):
-            fasta_name = os.path.splitext(file_name)[0]
-            fasta_name = fasta_name.replace('(','').replace(')','')
-            dir_path = os.path.join(alpha_out_dir, fasta_name)
-            os.makedirs(dir_path, exist_ok=True)
+def make_directories(targets):
+    for target in targets:
+        os.makedirs(target['out_dir'], exist_ok=True)
     return None
     
-def copy_fasta_files(fasta_file_dir, alpha_out_dir):
-    for file_name in os.listdir(fasta_file_dir):
-        if (file_name.endswith('.fasta')) or (file_name.endswith('.fa')):
-            
-            fasta_path = os.path.join(fasta_file_dir, file_name)
-            
-            fasta_name = os.path.splitext(file_name)[0]
-            fasta_name = fasta_name.replace('(','').replace(')','')
-            dir_path = os.path.join(alpha_out_dir, fasta_name)
-            
-            save_path = os.path.join(dir_path, f'{fasta_name}.fasta')
-            if not os.path.exists(save_path):
-                shutil.copy(fasta_path, save_path)
+def copy_fasta_files(targets):
+    for target in targets:
+        save_path = os.path.join(target['out_dir'], target['fasta_file'])
+        if not os.path.exists(save_path):
+            shutil.copy(target['source_fasta'], save_path)
     return None
 
 
-def generate_run_scripts(fasta_file_dir, alpha_out_dir, current_directory, sif_file, run_script):
+def generate_run_scripts(targets, sif_file, run_script):
     with open(run_script, 'r') as f:
         run_script_content = f.read()
+    
+    for target in targets:
+        # Modify the run script for each fasta file
+        run_script_content_modified = fill_run_script(run_script_content, target['fasta_file'], target['out_dir'], sif_file, f"alphafold_{target['name']}")
         
-          
+        run_script_path_modified = os.path.join(target['out_dir'], f"run_{target['name']}.sh")
+        with open(run_script_path_modified, 'w') as f:
+            f.write(run_script_content_modified)
+    return None
+
+
+def fill_run_script(run_script_content, fasta_file, out_dir, sif_file, job_name):
     # Modify the email address in the run script
     username = os.getenv('USER') or os.getenv('USERNAME')
-    run_script_content_modified_0 = run_script_content.replace('my_username_VAR', username)
+    run_script_content = run_script_content.replace('my_username_VAR', username)
     
+    run_script_content = run_script_content.replace('my_fasta_file_VAR', fasta_file)
     
-    for file_name in os.listdir(fasta_file_dir):
-        if (file_name.endswith('.fasta')) or (file_name.endswith('.fa')):
-            
-            # Modify the run script for each fasta file
-            
-            fasta_name = os.path.splitext(file_name)[0]
-            fasta_name = fasta_name.replace('(','').replace(')','')
-            run_script_content_modified_1 = run_script_content_modified_0.replace('my_fasta_file_VAR', file_name)
-            
-            # Modify where alphafold results will be saved
-            where_alpha_out_dir = os.path.join(alpha_out_dir, fasta_name)
-            run_script_content_modified_2 = run_script_content_modified_1.replace('my_alphafold_out_dir_VAR', where_alpha_out_dir)
-
-            # Modify the path to the singularity image file
-            run_script_content_modified_3 = run_script_content_modified_2.replace('my_sif_file_VAR', sif_file)
-            
-            # Modify the sbatch job name
-            run_script_content_modified_4 = run_script_content_modified_3.replace('my_job_name_VAR', f'alphafold_{fasta_name}')
-            
-            run_script_path_modified = os.path.join(alpha_out_dir, fasta_name, f'run_{fasta_name}.sh')
-            with open(run_script_path_modified, 'w') as f:
-                f.write(run_script_content_modified_4)
-    return None
+    # Modify where alphafold results will be saved
+    run_script_content = run_script_content.replace('my_alphafold_out_dir_VAR', out_dir)
 
+    # Modify the path to the singularity image file
+    run_script_content = run_script_content.replace('my_sif_file_VAR', sif_file)
+    
+    # Modify the sbatch job name
+    run_script_content = run_script_content.replace('my_job_name_VAR', job_name)
+    return run_script_content
+
+
+def generate_job_run_script(job, sif_file, run_script, stage=None):
+    job_name = f"{stage}_{job['name']}" if stage else job['name']
+    with open(run_script, 'r') as f:
+        run_script_content = f.read()
+    run_script_content = fill_run_script(run_script_content, job['fasta_file'], job['out_dir'], sif_file, f"alphafold_{job_name}")
+    if stage is None:
+        # The planned time and memory are those of the GPU job, feature jobs keep the resources of their template
+        run_script_content = apply_job_resources(run_script_content, job.get('time'), job.get('mem'))
+    
+    run_script_path = os.path.join(job['work_dir'], f"run_{job_name}.sh")
+    with open(run_script_path, 'w') as f:
+        f.write(run_script_content)
+    return run_script_path
 
-def check_existing_dirs(fasta_file_dir, alpha_out_dir, force_overwrite):
-    if force_overwrite is True:
-        return None
-    else:
-        for file_name in os.listdir(fasta_file_dir):
-            if (file_name.endswith('.fasta')) or (file_name.endswith('.fa')):
-                fasta_name = os.path.splitext(file_name)[0]
-                fasta_name.replace('(','').replace(')','')
-                dir_path = os.path.join(alpha_out_dir, fasta_name)
-                
-                if os.path.exists(dir_path):
-                    
-                    # Still decidicing on all the conditions to check for to see if I should bug user
-                    is_dir_empty = len(os.listdir(dir_path)) == 0
-                    has_fasta_dir_name_in_dir = any([fasta_name == file for file in os.listdir(dir_path)])
-                    bug_user_bool = not is_dir_empty and has_fasta_dir_name_in_dir
-                
-                    if bug_user_bool:
-                        user_input = input(f"Directory '{dir_path}' already exists. Do you want to proceed? (y/n/skip_this_fasta): ")
-                        if user_input.lower() == 'n':
-                            raise Exception("Process terminated by user.")
-                        elif user_input.lower() == 'skip_this_fasta':
-                            print(f"Skipping fasta file '{fasta_name}'.")
-                            continue
-                        else:
-                            print(f"Proceeding with fasta file '{fasta_name}'.")
 
 if __name__ == "__main__":
     main()
@@ -2,13 +2,31 @@ from pathlib import Path
 import os
 import shutil
 import pandas as pd
+import numpy as np
 import argparse
 import sys
 import traceback
+import heapq
+import re
+import io
 import subprocess
+import tempfile
+import asyncio
+import time
 from typing import Any
-from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from tqdm import tqdm
+from proteome_index import get_proteome_index, get_database_file, write_atomically
+from result_store import file_sha256, fatcat_version, tm_align_version, result_key, load_result, save_result
+from result_writer import OUTPUT_FORMATS, import_pyarrow, write_query_results
+from structure_descriptors import compute_descriptor, get_proteome_descriptors, prefilter_candidates, read_ca_atoms
+from tm_score_engine import TM_ENGINES, TM_ENGINE_VERSION, load_proteome_targets, score_query
+from metrics import enable_metrics, metrics_enabled, stage_timer, wait_process, print_metrics_summary
+from proteome_staging import stage_proteomes, release_proteomes
+from tool_scheduler import SCHEDULERS, schedule_tool_runs, run_tool_process
+from search_cluster import (DEFAULT_QUERY_CHUNK_SIZE, DEFAULT_RUN_SCRIPT, UNIT_QUERY_COLUMN, get_cluster_dir, plan_search_units, write_cluster_plan, load_cluster_plan, save_unit_result,
+                            load_unit_result, missing_units, print_cluster_plan, submit_cluster_search)
 
 # import xarray as xr
 # Given a query pdb and and a target proteome accension
@@ -22,8 +40,43 @@ def parse_arguments():
     parser.add_argument('-p', '--proteome_dirs', metavar='proteome_dirs', type=str, help='Directory of proteome directories EX: ./proteomes/ (where ./proteomes contains multiple dirs called i.e human, mouse, drome)')
     parser.add_argument('-f', '--fatcat_install_dir', metavar='fatcat_install_dir', type=str, help='Path to the fatcat github directory  EX: ./FATCAT-dist/')
     parser.add_argument('-t', '--tm_align_install_dir', metavar='tm_align_install_dir', type=str, help='Path to the USAlign github directory EX: ./USalign')
-    parser.add_argument('-o', '--output_name', metavar='output_name', type=str, help='Location to save the csv formatted results of the FATCAT and TM-Align search. Default: ./fatcat_tmalign_homology_search.csv')
+    parser.add_argument('-o', '--output_name', metavar='output_name', type=str, help='Location to save the csv formatted results of the FATCAT and TM-Align search (a directory for parquet and arrow). Default: ./fatcat_tmalign_homology_search.csv')
+    parser.add_argument('--output_format', metavar='output_format', type=str, default='csv', choices=OUTPUT_FORMATS, help='Format of the results: csv, or parquet/arrow partitioned by proteome and query (requires pyarrow). Default: csv')
     parser.add_argument('--force_overwrite', action='store_true', help='Force overwrite of existing results if they exist.')
+    parser.add_argument('-w', '--workers', metavar='workers', type=int, default=1, help='Number of FATCAT/TM-Align searches to run at the same time. Default: 1')
+    parser.add_argument('--shards', metavar='shards', type=int, default=1, help='Split every proteome database into this many shards balanced by residue count and search them at the same time. Default: 1')
+    parser.add_argument('--result_store', metavar='result_store', type=str, help='Directory where every finished (query, proteome) search is saved. Rerunning with the same directory only searches the pairs that are missing. EX: ./search_results_store/')
+    parser.add_argument('--stream', action='store_true', help='Parse the FATCAT/TM-Align output while the tools are running instead of writing it to .aln files first.')
+    parser.add_argument('--keep_alignments', action='store_true', help='Together with --stream, also keep the raw FATCAT/TM-Align output as .aln files in the work directory.')
+    parser.add_argument('--cascade_top_k', metavar='cascade_top_k', type=int, help='Cascade mode: screen each proteome with TM-Align first and only run FATCAT on the top K TM-Align hits of every query.')
+    parser.add_argument('--cascade_min_tm', metavar='cascade_min_tm', type=float, help='Cascade mode: also run FATCAT on every TM-Align hit whose TM1 or TM2 score is at least this value.')
+    parser.add_argument('--prefilter_min_length_ratio', metavar='prefilter_min_length_ratio', type=float, help='Skip structures whose length ratio to the query (shorter / longer chain) is below this value, EX: 0.5')
+    parser.add_argument('--prefilter_min_similarity', metavar='prefilter_min_similarity', type=float, help='Skip structures whose CA distance histogram overlaps the query histogram by less than this fraction (0 to 1), EX: 0.6')
+    parser.add_argument('--prefilter_min_rg_ratio', metavar='prefilter_min_rg_ratio', type=float, help='Skip structures whose radius of gyration ratio to the query (smaller / larger) is below this value, EX: 0.6')
+    parser.add_argument('--prefilter_max_ss_distance', metavar='prefilter_max_ss_distance', type=float, help='Skip structures whose helix/strand/coil composition differs from the query by more than this fraction of residues (0 to 1), EX: 0.4')
+    parser.add_argument('--tm_align_batch_size', metavar='tm_align_batch_size', type=int, help='Align this many queries against a proteome in one TM-Align (USalign -dir1) run, so every proteome structure is read once per batch instead of once per query. EX: 50')
+    parser.add_argument('--tm_engine', metavar='tm_engine', type=str, default='usalign', choices=TM_ENGINES, help='How the TM-Align scores are computed: usalign (a USalign run per search) or numpy (in process from cached CA coordinates, gapless threadings refined with the TM-score search, an estimate of the USalign scores). Default: usalign')
+    parser.add_argument('--validate_tm_engine', metavar='validate_tm_engine', type=int, help='Score this many random (query, structure) pairs with USalign and with the numpy TM engine, print how far apart they are and save the pairs to the output csv instead of searching. EX: 500')
+    parser.add_argument('--top_k', metavar='top_k', type=int, help='Only keep the K best hits of every query over all proteomes, ranked by the higher of TM1 and TM2. EX: 500')
+    parser.add_argument('--min_tm', metavar='min_tm', type=float, help='Only keep hits whose TM1 or TM2 score is at least this value. EX: 0.5')
+    parser.add_argument('--max_pval', metavar='max_pval', type=float, help='Only keep hits whose FATCAT P-value is at most this value. EX: 0.05')
+    parser.add_argument('--hit_alignments', metavar='hit_alignments', type=str, help='Together with --top_k, --min_tm or --max_pval, write the FATCAT alignments of the kept hits of every query to <hit_alignments>/<query>.aln')
+    parser.add_argument('--stage_dir', metavar='stage_dir', type=str, help='Copy every proteome into this node local directory before it is searched, from a packed archive that is read in one go, EX: /dev/shm or $TMPDIR. The copies are removed when the last search using them ends.')
+    parser.add_argument('--scheduler', metavar='scheduler', type=str, default='pool', choices=SCHEDULERS, help='How the FATCAT/TM-Align runs are scheduled: pool (a process pool of --workers) or asyncio (the tools run as subprocesses of the search with per tool limits, largest proteome first). Default: pool')
+    parser.add_argument('--fatcat_workers', metavar='fatcat_workers', type=int, help='With --scheduler asyncio, maximum number of FATCAT runs at the same time. Default: --workers')
+    parser.add_argument('--tm_align_workers', metavar='tm_align_workers', type=int, help='With --scheduler asyncio, maximum number of TM-Align runs at the same time. Default: --workers')
+    parser.add_argument('--pin_cpus', action='store_true', help='With --scheduler asyncio, pin every FATCAT/TM-Align run to a core of its own (Linux only).')
+    parser.add_argument('--metrics', metavar='metrics', type=str, help='Write per stage timings and the wall time, CPU time, max RSS and bytes read of every FATCAT/TM-Align run to this JSON lines file, and print a summary at the end. EX: ./search_metrics.jsonl')
+    parser.add_argument('--work_dir', metavar='work_dir', type=str, help='Directory where every search gets its own working directory and keeps its result files. Default: a temporary directory removed after the search')
+    parser.add_argument('--cluster', action='store_true', help='Cluster mode: plan the screen as (query chunk, proteome shard) work units in --work_dir, which has to be on a shared filesystem, and submit them as a Slurm job array followed by a reduce job that writes the results.')
+    parser.add_argument('--query_chunk_size', metavar='query_chunk_size', type=int, default=DEFAULT_QUERY_CHUNK_SIZE, help=f'Cluster mode: number of queries in every work unit. Default: {DEFAULT_QUERY_CHUNK_SIZE}')
+    parser.add_argument('--cluster_script', metavar='cluster_script', type=str, help='Cluster mode: run script template whose #SBATCH lines set the resources of the work units. Default: run_search.sh next to this script')
+    parser.add_argument('--array_throttle', metavar='array_throttle', type=int, help='Cluster mode: maximum number of work units running at the same time.')
+    parser.add_argument('--max_array_size', metavar='max_array_size', type=int, default=1000, help="Cluster mode: split the work units into job arrays of at most this many tasks (the cluster's MaxArraySize). Default: 1000")
+    parser.add_argument('--dry_run', action='store_true', help='Cluster mode: write the plan and the run scripts and print the work units without submitting anything.')
+    parser.add_argument('--run_unit', metavar='run_unit', type=str, help='Run work units of a cluster plan file, EX: ./work/cluster/cluster_plan.json. Runs the unit given by --unit_index, or every unit without a result one after the other.')
+    parser.add_argument('--unit_index', metavar='unit_index', type=int, help='Together with --run_unit, index of the work unit to run.')
+    parser.add_argument('--reduce', metavar='reduce', type=str, help='Merge the results of every work unit of a cluster plan file into its output, EX: ./work/cluster/cluster_plan.json')
     args = parser.parse_args()
     return args, parser
 
@@ -31,19 +84,44 @@ def parse_arguments():
 def main():
     # Parse command line arguments
     args, parser = parse_arguments()
+    if args.run_unit or args.reduce:
+        # Work units and the reduce step of cluster mode take everything they need from the plan file
+        return run_cluster_step(args, parser)
     query_file_dir, proteome_dirs, fatcat_install_dir, tm_align_install_dir, output_name = ensure_correct_script_input(args, parser)
+    search_settings = ensure_correct_search_settings(args, parser)
+    metrics_file = enable_metrics(args.metrics) if args.metrics else None
 
     try:
-        combined_df = search_multiple_queries(query_file_dir, proteome_dirs, fatcat_install_dir, tm_align_install_dir)
-        combined_df.to_csv(output_name, index=False)
+        query_pdbs = list_query_pdbs(query_file_dir)
+        if args.validate_tm_engine is not None:
+            validate_tm_engine(query_pdbs, proteome_dirs, tm_align_install_dir, args.validate_tm_engine, output_name)
+            print(f"TM engine validation complete. Scores of both engines saved to {output_name}.")
+            return None
+        if args.cluster:
+            plan_file, plan = plan_cluster_search(query_pdbs, proteome_dirs, fatcat_install_dir, tm_align_install_dir, output_name, args.output_format,
+                                                  args.query_chunk_size, search_settings)
+            print_cluster_plan(plan)
+            submit_cluster_search(plan_file.parent, plan_file, plan['units'], args.cluster_script or DEFAULT_RUN_SCRIPT, args.array_throttle, args.max_array_size,
+                                  args.dry_run)
+            print(f"Cluster plan written to {plan_file}. The reduce job saves the results to {output_name}.")
+            return None
+        
+        # Every query is written as soon as it is finished so the whole screen never has to fit in memory
+        results = iter_query_results(query_pdbs, proteome_dirs, fatcat_install_dir, tm_align_install_dir, **search_settings)
+        for query_pdb, result_df in tqdm(results, total=len(query_pdbs), desc='Progress searching all queries...'):
+            with stage_timer('write', query=query_pdb.name, rows=len(result_df)):
+                write_query_results(output_name, args.output_format, query_pdb.name, result_df)
     except:
         print(f"{traceback.format_exc()}")
         parser.print_help()
         sys.exit(1)
+    finally:
+        if metrics_file is not None:
+            print_metrics_summary(metrics_file)
         
     print(f"FATCAT and TM-Align search complete. Results saved to {output_name}.")
 
-    return  combined_df
+    return None
 
 
 def ensure_correct_script_input(args, parser):
@@ -120,14 +198,26 @@ def ensure_correct_script_input(args, parser):
             print("\nPlease provide the path to the USAlign github directory using --tm_align_install_dir or -t.")
             sys.exit(1)
             
-    if args.output_name:
-        if args.output_name.endswith('.csv'):
-            output_name = args.output_name
+    if args.output_format != 'csv':
+        try:
+            import_pyarrow()
+        except ImportError as e:
+            parser.print_help()
+            print(f"\n{e}")
+            sys.exit(1)
+    
+    if args.output_format == 'csv':
+        if args.output_name:
+            if args.output_name.endswith('.csv'):
+                output_name = args.output_name
+            else:
+                removed_extension, _ = os.path.splitext(args.output_name)
+                output_name = f'{removed_extension}.csv'
         else:
-            removed_extension, _ = os.path.splitext(args.output_name)
-            output_name = f'{removed_extension}.csv'
+            output_name = 'fatcat_tmalign_homology_search.csv'
     else:
-        output_name = 'fatcat_tmalign_homology_search.csv'
+        # Parquet and arrow results are written to a partitioned directory
+        output_name = os.path.splitext(args.output_name)[0] if args.output_name else 'fatcat_tmalign_homology_search'
     
     force_overwrite = args.force_overwrite if args.force_overwrite else False
     handle_overwrite(force_overwrite, output_name)
@@ -135,226 +225,1115 @@ def ensure_correct_script_input(args, parser):
     return query_file_dir, proteome_dirs, fatcat_install_dir, tm_align_install_dir, output_name
 
 
+def ensure_correct_search_settings(args, parser):
+    if args.workers < 1:
+        parser.print_help()
+        print("\nThe number of workers must be at least 1.")
+        sys.exit(1)
+    
+    if args.shards < 1:
+        parser.print_help()
+        print("\nThe number of proteome shards must be at least 1.")
+        sys.exit(1)
+    
+    work_dir = Path(args.work_dir).resolve() if args.work_dir else None
+    result_store = Path(args.result_store).resolve() if args.result_store else None
+    
+    if args.cascade_top_k is not None and args.cascade_top_k < 1:
+        parser.print_help()
+        print("\nThe number of cascade hits per query must be at least 1.")
+        sys.exit(1)
+    
+    if args.tm_align_batch_size is not None and args.tm_align_batch_size < 1:
+        parser.print_help()
+        print("\nThe TM-Align batch size must be at least 1.")
+        sys.exit(1)
+    
+    prefilter_args = (args.prefilter_min_length_ratio, args.prefilter_min_similarity, args.prefilter_min_rg_ratio, args.prefilter_max_ss_distance)
+    if args.tm_align_batch_size is not None and any(value is not None for value in prefilter_args):
+        parser.print_help()
+        print("\n--tm_align_batch_size cannot be combined with the prefilter, every prefiltered query searches its own candidate list.")
+        sys.exit(1)
+    
+    if args.validate_tm_engine is not None and args.validate_tm_engine < 1:
+        parser.print_help()
+        print("\nThe number of pairs to validate the TM engine on must be at least 1.")
+        sys.exit(1)
+    
+    if args.validate_tm_engine is not None and args.output_format != 'csv':
+        parser.print_help()
+        print("\n--validate_tm_engine saves the scores of both engines as csv, use --output_format csv.")
+        sys.exit(1)
+    
+    if args.top_k is not None and args.top_k < 1:
+        parser.print_help()
+        print("\nThe number of hits kept per query must be at least 1.")
+        sys.exit(1)
+    
+    if args.hit_alignments and args.top_k is None and args.min_tm is None and args.max_pval is None:
+        parser.print_help()
+        print("\n--hit_alignments needs --top_k, --min_tm or --max_pval to select the hits.")
+        sys.exit(1)
+    
+    if args.hit_alignments and args.cluster:
+        parser.print_help()
+        print("\n--hit_alignments cannot be combined with --cluster, the work units only see the hits of their own shard.")
+        sys.exit(1)
+    
+    for tool_workers in (args.fatcat_workers, args.tm_align_workers):
+        if tool_workers is not None and tool_workers < 1:
+            parser.print_help()
+            print("\nThe number of FATCAT and TM-Align workers must be at least 1.")
+            sys.exit(1)
+    
+    if args.scheduler != 'asyncio' and (args.fatcat_workers is not None or args.tm_align_workers is not None or args.pin_cpus):
+        parser.print_help()
+        print("\n--fatcat_workers, --tm_align_workers and --pin_cpus need --scheduler asyncio.")
+        sys.exit(1)
+    
+    if args.pin_cpus and not hasattr(os, 'sched_setaffinity'):
+        parser.print_help()
+        print("\nCPU pinning needs os.sched_setaffinity, which is only available on Linux.")
+        sys.exit(1)
+    
+    if args.cluster:
+        if work_dir is None:
+            parser.print_help()
+            print("\nCluster mode needs a --work_dir on a filesystem shared by all nodes, the plan and the unit results are kept there.")
+            sys.exit(1)
+        if args.query_chunk_size < 1 or args.max_array_size < 1:
+            parser.print_help()
+            print("\nThe query chunk size and the maximum array size must be at least 1.")
+            sys.exit(1)
+        if args.cascade_top_k is not None and args.shards > 1:
+            parser.print_help()
+            print("\n--cascade_top_k cannot be combined with --shards in cluster mode, every shard is searched by its own unit and would keep its own top K.")
+            sys.exit(1)
+        if args.cluster_script and not os.path.exists(args.cluster_script):
+            parser.print_help()
+            print("\nThe provided cluster_script does not exist, please ensure correct input.")
+            sys.exit(1)
+    
+    if args.keep_alignments and not args.stream:
+        print('--keep_alignments only has an effect together with --stream, the .aln files are always written without it.')
+    
+    return {
+        'workers': args.workers,
+        'work_dir': work_dir,
+        'shards': args.shards,
+        'result_store': result_store,
+        'stream_output': args.stream,
+        'keep_alignments': args.keep_alignments,
+        'cascade_top_k': args.cascade_top_k,
+        'cascade_min_tm': args.cascade_min_tm,
+        'prefilter_min_length_ratio': args.prefilter_min_length_ratio,
+        'prefilter_min_similarity': args.prefilter_min_similarity,
+        'prefilter_min_rg_ratio': args.prefilter_min_rg_ratio,
+        'prefilter_max_ss_distance': args.prefilter_max_ss_distance,
+        'tm_align_batch_size': args.tm_align_batch_size,
+        'scheduler': args.scheduler,
+        'tool_workers': {'fatcat': args.fatcat_workers, 'tm_align': args.tm_align_workers},
+        'pin_cpus': args.pin_cpus,
+        'stage_dir': Path(args.stage_dir).resolve() if args.stage_dir else None,
+        'tm_engine': args.tm_engine,
+        'top_k': args.top_k,
+        'min_tm': args.min_tm,
+        'max_pval': args.max_pval,
+        'hit_alignments': Path(args.hit_alignments).resolve() if args.hit_alignments else None,
+    }
+
+
 def handle_overwrite(force_overwrite, output_name):
     if os.path.exists(output_name):
         if force_overwrite:
-            os.remove(output_name)
+            if os.path.isdir(output_name):
+                shutil.rmtree(output_name)
+            else:
+                os.remove(output_name)
         else:
             print(f"The file {output_name} already exists. Please provide a new output name or use the --force_overwrite flag to overwrite the existing file.")
             sys.exit(1)
 
-def run_fatcat_search(query_pdb, proteome_dir, fatcat_install_dir):
-    start_dir = os.getcwd()
-    prot_db_path = make_proteome_database_file(proteome_dir)
+def run_fatcat_search(query_pdb, proteome_dir, fatcat_install_dir, task_dir=None, db_file=None, stream_output=False, keep_alignments=False):
+    task_dir, remove_task_dir = prepare_task_dir(task_dir)
+    prot_db_path = make_proteome_database_file(proteome_dir) if db_file is None else Path(db_file)
+    invocation, result_file = fatcat_invocation(query_pdb, proteome_dir, fatcat_install_dir, task_dir, prot_db_path)
+   
+    if stream_output:
+        raw_output_file = result_file if keep_alignments else None
+        aln_info = parse_fatcat_lines(stream_tool_output(invocation, task_dir, 'FATCAT', raw_output_file))
+    else:
+        run_tool_to_file(invocation, task_dir, 'FATCAT', result_file)
+        aln_info = parse_fatcat_file(result_file)
+    
+    if remove_task_dir:
+        shutil.rmtree(task_dir, ignore_errors=True)
+    return aln_info
 
+
+def run_tm_align_search(query_pdb, proteome_dir, tm_align_install_dir, task_dir=None, db_file=None, stream_output=False, keep_alignments=False):
+    task_dir, remove_task_dir = prepare_task_dir(task_dir)
+    prot_db_path = make_proteome_database_file(proteome_dir) if db_file is None else Path(db_file)
+    invocation, result_file = tm_align_invocation(query_pdb, proteome_dir, tm_align_install_dir, task_dir, prot_db_path)
     
-    fatcat_search_path = fatcat_install_dir / 'FATCATMain' / 'FATCATSearch.pl'
+    if stream_output:
+        raw_output_file = result_file if keep_alignments else None
+        aln_info = parse_tmalign_lines(stream_tool_output(invocation, task_dir, 'TM-Align', raw_output_file))
+    else:
+        run_tool_to_file(invocation, task_dir, 'TM-Align', result_file)
+        aln_info = parse_tmalign_file(result_file)
     
-    os.chdir(proteome_dir)
+    if remove_task_dir:
+        shutil.rmtree(task_dir, ignore_errors=True)
+    return aln_info
+
+
+def run_tm_align_batch_search(query_pdbs, proteome_dir, tm_align_install_dir, task_dir=None, db_file=None, stream_output=False, keep_alignments=False):
+    # One USalign run aligns every query of the batch against the proteome, returns the results of each query
+    task_dir, remove_task_dir = prepare_task_dir(task_dir)
+    prot_db_path = make_proteome_database_file(proteome_dir) if db_file is None else Path(db_file)
+    invocation, result_file = tm_align_batch_invocation(query_pdbs, proteome_dir, tm_align_install_dir, task_dir, prot_db_path)
     
-    if os.path.exists(proteome_dir / query_pdb.name):
-        place_query_in_proteome_dir = False
+    if stream_output:
+        raw_output_file = result_file if keep_alignments else None
+        aln_info = parse_tmalign_lines(stream_tool_output(invocation, task_dir, 'TM-Align', raw_output_file))
     else:
-        place_query_in_proteome_dir = True
-        shutil.copyfile(query_pdb, proteome_dir / query_pdb.name)
+        run_tool_to_file(invocation, task_dir, 'TM-Align', result_file)
+        aln_info = parse_tmalign_file(result_file)
+    
+    if remove_task_dir:
+        shutil.rmtree(task_dir, ignore_errors=True)
+    return split_tmalign_results(aln_info, query_pdbs)
+
+
+def run_tm_engine_search(query_pdbs, proteome_dir, db_file, proteome_index):
+    # In process TM-score engine in place of a USalign run, returns the results of each query with the columns of
+    # parse_tmalign_file. The CA coordinates of the proteome are read from its cache, so no PDB file is opened and
+    # the proteome index built when the search was planned is used instead of scanning the proteome again
+    with open(db_file, 'r') as f:
+        db_names = [line.strip() for line in f if line.strip()]
+    targets = load_proteome_targets(proteome_dir, proteome_index, db_names)
+    query_results = {}
+    for query_pdb in query_pdbs:
+        with stage_timer('tm_engine', query=query_pdb.name, proteome=proteome_dir.name, files=len(targets)):
+            query_coordinates, query_residues = read_ca_atoms(query_pdb)
+            rows = score_query(query_coordinates, query_residues, targets)
+        aln_info = pd.DataFrame([(query_pdb.name, target_file, *row) for (target_file, _, _), row in zip(targets, rows) if row is not None], columns=TMALIGN_COLUMNS)
+        query_results[query_pdb.name] = aln_info.astype(TMALIGN_DTYPES)
+    return query_results
+
+
+def validate_tm_engine(query_pdbs, proteome_dirs, tm_align_install_dir, sample_size, output_name, seed=0):
+    # Scores a random sample of (query, structure) pairs with USalign and with the numpy engine, prints how far
+    # apart the scores are and how long each engine took, and saves the scores of both side by side
+    indexes = {proteome_dir.name: get_proteome_index(proteome_dir) for proteome_dir in proteome_dirs}
+    all_pairs = [(query_pdb, proteome_dir, entry['name']) for query_pdb in query_pdbs for proteome_dir in proteome_dirs for entry in indexes[proteome_dir.name]['entries']]
+    rng = np.random.default_rng(seed)
+    sample = sorted(rng.choice(len(all_pairs), size=min(sample_size, len(all_pairs)), replace=False))
+    pair_entries = {}
+    for position in sample:
+        query_pdb, proteome_dir, name = all_pairs[position]
+        pair_entries.setdefault((query_pdb, proteome_dir), []).append(name)
+    
+    comparisons = []
+    seconds = {'usalign': 0.0, 'numpy': 0.0}
+    with tempfile.TemporaryDirectory(prefix='fatcat_tmalign_validate_') as validate_dir:
+        for pair, ((query_pdb, proteome_dir), names) in enumerate(pair_entries.items()):
+            db_file = Path(validate_dir) / f'sample_{pair}.txt'
+            with open(db_file, 'w') as f:
+                f.writelines(f'{name}\n' for name in names)
+            started = time.perf_counter()
+            usalign_df = run_tm_align_search(query_pdb, proteome_dir, tm_align_install_dir, db_file=db_file)
+            seconds['usalign'] += time.perf_counter() - started
+            started = time.perf_counter()
+            numpy_df = run_tm_engine_search([query_pdb], proteome_dir, db_file, indexes[proteome_dir.name])[query_pdb.name]
+            seconds['numpy'] += time.perf_counter() - started
+            comparison = usalign_df.merge(numpy_df, on=['query', 'prot_pdb'], suffixes=('_usalign', '_numpy'))
+            comparisons.append(comparison.assign(proteome=proteome_dir.name))
+    if not comparisons:
+        raise Exception("The proteomes hold no structures to validate the TM engine on.")
+    comparison_df = pd.concat(comparisons, ignore_index=True)
+    
+    print(f"{len(comparison_df)} pairs scored by both engines, USalign {seconds['usalign']:.1f}s, numpy {seconds['numpy']:.1f}s.")
+    for column in ('TM1', 'TM2', 'RMSD', 'IDali', 'Lali'):
+        differences = (comparison_df[f'{column}_numpy'] - comparison_df[f'{column}_usalign']).abs()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # Columns that are constant in the sample (e.g. IDali of identical sequences) have no correlation
+            correlation = comparison_df[f'{column}_numpy'].corr(comparison_df[f'{column}_usalign'])
+        print(f"{column}: mean abs difference {differences.mean():.4f}, max abs difference {differences.max():.4f}, correlation {correlation:.4f}")
+    comparison_df.to_csv(output_name, index=False)
+    return comparison_df
+
+
+def fatcat_invocation(query_pdb, proteome_dir, fatcat_install_dir, task_dir, prot_db_path):
+    fatcat_search_path = fatcat_install_dir / 'FATCATMain' / 'FATCATSearch.pl'
+    
+    # The query is copied into the task directory so nothing is written into the shared proteome directory
+    shutil.copyfile(query_pdb, task_dir / query_pdb.name)
     
     invocation = [
         str(fatcat_search_path),
         str(query_pdb.name),
-        str(prot_db_path.name),
+        str(prot_db_path),
+        '-i1', f'{task_dir}/',
+        '-i2', f'{proteome_dir}/',
         '-q'
     ]
-    result_file = proteome_dir / f'fatcat_search_results_{query_pdb.name.split(".")[0]}.aln'
-   
-    try:
-        with open(result_file, 'w') as output_file:
-            subprocess.run(invocation, check=True, stdout=output_file, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        print(f"An error occurred while running FATCAT search: {e.stderr.decode()}")
-        raise
-    
-    if place_query_in_proteome_dir:
-        os.remove(proteome_dir / query_pdb.name)
-    
-    aln_info = parse_fatcat_file(result_file)
-    
-    
-    os.chdir(start_dir)
-    return aln_info
+    return invocation, task_dir / f'fatcat_search_results_{query_pdb.stem}.aln'
 
 
-def run_tm_align_search(query_pdb, proteome_dir, tm_align_install_dir):
-    start_dir = os.getcwd()
-    prot_db_path = make_proteome_database_file(proteome_dir)
-    
+def tm_align_invocation(query_pdb, proteome_dir, tm_align_install_dir, task_dir, prot_db_path):
     tm_align_path = tm_align_install_dir / 'USalign'
     
-    os.chdir(proteome_dir)
-    if os.path.exists(proteome_dir / query_pdb.name):
-        place_query_in_proteome_dir = False
-    else:
-        place_query_in_proteome_dir = True
-        shutil.copyfile(query_pdb, proteome_dir / query_pdb.name)
+    shutil.copyfile(query_pdb, task_dir / query_pdb.name)
     
     invocation = [
         str(tm_align_path),
         str(query_pdb.name),
-        '-dir2', './', f'./{prot_db_path.name}',
+        '-dir2', f'{proteome_dir}/', str(prot_db_path),
         '-suffix', '.pdb',
         '-outfmt', '2',
         '-ter', '1',
         '-fast'
     ]    
-    result_file = proteome_dir / f'tm_align_search_results_{query_pdb.name.split(".")[0]}.aln'
-    
-    try:
-        with open(result_file, 'w') as output_file:
-            subprocess.run(invocation, check=True, stdout=output_file, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        print(f"An error occurred while running TM-Align search: {e.stderr.decode()}")
-        raise
-    
-    if place_query_in_proteome_dir:
-        os.remove(proteome_dir / query_pdb.name)
+    return invocation, task_dir / f'tm_align_search_results_{query_pdb.stem}.aln'
+
+
+def tm_align_batch_invocation(query_pdbs, proteome_dir, tm_align_install_dir, task_dir, prot_db_path):
+    tm_align_path = tm_align_install_dir / 'USalign'
     
-    aln_info = parse_tmalign_file(result_file)
+    query_dir = task_dir / 'queries'
+    query_dir.mkdir(exist_ok=True)
+    for query_pdb in query_pdbs:
+        shutil.copyfile(query_pdb, query_dir / query_pdb.name)
+    query_list_path = task_dir / 'query_list.txt'
+    with open(query_list_path, 'w') as f:
+        f.writelines(f'{query_pdb.stem}\n' for query_pdb in query_pdbs)
     
-    os.chdir(start_dir)
-    return aln_info
+    invocation = [
+        str(tm_align_path),
+        '-dir1', f'{query_dir}/', str(query_list_path),
+        '-dir2', f'{proteome_dir}/', str(prot_db_path),
+        '-suffix', '.pdb',
+        '-outfmt', '2',
+        '-ter', '1',
+        '-fast'
+    ]
+    return invocation, task_dir / 'tm_align_search_results_batch.aln'
+
+
+def split_tmalign_results(aln_info, query_pdbs):
+    # Rows of a batched run name the query like a single query run would, only with the -dir1 path in front
+    aln_info['query'] = aln_info['query'].map(os.path.basename)
+    query_results = {query_pdb_name: query_df.reset_index(drop=True) for query_pdb_name, query_df in aln_info.groupby('query', sort=False)}
+    return {query_pdb.name: query_results.get(query_pdb.name, empty_tmalign_frame()) for query_pdb in query_pdbs}
+
+
+def prepare_task_dir(task_dir):
+    # Every search runs inside its own working directory, so concurrent searches never share files
+    if task_dir is None:
+        return Path(tempfile.mkdtemp(prefix='fatcat_tmalign_task_')), True
+    task_dir = Path(task_dir)
+    task_dir.mkdir(parents=True, exist_ok=True)
+    return task_dir, False
+
+
+def run_tool_to_file(invocation, task_dir, tool_name, result_file):
+    with open(result_file, 'w') as output_file:
+        started = time.perf_counter()
+        process = subprocess.Popen(invocation, stdout=output_file, stderr=subprocess.PIPE, cwd=task_dir)
+        stderr = process.stderr.read()
+        process.stderr.close()
+        return_code = wait_process(process, started, tool=tool_name, task_dir=task_dir) if metrics_enabled() else process.wait()
+    if return_code != 0:
+        print(f"An error occurred while running {tool_name} search: {stderr.decode()}")
+        raise subprocess.CalledProcessError(return_code, invocation, stderr=stderr)
+
+
+def stream_tool_output(invocation, task_dir, tool_name, raw_output_file=None):
+    # Yields the output of the search tool line by line while it is still running, the raw text is only kept on request
+    with open(task_dir / f'{tool_name.lower()}_stderr.log', 'w+') as stderr_file:
+        started = time.perf_counter()
+        process = subprocess.Popen(invocation, stdout=subprocess.PIPE, stderr=stderr_file, cwd=task_dir, text=True)
+        raw_output = open(raw_output_file, 'w') if raw_output_file is not None else None
+        try:
+            for line in process.stdout:
+                if raw_output is not None:
+                    raw_output.write(line)
+                yield line
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            if raw_output is not None:
+                raw_output.close()
+            return_code = wait_process(process, started, tool=tool_name, task_dir=task_dir, streamed=True) if metrics_enabled() else process.wait()
+        
+        if return_code != 0:
+            stderr_file.seek(0)
+            print(f"An error occurred while running {tool_name} search: {stderr_file.read()}")
+            raise subprocess.CalledProcessError(return_code, invocation)
+
+
+TMALIGN_COLUMNS = ['query', 'prot_pdb', 'TM1', 'TM2', 'RMSD', 'ID1', 'ID2', 'IDali', 'L1', 'L2', 'Lali']
+FATCAT_COLUMNS = ['query', 'prot_pdb', 'p_val', 'rmsd', 'identity', 'similarity', 'score', 'afp']
+TMALIGN_DTYPES = {column: 'float64' for column in TMALIGN_COLUMNS[2:]}
+FATCAT_DTYPES = {column: 'float64' for column in FATCAT_COLUMNS[2:]}
+
+
+# Frames for searches without alignments, with the dtypes of parsed results so that concatenating them keeps float64
+def empty_tmalign_frame():
+    return pd.DataFrame(columns=TMALIGN_COLUMNS).astype(TMALIGN_DTYPES)
+
+
+def empty_fatcat_frame():
+    return pd.DataFrame(columns=FATCAT_COLUMNS).astype(FATCAT_DTYPES)
+
+
+# FATCAT -q output has an Align, a Twists and a P-value line per alignment, with fields separated by single spaces.
+# Whole alignment blocks are matched with one compiled pattern per line order; output that does not consist of
+# complete blocks falls back to matching every line type on its own and assigning the lines to their Align line.
+FATCAT_FIELD = r'([^ \n]*)'
+FATCAT_ALIGN_LINE = rf'Align {FATCAT_FIELD} [^ \n]* with {FATCAT_FIELD} [^ \n]*'
+FATCAT_PVALUE_LINE = rf'P-value {FATCAT_FIELD} [^ \n]* {FATCAT_FIELD} [^ \n]* {FATCAT_FIELD}% [^ \n]* {FATCAT_FIELD}%'
+FATCAT_TWISTS_LINE = rf'Twists(?: [^ \n]*){{8}} {FATCAT_FIELD}(?: [^ \n]*){{3}} {FATCAT_FIELD}[^\n]*'
+FATCAT_BLOCK_PATTERNS = [
+    (re.compile(rf'^{FATCAT_ALIGN_LINE}\n{FATCAT_PVALUE_LINE}\n{FATCAT_TWISTS_LINE}', re.MULTILINE),
+     ['query', 'prot_pdb', 'p_val', 'afp', 'identity', 'similarity', 'rmsd', 'score']),
+    (re.compile(rf'^{FATCAT_ALIGN_LINE}\n{FATCAT_TWISTS_LINE}\n{FATCAT_PVALUE_LINE}$', re.MULTILINE),
+     ['query', 'prot_pdb', 'rmsd', 'score', 'p_val', 'afp', 'identity', 'similarity']),
+]
+FATCAT_BLOCK_SPLIT = re.compile(r'^(?=Align )', re.MULTILINE)
+FATCAT_ALIGN_PATTERN = re.compile(r'^Align ([^ \n]*) .* ([^ \n]*) [^ \n]*$', re.MULTILINE)
+FATCAT_PVALUE_PATTERN = re.compile(rf'^{FATCAT_PVALUE_LINE}', re.MULTILINE)
+FATCAT_TWISTS_PATTERN = re.compile(rf'^{FATCAT_TWISTS_LINE}', re.MULTILINE)
 
 
 def parse_tmalign_file(aln_path):
-    aln_info_dict = {'query':[], 'prot_pdb':[], 'TM1':[], 'TM2':[], 'RMSD':[], 'ID1':[], 'ID2':[], 'IDali':[], 'L1':[], 'L2':[], 'Lali':[]}
-    aln_info_dict_keys = list(aln_info_dict.keys())
-    n_pdbs = 0
-    
-    with open(aln_path, 'r') as f:
-        for line in f:
-            if line.startswith('#PDBchain1'):
-                pass
-            else:
-                line_split = line.split('\t')
-                # line_split = line_split[1:]
-                for value, key in zip(line_split, aln_info_dict_keys):
-                    value = value.strip()
-                    if '.pdb' in value:
-                        value = value.split(':')[0]
-                    else:
-                        value = float(value)
-                    aln_info_dict[key].append(value)
-
-    df = pd.DataFrame(aln_info_dict)
-    return df
-            
+    with stage_timer('parse', tool='TM-Align', bytes=os.path.getsize(aln_path)):
+        return parse_tmalign_buffer(aln_path)
+
+
+def parse_tmalign_lines(lines):
+    return parse_tmalign_buffer(io.StringIO(''.join(lines)))
+
+
+def parse_tmalign_buffer(buffer):
+    # USalign -outfmt 2 is a tab separated table, the header line (repeated by batched runs) starts with #
+    try:
+        aln_info = pd.read_csv(buffer, sep='\t', header=None, names=TMALIGN_COLUMNS, usecols=range(len(TMALIGN_COLUMNS)),
+                               comment='#', dtype=TMALIGN_DTYPES, engine='c')
+    except pd.errors.EmptyDataError:
+        return empty_tmalign_frame()
+    if aln_info.empty:
+        return empty_tmalign_frame()
+    
+    # Structures are named <file>:<chain>
+    for column in ('query', 'prot_pdb'):
+        aln_info[column] = aln_info[column].str.replace(':.*', '', regex=True)
+    return aln_info
+
 
 def parse_fatcat_file(aln_path):
+    with stage_timer('parse', tool='FATCAT', bytes=os.path.getsize(aln_path)), open(aln_path, 'r') as f:
+        return parse_fatcat_text(f.read())
+
+
+def parse_fatcat_lines(lines):
+    return parse_fatcat_text(''.join(lines))
+
+
+def parse_fatcat_text(text):
+    n_alignments = text.count('\nTwists ') + text.startswith('Twists ')
+    if n_alignments == 0:
+        return empty_fatcat_frame()
+    for block_pattern, columns in FATCAT_BLOCK_PATTERNS:
+        blocks = block_pattern.findall(text)
+        if len(blocks) == n_alignments:
+            return fatcat_frame(dict(zip(columns, zip(*blocks))))
+    return fatcat_frame(match_fatcat_lines(text))
+
+
+def match_fatcat_lines(text):
+    # Every Twists line is one alignment; it belongs to the last Align line before it and takes the last P-value
+    # line of the same block, blocks without one get NaN
+    aligns = [(match.start(), match.group(1), match.group(2)) for match in FATCAT_ALIGN_PATTERN.finditer(text)]
+    pvalues = [(match.start(), *match.groups()) for match in FATCAT_PVALUE_PATTERN.finditer(text)]
+    twists = [(match.start(), *match.groups()) for match in FATCAT_TWISTS_PATTERN.finditer(text)]
     
-    aln_info_dict = {'query':[], 'prot_pdb':[],'p_val':[], 'rmsd':[], 'identity':[], 'similarity':[], 'score':[], 'afp':[]}
-    
-    n_pdbs = 0
-    with open(aln_path, 'r') as f:
-        for line in f:
-            if line.startswith('Align'):
-                n_pdbs += 1
-                prot_pdb_name = line.split(' ')[-2]
-                query = line.split(' ')[1]
-                aln_info_dict['prot_pdb'].append(prot_pdb_name)
-                aln_info_dict['query'].append(query)
-                
-            if line.startswith('P-value'):
-                split_line = line.split(' ')
-                p_val = float(split_line[1])
-                identity = float(split_line[5][:-1]) / 100
-                similarity = float(split_line[7][:-2]) / 100
-                afp = float(split_line[3])
-                
-                aln_info_dict['p_val'].append(p_val)
-                aln_info_dict['identity'].append(identity)
-                aln_info_dict['similarity'].append(similarity)
-                aln_info_dict['afp'].append(afp)
-                
-            if line.startswith('Twists'):
-                rmsd = float(line.split(' ')[9])
-                score = float(line.split(' ')[13])
-                
-                aln_info_dict['score'].append(score)
-                aln_info_dict['rmsd'].append(rmsd)
-                
-    df = pd.DataFrame(aln_info_dict)
-   
-    return df
+    align_starts = np.array([align[0] for align in aligns], dtype=np.int64)
+    twists_blocks = np.searchsorted(align_starts, [twist[0] for twist in twists], side='right') - 1
+    block_pvalues = np.full((len(aligns) + 1, 4), np.nan)
+    if pvalues:
+        pvalues_blocks = np.searchsorted(align_starts, [pvalue[0] for pvalue in pvalues], side='right') - 1
+        block_pvalues[pvalues_blocks] = np.array([pvalue[1:] for pvalue in pvalues], dtype='float64')
+    pvalues_values = block_pvalues[twists_blocks]
+    # Twists lines before the first Align line get the last row, which has no names
+    names = np.array([align[1:] for align in aligns] + [(np.nan, np.nan)], dtype=object)[twists_blocks]
+    return {
+        'query': names[:, 0],
+        'prot_pdb': names[:, 1],
+        'p_val': pvalues_values[:, 0],
+        'afp': pvalues_values[:, 1],
+        'identity': pvalues_values[:, 2],
+        'similarity': pvalues_values[:, 3],
+        'rmsd': [twist[1] for twist in twists],
+        'score': [twist[2] for twist in twists],
+    }
+
+
+def fatcat_frame(columns):
+    numbers = {column: np.asarray(columns[column], dtype=dtype) for column, dtype in FATCAT_DTYPES.items()}
+    numbers['identity'] = numbers['identity'] / 100
+    numbers['similarity'] = numbers['similarity'] / 100
+    return pd.DataFrame({'query': np.asarray(columns['query'], dtype=object), 'prot_pdb': np.asarray(columns['prot_pdb'], dtype=object), **numbers}, columns=FATCAT_COLUMNS)
 
 
 def make_proteome_database_file(proteome_dir):
-    db_file = Path(proteome_dir / "proteome_database.txt")
-    with open(db_file.as_posix(), 'w') as f:
-        for pdb in proteome_dir.glob("*.pdb"):
-            pdb_name = pdb.as_posix().split('/')[-1].split('.')[0]
-            f.write(f"{pdb_name}\n")
+    # The database list comes from the cached proteome index and is only rewritten when the proteome changes
+    index = get_proteome_index(proteome_dir)
+    return get_database_file(proteome_dir, index)
+
+
+def split_proteome_database(db_entries, residue_counts, n_shards):
+    # Greedily place the largest structures first onto the shard with the fewest residues so far,
+    # which balances shards by the total number of residues each search has to align against
+    n_shards = max(1, min(n_shards, len(db_entries)))
+    shard_loads = [(0, shard) for shard in range(n_shards)]
+    shard_positions = [[] for _ in range(n_shards)]
+    for position in sorted(range(len(db_entries)), key=lambda i: residue_counts[i], reverse=True):
+        load, shard = heapq.heappop(shard_loads)
+        shard_positions[shard].append(position)
+        heapq.heappush(shard_loads, (load + residue_counts[position], shard))
+    
+    # Keep every shard in the original database order so concatenated shard results can be restored to it
+    return [[db_entries[position] for position in sorted(positions)] for positions in shard_positions]
+
+
+def plan_proteome_databases(proteome_dirs, n_shards):
+    # Build (or load) every proteome index once up front so the searches only ever read it
+    proteome_databases = {}
+    for proteome_dir in proteome_dirs:
+        index = get_proteome_index(proteome_dir)
+        db_entries = [entry['name'] for entry in index['entries']]
+        if n_shards > 1:
+            residue_counts = [entry['n_residues'] for entry in index['entries']]
+            shards = split_proteome_database(db_entries, residue_counts, n_shards)
+            db_files = [get_database_file(proteome_dir, index, shard_entries, f'shard{shard}of{len(shards)}') for shard, shard_entries in enumerate(shards)]
+        else:
+            shards = [db_entries]
+            db_files = [get_database_file(proteome_dir, index)]
+        proteome_databases[proteome_dir.name] = {
+            'index': index,
+            'fingerprint': index['fingerprint'],
+            'db_entries': db_entries,
+            'shard_entries': shards,
+            'db_files': db_files,
+        }
+    return proteome_databases
+
+
+def plan_prefiltered_databases(query_pdbs, proteome_dirs, proteome_databases, n_shards, min_length_ratio=None, min_similarity=None, min_rg_ratio=None,
+                               max_ss_distance=None):
+    # Rules out (query, structure) pairs from their precomputed descriptors before any alignment is run,
+    # every pair then searches only its own candidate list (split into shards if requested)
+    query_descriptors = {query_pdb.name: compute_descriptor(query_pdb) for query_pdb in query_pdbs}
+    pair_databases = {}
+    for proteome_dir in proteome_dirs:
+        proteome_database = proteome_databases[proteome_dir.name]
+        descriptors = get_proteome_descriptors(proteome_dir, proteome_database['index'])
+        residue_counts = {entry['name']: entry['n_residues'] for entry in proteome_database['index']['entries']}
+        for query_pdb in query_pdbs:
+            candidates = prefilter_candidates(query_descriptors[query_pdb.name], descriptors, proteome_database['db_entries'], min_length_ratio, min_similarity,
+                                              min_rg_ratio, max_ss_distance)
+            if not candidates:
+                pair_databases[(query_pdb.name, proteome_dir.name)] = []
+            elif n_shards > 1:
+                pair_databases[(query_pdb.name, proteome_dir.name)] = split_proteome_database(candidates, [residue_counts[name] for name in candidates], n_shards)
+            else:
+                pair_databases[(query_pdb.name, proteome_dir.name)] = [candidates]
+    return pair_databases
+
+
+def build_tool_tasks(query_pdb, proteome_dir, proteome_index, tool, install_dir, work_dir, db_shards, tool_options):
+    # Every shard is either the path of a cached proteome database list or a list of structure names
+    tasks = []
+    for shard, db_shard in enumerate(db_shards):
+        task_dir = Path(work_dir) / query_pdb.stem / proteome_dir.name / tool
+        if len(db_shards) > 1:
+            task_dir = task_dir / f'shard_{shard}'
+        tasks.append({
+            'tool': tool,
+            'query_pdb': query_pdb,
+            'proteome_dir': proteome_dir,
+            'proteome_index': proteome_index,
+            'install_dir': install_dir,
+            'task_dir': task_dir,
+            'shard': shard,
+            'db_file': None if isinstance(db_shard, list) else db_shard,
+            'db_entries': db_shard if isinstance(db_shard, list) else None,
+            'tool_options': tool_options,
+        })
+    return tasks
+
+
+def build_tm_align_batch_tasks(query_pdbs, proteome_dir, proteome_index, install_dir, work_dir, db_shards, tool_options, batch):
+    tasks = []
+    for shard, db_shard in enumerate(db_shards):
+        task_dir = Path(work_dir) / 'tm_align_batches' / f'batch_{batch}' / proteome_dir.name
+        if len(db_shards) > 1:
+            task_dir = task_dir / f'shard_{shard}'
+        tasks.append({
+            'tool': 'tm_align_batch',
+            'query_pdbs': query_pdbs,
+            'proteome_dir': proteome_dir,
+            'proteome_index': proteome_index,
+            'install_dir': install_dir,
+            'task_dir': task_dir,
+            'shard': shard,
+            'db_file': db_shard,
+            'db_entries': None,
+            'tool_options': tool_options,
+        })
+    return tasks
+
+
+def run_search_task(task):
+    query_names = [query_pdb.name for query_pdb in task['query_pdbs']] if task['tool'] == 'tm_align_batch' else [task['query_pdb'].name]
+    with stage_timer('search_task', tool=task['tool'], queries=query_names, proteome=task['proteome_dir'].name, shard=task['shard']) as fields:
+        if metrics_enabled():
+            fields['files'] = len(task['db_entries']) if task['db_entries'] is not None else sum(1 for _ in open(task['db_file']))
+        return run_search_task_in_dir(task)
+
+
+def write_task_database(task):
+    if task['db_entries'] is None:
+        return task['db_file']
+    # Searches against a subset of the proteome get their own database list in the task directory
+    task['task_dir'].mkdir(parents=True, exist_ok=True)
+    db_file = task['task_dir'] / 'subset_database.txt'
+    with open(db_file, 'w') as f:
+        f.writelines(f'{pdb_name}\n' for pdb_name in task['db_entries'])
     return db_file
 
 
-def run_fatcat_tmalign_parallel(args):
-    query_pdb, proteome_dirs, fatcat_install_dir, tm_align_install_dir = args
-    fatcat_results = run_fatcat_search(query_pdb, proteome_dirs, fatcat_install_dir)
-    tm_align_results = run_tm_align_search(query_pdb, proteome_dirs, tm_align_install_dir)
-    return (fatcat_results, tm_align_results)
+def run_search_task_in_dir(task):
+    db_file = write_task_database(task)
+    tool_options = {'stream_output': task['tool_options']['stream_output'], 'keep_alignments': task['tool_options']['keep_alignments']}
+    
+    if task['tool'] != 'fatcat' and task['tool_options']['tm_engine'] == 'numpy':
+        query_pdbs = task['query_pdbs'] if task['tool'] == 'tm_align_batch' else [task['query_pdb']]
+        query_results = run_tm_engine_search(query_pdbs, task['proteome_dir'], db_file, task['proteome_index'])
+        aln_info = query_results if task['tool'] == 'tm_align_batch' else query_results[task['query_pdb'].name]
+    elif task['tool'] == 'tm_align_batch':
+        aln_info = run_tm_align_batch_search(task['query_pdbs'], task['proteome_dir'], task['install_dir'], task['task_dir'], db_file, **tool_options)
+    elif task['tool'] == 'fatcat':
+        aln_info = run_fatcat_search(task['query_pdb'], task['proteome_dir'], task['install_dir'], task['task_dir'], db_file, **tool_options)
+    else:
+        aln_info = run_tm_align_search(task['query_pdb'], task['proteome_dir'], task['install_dir'], task['task_dir'], db_file, **tool_options)
+    return task, aln_info
 
 
-def search_multiple_proteomes(query_pdb, proteome_dirs, fatcat_install_dir, tm_align_install_dir):
+async def run_search_task_async(task, cpus=None):
+    # The same search as run_search_task_in_dir with the tool run by the asyncio scheduler, the output is parsed
+    # in a thread so the scheduler keeps starting tools meanwhile
+    if task['tool'] != 'fatcat' and task['tool_options']['tm_engine'] == 'numpy':
+        # There is no tool to run, the numpy engine scores the whole search in a thread
+        return await asyncio.get_running_loop().run_in_executor(None, run_search_task_in_dir, task)
+    try:
+        db_file = write_task_database(task)
+        task['task_dir'].mkdir(parents=True, exist_ok=True)
+        if task['tool'] == 'tm_align_batch':
+            invocation, result_file = tm_align_batch_invocation(task['query_pdbs'], task['proteome_dir'], task['install_dir'], task['task_dir'], db_file)
+        elif task['tool'] == 'fatcat':
+            invocation, result_file = fatcat_invocation(task['query_pdb'], task['proteome_dir'], task['install_dir'], task['task_dir'], db_file)
+        else:
+            invocation, result_file = tm_align_invocation(task['query_pdb'], task['proteome_dir'], task['install_dir'], task['task_dir'], db_file)
+        tool_name = 'FATCAT' if task['tool'] == 'fatcat' else 'TM-Align'
+        
+        stream_output = task['tool_options']['stream_output']
+        raw_output_file = result_file if task['tool_options']['keep_alignments'] else None
+        lines = await run_tool_process(invocation, task['task_dir'], tool_name, result_file, stream_output, raw_output_file, cpus)
+        if task['tool'] == 'fatcat':
+            parse, parse_input = (parse_fatcat_lines, lines) if stream_output else (parse_fatcat_file, result_file)
+        else:
+            parse, parse_input = (parse_tmalign_lines, lines) if stream_output else (parse_tmalign_file, result_file)
+        aln_info = await asyncio.get_running_loop().run_in_executor(None, parse, parse_input)
+    except asyncio.CancelledError:
+        # An interrupted search leaves no partial .aln file or query copy behind
+        shutil.rmtree(task['task_dir'], ignore_errors=True)
+        raise
+    
+    if task['tool'] == 'tm_align_batch':
+        aln_info = split_tmalign_results(aln_info, task['query_pdbs'])
+    return task, aln_info
+
+
+def search_task_size(task, residue_counts, db_file_residues):
+    # Residues to align against, the asyncio scheduler starts the largest searches first
+    if task['db_entries'] is not None:
+        residues = sum(residue_counts[task['proteome_dir'].name][pdb_name] for pdb_name in task['db_entries'])
+    else:
+        residues = db_file_residues[str(task['db_file'])]
+    return residues * (len(task['query_pdbs']) if task['tool'] == 'tm_align_batch' else 1)
+
+
+def execute_search_tasks(tasks, workers, collect):
+    # collect(task, aln_info) returns the follow up tasks and the finished results of every completed task,
+    # which lets later stages (e.g. FATCAT in cascade mode) be scheduled as soon as their input is ready
+    if workers <= 1:
+        queue = deque(tasks)
+        while queue:
+            follow_up_tasks, finished = collect(*run_search_task(queue.popleft()))
+            queue.extend(follow_up_tasks)
+            yield from finished
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_search_task, task) for task in tasks}
+            while futures:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    follow_up_tasks, finished = collect(*future.result())
+                    futures |= {executor.submit(run_search_task, task) for task in follow_up_tasks}
+                    yield from finished
+
+
+def select_cascade_candidates(tm_align_df, top_k=None, min_tm=None):
+    # A structure passes the TM-align prefilter if it is among the top_k best hits of the query in this
+    # proteome or if either of its TM-scores reaches min_tm
+    if tm_align_df.empty:
+        return []
+    best_tm = tm_align_df[['TM1', 'TM2']].max(axis=1)
+    selected = pd.Series(False, index=tm_align_df.index)
+    if top_k is not None:
+        selected |= best_tm.rank(method='first', ascending=False) <= top_k
+    if min_tm is not None:
+        selected |= best_tm >= min_tm
+    candidates = tm_align_df.loc[selected, 'prot_pdb'].map(lambda prot_pdb: prot_pdb.split('.')[0])
+    return list(dict.fromkeys(candidates))
+
+
+def retain_hits(result_df, top_k=None, min_tm=None, max_pval=None):
+    # Keeps the hits that pass the thresholds and of those the top_k with the highest TM-score, in their original
+    # order. Thresholds on a score the frame does not have (FATCAT or TM-Align results on their own) are skipped
+    if result_df.empty:
+        return result_df
+    has_tm = 'TM1' in result_df.columns
+    keep = np.ones(len(result_df), dtype=bool)
+    if has_tm:
+        best_tm = np.fmax(result_df['TM1'].to_numpy(dtype=np.float64), result_df['TM2'].to_numpy(dtype=np.float64))
+        if min_tm is not None:
+            keep &= best_tm >= min_tm
+    if max_pval is not None and 'p_val' in result_df.columns:
+        keep &= result_df['p_val'].to_numpy(dtype=np.float64) <= max_pval
+    positions = np.flatnonzero(keep)
+    if top_k is not None and has_tm and len(positions) > top_k:
+        # A stable sort keeps the earlier of two equal hits, so the top K of the parts contain the top K of the whole
+        positions = np.sort(positions[np.argsort(-best_tm[positions], kind='stable')[:top_k]])
+    if len(positions) == len(result_df):
+        return result_df
+    return result_df.iloc[positions].reset_index(drop=True)
+
+
+def write_hit_alignments(hit_alignments_dir, query_pdb, result_df, alignment_files):
+    # Copies the FATCAT alignment block of every kept hit out of the raw output of the query's searches
+    hits = set(zip(result_df['proteome'], result_df['prot_pdb'])) if not result_df.empty else set()
+    blocks = []
+    for _, _, proteome_name, aln_file in alignment_files:
+        if not aln_file.exists():
+            continue
+        for block in FATCAT_BLOCK_SPLIT.split(aln_file.read_text()):
+            match = FATCAT_ALIGN_PATTERN.match(block)
+            if match is not None and (proteome_name, match.group(2)) in hits:
+                blocks.append(block)
+    Path(hit_alignments_dir).mkdir(parents=True, exist_ok=True)
+    write_atomically(Path(hit_alignments_dir) / f'{query_pdb.stem}.aln', ''.join(blocks))
+    return None
+
+
+def combine_shard_results(shard_results, db_entries):
+    # Concatenate the per shard frames and restore the row order of the unsharded proteome database
+    if len(shard_results) == 1:
+        return shard_results[0]
+    combined_df = pd.concat([shard_results[shard] for shard in sorted(shard_results)], ignore_index=True)
+    db_order = {pdb_name: position for position, pdb_name in enumerate(db_entries)}
+    order = np.array([db_order.get(prot_pdb.split('.')[0], len(db_order)) for prot_pdb in combined_df['prot_pdb']], dtype=np.int64)
+    return combined_df.iloc[np.argsort(order, kind='stable')].reset_index(drop=True)
+
+
+def merge_proteome_results(proteome_dirs, proteomes_fatcat, proteomes_tm_align):
+    # Each tool is concatenated once over all proteomes and the two are joined in a single keyed merge,
+    # the frames of the proteomes are left as they are
+    fatcat_df = concat_proteome_results(proteome_dirs, proteomes_fatcat)
+    tm_align_df = concat_proteome_results(proteome_dirs, proteomes_tm_align)
+    return pd.merge(fatcat_df, tm_align_df, on=['query', 'prot_pdb', 'proteome'], how='inner')
+
+
+def concat_proteome_results(proteome_dirs, proteome_results):
+    dfs = [proteome_results[proteome_dir.name] for proteome_dir in proteome_dirs]
+    combined_df = pd.concat(dfs, ignore_index=True)
+    combined_df['proteome'] = np.repeat([proteome_dir.name for proteome_dir in proteome_dirs], [len(df) for df in dfs])
+    return combined_df
+
+
+def search_multiple_proteomes(query_pdb, proteome_dirs, fatcat_install_dir, tm_align_install_dir, work_dir=None):
     
     proteomes_fatcat = {proteome_dir.name:[] for proteome_dir in proteome_dirs}
     proteomes_tm_align = {proteome_dir.name:[] for proteome_dir in proteome_dirs}
     
-    # args = [(query_pdb, proteome_dir, fatcat_install_dir, tm_align_install_dir) for proteome_dir in proteome_dirs]
-    # with ProcessPoolExecutor() as executor:
-    #     results = list(executor.map(run_fatcat_tmalign_parallel, args))
-        
-    # for proteome_dir, (fatcat_result, tm_align_result) in zip(proteome_dirs, results):
-    #     proteomes_fatcat[proteome_dir.name] = fatcat_result
-    #     proteomes_tm_align[proteome_dir.name] = tm_align_result
+    for proteome_dir in proteome_dirs:
+        fatcat_task_dir = Path(work_dir) / proteome_dir.name / 'fatcat' if work_dir else None
+        tm_align_task_dir = Path(work_dir) / proteome_dir.name / 'tm_align' if work_dir else None
+        proteomes_fatcat[proteome_dir.name] = run_fatcat_search(query_pdb, proteome_dir, fatcat_install_dir, fatcat_task_dir)
+        proteomes_tm_align[proteome_dir.name] = run_tm_align_search(query_pdb, proteome_dir, tm_align_install_dir, tm_align_task_dir)
+    
+    return merge_proteome_results(proteome_dirs, proteomes_fatcat, proteomes_tm_align)
+
+
+def load_stored_results(query_pdbs, proteome_dirs, fatcat_install_dir, tm_align_install_dir, proteome_databases, result_store, search_options=None):
+    # Pairs searched by an earlier run with the same query, proteome and tools are loaded instead of searched again
+    tool_versions = {'fatcat': fatcat_version(fatcat_install_dir), 'tm_align': tm_align_version(tm_align_install_dir)}
+    pair_keys = {}
+    pair_results = {query_pdb.name: {} for query_pdb in query_pdbs}
+    for query_pdb in query_pdbs:
+        query_hash = file_sha256(query_pdb)
+        for proteome_dir in proteome_dirs:
+            key = result_key(query_hash, proteome_databases[proteome_dir.name]['fingerprint'], tool_versions, search_options)
+            pair_keys[(query_pdb.name, proteome_dir.name)] = key
+            result_df = load_result(result_store, query_pdb, proteome_dir.name, key)
+            if result_df is not None:
+                pair_results[query_pdb.name][proteome_dir.name] = result_df
+    return pair_keys, pair_results
+
+
+def iter_query_results(query_pdbs, proteome_dirs, fatcat_install_dir, tm_align_install_dir, workers=1, work_dir=None, shards=1, result_store=None,
+                       stream_output=False, keep_alignments=False, cascade_top_k=None, cascade_min_tm=None, prefilter_min_length_ratio=None, prefilter_min_similarity=None,
+                       prefilter_min_rg_ratio=None, prefilter_max_ss_distance=None, tm_align_batch_size=None, database_shard=None, scheduler='pool', tool_workers=None,
+                       pin_cpus=False, stage_dir=None, tm_engine='usalign', top_k=None, min_tm=None, max_pval=None, hit_alignments=None):
+    # With stage_dir the proteomes are searched from staged copies in local scratch, which keep the proteome names,
+    # so the results are the same. The copies are released when the search ends, also when it is interrupted
+    staged_dirs = stage_proteomes(proteome_dirs, stage_dir) if stage_dir is not None else proteome_dirs
+    try:
+        yield from iter_query_results_in_dirs(query_pdbs, staged_dirs, fatcat_install_dir, tm_align_install_dir, workers, work_dir, shards, result_store,
+                                              stream_output, keep_alignments, cascade_top_k, cascade_min_tm, prefilter_min_length_ratio, prefilter_min_similarity,
+                                              prefilter_min_rg_ratio, prefilter_max_ss_distance, tm_align_batch_size, database_shard, scheduler, tool_workers, pin_cpus,
+                                              tm_engine, top_k, min_tm, max_pval, hit_alignments)
+    finally:
+        if stage_dir is not None:
+            release_proteomes(staged_dirs)
+
+
+def iter_query_results_in_dirs(query_pdbs, proteome_dirs, fatcat_install_dir, tm_align_install_dir, workers=1, work_dir=None, shards=1, result_store=None,
+                               stream_output=False, keep_alignments=False, cascade_top_k=None, cascade_min_tm=None, prefilter_min_length_ratio=None,
+                               prefilter_min_similarity=None, prefilter_min_rg_ratio=None, prefilter_max_ss_distance=None, tm_align_batch_size=None, database_shard=None,
+                               scheduler='pool', tool_workers=None, pin_cpus=False, tm_engine='usalign', top_k=None, min_tm=None, max_pval=None, hit_alignments=None):
+    # Yields (query_pdb, merged results) for each query as soon as all of its proteome searches are finished.
+    # With database_shard only that shard of every proteome is searched, which is what a cluster work unit does
+    remove_work_dir = work_dir is None
+    work_dir = Path(tempfile.mkdtemp(prefix='fatcat_tmalign_work_')) if work_dir is None else Path(work_dir)
+    cascade = cascade_top_k is not None or cascade_min_tm is not None
+    shape_prefilter = {'prefilter_min_rg_ratio': prefilter_min_rg_ratio, 'prefilter_max_ss_distance': prefilter_max_ss_distance}
+    prefilter = prefilter_min_length_ratio is not None or prefilter_min_similarity is not None or any(value is not None for value in shape_prefilter.values())
+    retention = top_k is not None or min_tm is not None or max_pval is not None
     
+    with stage_timer('proteome_databases', proteomes=len(proteome_dirs), shards=shards) as fields:
+        proteome_databases = plan_proteome_databases(proteome_dirs, shards)
+        fields['files'] = sum(len(proteome_database['db_entries']) for proteome_database in proteome_databases.values())
+    if database_shard is not None:
+        for proteome_database in proteome_databases.values():
+            proteome_database['shard_entries'] = proteome_database['shard_entries'][database_shard:database_shard + 1]
+            proteome_database['db_files'] = proteome_database['db_files'][database_shard:database_shard + 1]
+    if result_store is not None:
+        search_options = {} if database_shard is None else {'shards': shards, 'database_shard': database_shard}
+        if cascade:
+            search_options.update({'cascade_top_k': cascade_top_k, 'cascade_min_tm': cascade_min_tm})
+        if prefilter:
+            search_options.update({'prefilter_min_length_ratio': prefilter_min_length_ratio, 'prefilter_min_similarity': prefilter_min_similarity})
+            # Stored pairs of searches without the shape thresholds keep their keys
+            search_options.update({name: value for name, value in shape_prefilter.items() if value is not None})
+        if tm_engine != 'usalign':
+            search_options.update({'tm_engine': tm_engine, 'tm_engine_version': TM_ENGINE_VERSION})
+        if retention:
+            # Stored pairs only hold the hits kept under these settings
+            search_options.update({'top_k': top_k, 'min_tm': min_tm, 'max_pval': max_pval})
+        with stage_timer('result_store_load', pairs=len(query_pdbs) * len(proteome_dirs)):
+            pair_keys, pair_results = load_stored_results(query_pdbs, proteome_dirs, fatcat_install_dir, tm_align_install_dir, proteome_databases, result_store, search_options)
+    else:
+        pair_keys, pair_results = {}, {query_pdb.name: {} for query_pdb in query_pdbs}
     
-    for proteome_dir in proteome_dirs:
-        proteomes_fatcat[proteome_dir.name] = run_fatcat_search(query_pdb, proteome_dir, fatcat_install_dir)
-        proteomes_tm_align[proteome_dir.name] = run_tm_align_search(query_pdb, proteome_dir, tm_align_install_dir)
+    search_pairs = [(query_pdb, proteome_dir) for query_pdb in query_pdbs for proteome_dir in proteome_dirs if proteome_dir.name not in pair_results[query_pdb.name]]
+    if prefilter:
+        with stage_timer('prefilter', queries=len(query_pdbs), proteomes=len(proteome_dirs)):
+            pair_databases = plan_prefiltered_databases([query_pdb for query_pdb in query_pdbs if len(pair_results[query_pdb.name]) < len(proteome_dirs)],
+                                                        proteome_dirs, proteome_databases, shards if database_shard is None else 1,
+                                                        prefilter_min_length_ratio, prefilter_min_similarity, prefilter_min_rg_ratio, prefilter_max_ss_distance)
+        if database_shard is not None:
+            # The candidates of a work unit are the ones in its own shard
+            shard_entries = {name: set(entry for entries in proteome_database['shard_entries'] for entry in entries) for name, proteome_database in proteome_databases.items()}
+            for (query_name, proteome_name), db_shards in pair_databases.items():
+                candidates = [entry for entries in db_shards for entry in entries if entry in shard_entries[proteome_name]]
+                pair_databases[(query_name, proteome_name)] = [candidates] if candidates else []
+    else:
+        pair_databases = {(query_pdb.name, proteome_dir.name): proteome_databases[proteome_dir.name]['db_files'] for query_pdb, proteome_dir in search_pairs}
     
-    dfs1 = []
-    for key, df in proteomes_fatcat.items():
-        df['proteome'] = key
-        dfs1.append(df)
-    combined_df1 = pd.concat(dfs1, ignore_index=True)
+    # The alignments of the kept hits are taken from the raw FATCAT output, which streamed searches then have to keep
+    tool_options = {'stream_output': stream_output, 'keep_alignments': keep_alignments or hit_alignments is not None, 'tm_engine': tm_engine}
+    tasks = []
+    pending = {}
+    alignment_files = {query_pdb.name: [] for query_pdb in query_pdbs}
     
-    dfs2 = []
-    for key, df in proteomes_tm_align.items():
-        df['proteome'] = key
-        dfs2.append(df)
-    combined_df2 = pd.concat(dfs2, ignore_index=True)
+    def query_result(query_pdb):
+        result_df = pd.concat([pair_results[query_pdb.name][proteome_dir.name] for proteome_dir in proteome_dirs], ignore_index=True)
+        if top_k is not None:
+            # Every proteome kept its own top K, the best K of the query are among them
+            result_df = retain_hits(result_df, top_k)
+        if hit_alignments is not None:
+            write_hit_alignments(hit_alignments, query_pdb, result_df, sorted(alignment_files.pop(query_pdb.name, [])))
+        return result_df
+    
+    def finish_pair(query_pdb, proteome_dir, pair):
+        proteome_database = proteome_databases[proteome_dir.name]
+        with stage_timer('merge', query=query_pdb.name, proteome=proteome_dir.name) as fields:
+            fatcat_df = combine_shard_results(pair['fatcat'], proteome_database['db_entries']) if pair['fatcat'] else empty_fatcat_frame()
+            tm_align_df = combine_shard_results(pair['tm_align'], proteome_database['db_entries']) if pair['tm_align'] else empty_tmalign_frame()
+            pair_df = merge_proteome_results([proteome_dir], {proteome_dir.name: fatcat_df}, {proteome_dir.name: tm_align_df})
+            if retention:
+                pair_df = retain_hits(pair_df, top_k, min_tm, max_pval)
+            fields['rows'] = len(pair_df)
+        if result_store is not None:
+            save_result(result_store, query_pdb, proteome_dir.name, pair_keys[(query_pdb.name, proteome_dir.name)], pair_df)
+        
+        pair_results[query_pdb.name][proteome_dir.name] = pair_df
+        if len(pair_results[query_pdb.name]) < len(proteome_dirs):
+            return []
+        return [(query_pdb, query_result(query_pdb))]
+    
+    def collect(task, aln_info):
+        if task['tool'] == 'fatcat' and hit_alignments is not None:
+            alignment_files[task['query_pdb'].name].append((proteome_dirs.index(task['proteome_dir']), task['shard'], task['proteome_dir'].name,
+                                                            task['task_dir'] / f"fatcat_search_results_{task['query_pdb'].stem}.aln"))
+        if task['tool'] != 'tm_align_batch':
+            return collect_pair(task['query_pdb'], task['proteome_dir'], task['tool'], task['shard'], aln_info)
+        follow_up_tasks, finished = [], []
+        for query_pdb in task['query_pdbs']:
+            query_follow_up_tasks, query_finished = collect_pair(query_pdb, task['proteome_dir'], 'tm_align', task['shard'], aln_info[query_pdb.name])
+            follow_up_tasks += query_follow_up_tasks
+            finished += query_finished
+        return follow_up_tasks, finished
+    
+    def collect_pair(query_pdb, proteome_dir, tool, shard, aln_info):
+        pair = pending[(query_pdb.name, proteome_dir.name)]
+        # Hits below the thresholds are dropped as soon as a search returns, the top K is only known per pair
+        pair[tool][shard] = retain_hits(aln_info, None, min_tm, max_pval) if retention else aln_info
+        tm_align_done = len(pair['tm_align']) == pair['n_tm_align']
+        
+        if cascade and tool == 'tm_align' and tm_align_done:
+            # FATCAT only runs on the structures that passed the TM-align prefilter
+            tm_align_df = combine_shard_results(pair['tm_align'], proteome_databases[proteome_dir.name]['db_entries'])
+            candidates = select_cascade_candidates(tm_align_df, cascade_top_k, cascade_min_tm)
+            pair['n_fatcat'] = 1 if candidates else 0
+            if candidates:
+                return build_tool_tasks(query_pdb, proteome_dir, proteome_databases[proteome_dir.name]['index'], 'fatcat', fatcat_install_dir, work_dir, [candidates], tool_options), []
+        
+        if not tm_align_done or pair['n_fatcat'] is None or len(pair['fatcat']) < pair['n_fatcat']:
+            return [], []
+        
+        del pending[(query_pdb.name, proteome_dir.name)]
+        return [], finish_pair(query_pdb, proteome_dir, pair)
     
-    result_df = pd.merge(combined_df1, combined_df2, on=['query', 'prot_pdb', 'proteome'], how='inner')
-    return result_df
+    try:
+        finished = []
+        for query_pdb, proteome_dir in search_pairs:
+            db_shards = pair_databases[(query_pdb.name, proteome_dir.name)]
+            pair = {'fatcat': {}, 'tm_align': {}, 'n_tm_align': len(db_shards), 'n_fatcat': None if cascade else len(db_shards)}
+            if not db_shards:
+                # Nothing in this proteome passed the descriptor prefilter
+                finished += finish_pair(query_pdb, proteome_dir, pair)
+                continue
+            pending[(query_pdb.name, proteome_dir.name)] = pair
+            if tm_align_batch_size is None:
+                tasks += build_tool_tasks(query_pdb, proteome_dir, proteome_databases[proteome_dir.name]['index'], 'tm_align', tm_align_install_dir, work_dir, db_shards, tool_options)
+            if not cascade:
+                tasks += build_tool_tasks(query_pdb, proteome_dir, proteome_databases[proteome_dir.name]['index'], 'fatcat', fatcat_install_dir, work_dir, db_shards, tool_options)
+        
+        if tm_align_batch_size is not None:
+            # Every proteome is aligned against chunks of the queries still missing for it, batched TM-Align runs
+            # go first so cascade FATCAT searches can start as early as possible
+            batch_tasks = []
+            for proteome_dir in proteome_dirs:
+                proteome_queries = [query_pdb for query_pdb, search_proteome_dir in search_pairs if search_proteome_dir == proteome_dir]
+                for start in range(0, len(proteome_queries), tm_align_batch_size):
+                    batch_tasks += build_tm_align_batch_tasks(proteome_queries[start:start + tm_align_batch_size], proteome_dir, proteome_databases[proteome_dir.name]['index'],
+                                                              tm_align_install_dir, work_dir, proteome_databases[proteome_dir.name]['db_files'], tool_options,
+                                                              start // tm_align_batch_size)
+            tasks = batch_tasks + tasks
+        
+        for query_pdb in query_pdbs:
+            if len(pair_results[query_pdb.name]) == len(proteome_dirs) and query_pdb.name not in {finished_query.name for finished_query, _ in finished}:
+                yield query_pdb, query_result(query_pdb)
+        yield from finished
+        
+        if scheduler == 'asyncio':
+            residue_counts = {name: {entry['name']: entry['n_residues'] for entry in proteome_database['index']['entries']}
+                              for name, proteome_database in proteome_databases.items()}
+            db_file_residues = {str(db_file): sum(residue_counts[name][pdb_name] for pdb_name in shard_entries) for name, proteome_database in proteome_databases.items()
+                                for db_file, shard_entries in zip(proteome_database['db_files'], proteome_database['shard_entries'])}
+            # Batched TM-Align runs share the TM-Align limit
+            tool_limits = {tool: limit for tool, limit in (tool_workers or {}).items() if limit is not None}
+            if 'tm_align' in tool_limits:
+                tool_limits['tm_align_batch'] = tool_limits['tm_align']
+            yield from schedule_tool_runs(tasks, run_search_task_async, collect, workers, tool_limits,
+                                          lambda task: search_task_size(task, residue_counts, db_file_residues), pin_cpus)
+        else:
+            yield from execute_search_tasks(tasks, workers, collect)
+    finally:
+        if remove_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
 
+def plan_cluster_search(query_pdbs, proteome_dirs, fatcat_install_dir, tm_align_install_dir, output_name, output_format, query_chunk_size, search_settings):
+    # The plan holds everything the work units and the reduce job need, they only get the path of the plan file
+    cluster_dir = get_cluster_dir(search_settings['work_dir'])
+    with stage_timer('proteome_databases', proteomes=len(proteome_dirs), shards=search_settings['shards']):
+        proteome_databases = plan_proteome_databases(proteome_dirs, search_settings['shards'])
+    shard_counts = {proteome_dir.name: len(proteome_databases[proteome_dir.name]['shard_entries']) for proteome_dir in proteome_dirs}
+    plan = {
+        'proteome_dirs': [str(proteome_dir) for proteome_dir in proteome_dirs],
+        'fingerprints': {name: proteome_database['fingerprint'] for name, proteome_database in proteome_databases.items()},
+        'shards': search_settings['shards'],
+        'shard_counts': shard_counts,
+        'fatcat_install_dir': str(fatcat_install_dir),
+        'tm_align_install_dir': str(tm_align_install_dir),
+        'output_name': os.path.abspath(output_name),
+        'output_format': output_format,
+        # The number of workers is set per unit from the cores Slurm gives it
+        'search_settings': {setting: value for setting, value in search_settings.items() if setting not in ('workers', 'work_dir')},
+        'units': plan_search_units(query_pdbs, proteome_dirs, shard_counts, query_chunk_size),
+    }
+    return write_cluster_plan(cluster_dir, plan), plan
 
-def search_multiple_proteomes_parallel(args):
-    return search_multiple_proteomes(*args)
+
+def ensure_cluster_proteomes_unchanged(plan, proteome_dirs):
+    # Shards and results of a plan are only valid for the proteomes as they were when the plan was made
+    for proteome_dir in proteome_dirs:
+        if get_proteome_index(proteome_dir)['fingerprint'] != plan['fingerprints'][proteome_dir.name]:
+            raise Exception(f"The proteome '{proteome_dir}' changed since the cluster plan was made, plan the screen again.")
+    return None
 
 
-def search_multiple_queries(query_file_dir, proteome_dirs, fatcat_install_dir, tm_align_install_dir):
+def run_cluster_unit(plan, cluster_dir, unit, workers=1):
+    proteome_dir = Path(unit['proteome_dir'])
+    ensure_cluster_proteomes_unchanged(plan, [proteome_dir])
+    query_pdbs = [Path(query_pdb) for query_pdb in unit['queries']]
+    search_settings = dict(plan['search_settings'], workers=workers, database_shard=unit['shard'])
+    if search_settings['result_store'] is not None:
+        search_settings['result_store'] = Path(search_settings['result_store'])
+    # Alignments only go to the shared work directory when they are asked for, otherwise they stay on the node
+    if search_settings['keep_alignments']:
+        search_settings['work_dir'] = Path(cluster_dir) / 'work' / f"unit_{unit['index']}"
     
-    query_pdbs = [query_file_dir / query_pdb for query_pdb in query_file_dir.glob("*.pdb") if query_pdb.is_file()]
-    queries = {query_pdb.name:[] for query_pdb in query_pdbs}
+    results = iter_query_results(query_pdbs, [proteome_dir], Path(plan['fatcat_install_dir']), Path(plan['tm_align_install_dir']), **search_settings)
+    query_results = {query_pdb.name: result_df for query_pdb, result_df in results}
+    unit_df = pd.concat([query_results[query_pdb.name].assign(**{UNIT_QUERY_COLUMN: query_pdb.name}) for query_pdb in query_pdbs], ignore_index=True)
+    return save_unit_result(cluster_dir, unit['index'], unit_df)
+
+
+def reduce_cluster_search(plan, cluster_dir):
+    # Merges the unit results one query chunk at a time and writes the queries in the planned order,
+    # the shards of every (query, proteome) pair are combined back into the order of the whole proteome database
+    missing = missing_units(cluster_dir, plan['units'])
+    if missing:
+        raise Exception(f"Work units {', '.join(str(unit['index']) for unit in missing)} have no result, run them again before the reduce step.")
+    proteome_dirs = [Path(proteome_dir) for proteome_dir in plan['proteome_dirs']]
+    ensure_cluster_proteomes_unchanged(plan, proteome_dirs)
+    db_entries = {proteome_dir.name: [entry['name'] for entry in get_proteome_index(proteome_dir)['entries']] for proteome_dir in proteome_dirs}
     
+    output_name = plan['output_name']
+    if os.path.isdir(output_name):
+        shutil.rmtree(output_name)
+    elif os.path.exists(output_name):
+        os.remove(output_name)
     
-    # args = [(query_pdb, proteome_dirs, fatcat_install_dir, tm_align_install_dir) for query_pdb in query_pdbs]
+    chunks = {}
+    for unit in plan['units']:
+        chunks.setdefault(unit['chunk'], []).append(unit)
+    for chunk in sorted(chunks):
+        chunk_units = chunks[chunk]
+        with stage_timer('reduce', chunk=chunk, units=len(chunk_units)) as fields:
+            unit_results = {}
+            fields['rows'] = 0
+            for unit in chunk_units:
+                unit_df = load_unit_result(cluster_dir, unit['index'])
+                fields['rows'] += len(unit_df)
+                query_dfs = {query_name: query_df.drop(columns=UNIT_QUERY_COLUMN) for query_name, query_df in unit_df.groupby(UNIT_QUERY_COLUMN, sort=False)}
+                unit_results[(Path(unit['proteome_dir']).name, unit['shard'])] = (query_dfs, unit_df.drop(columns=UNIT_QUERY_COLUMN).iloc[:0])
+            
+            for query_name in [Path(query_pdb).name for query_pdb in chunk_units[0]['queries']]:
+                proteome_dfs = []
+                for proteome_dir in proteome_dirs:
+                    shard_results = {}
+                    for shard in range(plan['shard_counts'][proteome_dir.name]):
+                        query_dfs, empty_df = unit_results[(proteome_dir.name, shard)]
+                        shard_results[shard] = query_dfs.get(query_name, empty_df)
+                    proteome_dfs.append(combine_shard_results(shard_results, db_entries[proteome_dir.name]))
+                query_df = pd.concat(proteome_dfs, ignore_index=True)
+                if plan['search_settings']['top_k'] is not None:
+                    # Every unit kept the top K of its own shard, the best K of the query are among them
+                    query_df = retain_hits(query_df, plan['search_settings']['top_k'])
+                write_query_results(output_name, plan['output_format'], query_name, query_df)
+    return output_name
+
+
+def run_cluster_step(args, parser):
+    plan_file = Path(args.run_unit or args.reduce).resolve()
+    if not plan_file.exists():
+        parser.print_help()
+        print("\nThe provided cluster plan file does not exist, please ensure correct input.")
+        sys.exit(1)
+    if args.workers < 1:
+        parser.print_help()
+        print("\nThe number of workers must be at least 1.")
+        sys.exit(1)
+    metrics_file = enable_metrics(args.metrics) if args.metrics else None
     
-    # with ProcessPoolExecutor() as executor:
-    #     results = list(tqdm(executor.map(search_multiple_proteomes_parallel, args), total=len(args), desc='Progress searching all queries...'))
+    try:
+        plan = load_cluster_plan(plan_file)
+        if args.reduce:
+            output_name = reduce_cluster_search(plan, plan_file.parent)
+            print(f"FATCAT and TM-Align search complete. Results saved to {output_name}.")
+            return None
+        
+        if args.unit_index is None:
+            # Without an index every unit that has no result yet runs here, one after the other
+            units = missing_units(plan_file.parent, plan['units'])
+        elif 0 <= args.unit_index < len(plan['units']):
+            units = [plan['units'][args.unit_index]]
+        else:
+            raise Exception(f"The cluster plan has {len(plan['units'])} work units, there is no unit {args.unit_index}.")
+        for unit in tqdm(units, desc='Progress running work units...'):
+            run_cluster_unit(plan, plan_file.parent, unit, args.workers)
+    except:
+        print(f"{traceback.format_exc()}")
+        sys.exit(1)
+    finally:
+        if metrics_file is not None:
+            print_metrics_summary(metrics_file)
+    return None
+
+
+def list_query_pdbs(query_file_dir):
+    return [query_file_dir / query_pdb for query_pdb in query_file_dir.glob("*.pdb") if query_pdb.is_file()]
+
+
+def search_multiple_queries(query_file_dir, proteome_dirs, fatcat_install_dir, tm_align_install_dir, **search_settings):
     
-    # for query_pdb, result in zip(query_pdbs, results):
-    #     queries[query_pdb.name] = result
+    query_pdbs = list_query_pdbs(query_file_dir)
+    queries = {query_pdb.name:[] for query_pdb in query_pdbs}
     
-    for query_pdb in tqdm(query_pdbs, total=len(query_pdbs), desc='Progress searching all queries...'):
-        queries[query_pdb.name] = search_multiple_proteomes(query_pdb, proteome_dirs, fatcat_install_dir, tm_align_install_dir)
+    results = iter_query_results(query_pdbs, proteome_dirs, fatcat_install_dir, tm_align_install_dir, **search_settings)
+    for query_pdb, result_df in tqdm(results, total=len(query_pdbs), desc='Progress searching all queries...'):
+        queries[query_pdb.name] = result_df
     
     dfs = []
     for key, df in queries.items():    
@@ -365,4 +1344,4 @@ def search_multiple_queries(query_file_dir, proteome_dirs, fatcat_install_dir, t
     
     
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
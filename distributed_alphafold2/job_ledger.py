@@ -0,0 +1,170 @@
+from pathlib import Path
+import os
+import time
+import sqlite3
+import subprocess
+from sequence_registry import find_result_dir
+from metrics import stage_timer
+
+# Local record of every fasta target distributed to an AlphaFold2 output directory: its state, the Slurm job it
+# was submitted as (<job id>_<task id> for array tasks) and how often it was submitted. Reconciling asks squeue and
+# sacct about all tracked jobs at once and looks for the finished models, so reruns never have to guess.
+LEDGER_FILE_NAME = '.job_ledger.sqlite'
+STATES = ('planned', 'submitted', 'running', 'done', 'failed')
+ACTIVE_STATES = ('submitted', 'running', 'done')
+SQUEUE_STATES = {'PENDING': 'submitted', 'CONFIGURING': 'submitted', 'REQUEUED': 'submitted', 'RESIZING': 'submitted',
+                 'RUNNING': 'running', 'COMPLETING': 'running', 'SUSPENDED': 'running', 'STOPPED': 'running'}
+SACCT_FAILED_STATES = ('FAILED', 'TIMEOUT', 'CANCELLED', 'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE', 'REVOKED')
+SLURM_QUERY_CHUNK = 500
+
+
+def open_ledger(alpha_out_dir):
+    connection = sqlite3.connect(Path(alpha_out_dir) / LEDGER_FILE_NAME, timeout=60)
+    connection.row_factory = sqlite3.Row
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS targets (
+            name TEXT PRIMARY KEY,
+            fasta_file TEXT NOT NULL,
+            out_dir TEXT NOT NULL,
+            state TEXT NOT NULL,
+            job_id TEXT,
+            slurm_state TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        )""")
+    connection.commit()
+    return connection
+
+
+def ledger_exists(alpha_out_dir):
+    return (Path(alpha_out_dir) / LEDGER_FILE_NAME).exists()
+
+
+def get_targets(connection, states=None):
+    if states is None:
+        return connection.execute('SELECT * FROM targets ORDER BY name').fetchall()
+    placeholders = ','.join('?' * len(states))
+    return connection.execute(f'SELECT * FROM targets WHERE state IN ({placeholders}) ORDER BY name', tuple(states)).fetchall()
+
+
+def record_planned(connection, targets):
+    now = time.time()
+    with connection:
+        connection.executemany("""
+            INSERT INTO targets (name, fasta_file, out_dir, state, updated_at) VALUES (?, ?, ?, 'planned', ?)
+            ON CONFLICT(name) DO UPDATE SET fasta_file = excluded.fasta_file, out_dir = excluded.out_dir,
+                state = 'planned', job_id = NULL, slurm_state = NULL, updated_at = excluded.updated_at""",
+            [(target['name'], target['fasta_file'], target['out_dir'], now) for target in targets])
+
+
+def record_submitted(connection, target_job_ids):
+    now = time.time()
+    with connection:
+        connection.executemany("""
+            UPDATE targets SET state = 'submitted', job_id = ?, slurm_state = NULL, attempts = attempts + 1, updated_at = ?
+            WHERE name = ?""", [(job_id, now, name) for name, job_id in target_job_ids.items()])
+
+
+def record_states(connection, target_states):
+    now = time.time()
+    with connection:
+        connection.executemany('UPDATE targets SET state = ?, slurm_state = ?, updated_at = ? WHERE name = ?',
+                               [(state, slurm_state, now, name) for name, (state, slurm_state) in target_states.items()])
+
+
+def select_targets_to_submit(connection, alpha_out_dir, targets, force_overwrite=False):
+    # Replaces asking about every existing directory: targets the ledger knows as submitted, running or done and
+    # targets whose model is already on disk are skipped unless force_overwrite is given. Without a ledger (a dry
+    # run in a fresh output directory) no target has a known state yet
+    if force_overwrite:
+        return targets, []
+    known_states = {row['name']: row['state'] for row in get_targets(connection)} if connection is not None else {}
+    to_submit, skipped = [], []
+    for target in targets:
+        if known_states.get(target['name']) in ACTIVE_STATES or find_result_dir(alpha_out_dir, target['name']) is not None:
+            skipped.append(target)
+        else:
+            to_submit.append(target)
+    return to_submit, skipped
+
+
+def run_scheduler_command(invocation):
+    try:
+        completed = subprocess.run(invocation, check=True, capture_output=True, text=True)
+    except FileNotFoundError:
+        return None
+    except subprocess.CalledProcessError as e:
+        print(f"Warning: {invocation[0]} failed: {e.stderr.strip()}")
+        return None
+    return completed.stdout
+
+
+def query_squeue(job_ids):
+    # One squeue call for every job of the user, pending array tasks expanded to one line each
+    username = os.getenv('USER') or os.getenv('USERNAME')
+    output = run_scheduler_command(['squeue', '--noheader', '--array', '--user', username, '--format=%i|%T'])
+    if output is None:
+        return {}
+    queued = {}
+    for line in output.splitlines():
+        job_id, _, slurm_state = line.strip().partition('|')
+        if job_id in job_ids:
+            queued[job_id] = slurm_state
+    return queued
+
+
+def query_sacct(job_ids):
+    base_job_ids = sorted({job_id.split('_')[0] for job_id in job_ids})
+    accounted = {}
+    for start in range(0, len(base_job_ids), SLURM_QUERY_CHUNK):
+        chunk = base_job_ids[start:start + SLURM_QUERY_CHUNK]
+        output = run_scheduler_command(['sacct', '--noheader', '--parsable2', '--allocations', '--format=JobID,State', '--jobs', ','.join(chunk)])
+        if output is None:
+            break
+        for line in output.splitlines():
+            job_id, _, slurm_state = line.strip().partition('|')
+            if job_id in job_ids:
+                # "CANCELLED by 1234" -> CANCELLED
+                accounted[job_id] = slurm_state.split()[0] if slurm_state else slurm_state
+    return accounted
+
+
+def reconcile_ledger(connection, alpha_out_dir):
+    rows = get_targets(connection, ('planned', 'submitted', 'running', 'failed'))
+    job_ids = {row['job_id'] for row in rows if row['job_id'] and row['state'] in ('submitted', 'running')}
+    with stage_timer('scheduler_query', jobs=len(job_ids)):
+        queued = query_squeue(job_ids) if job_ids else {}
+        accounted = query_sacct(job_ids - set(queued)) if job_ids - set(queued) else {}
+
+    target_states = {}
+    for row in rows:
+        has_result = find_result_dir(alpha_out_dir, row['name']) is not None
+        job_id = row['job_id']
+        if has_result:
+            target_states[row['name']] = ('done', accounted.get(job_id, row['slurm_state']))
+        elif row['state'] not in ('submitted', 'running'):
+            continue
+        elif job_id in queued:
+            target_states[row['name']] = (SQUEUE_STATES.get(queued[job_id], 'running'), queued[job_id])
+        elif job_id in accounted:
+            slurm_state = accounted[job_id]
+            if slurm_state in SACCT_FAILED_STATES or slurm_state == 'COMPLETED':
+                # A job that completed without ranked_0.pdb did not produce a model either
+                target_states[row['name']] = ('failed', slurm_state)
+            else:
+                target_states[row['name']] = (SQUEUE_STATES.get(slurm_state, row['state']), slurm_state)
+    with stage_timer('ledger_write', targets=len(target_states)):
+        record_states(connection, target_states)
+    return target_states
+
+
+def print_ledger_status(connection, verbose=False):
+    rows = get_targets(connection)
+    counts = {state: 0 for state in STATES}
+    for row in rows:
+        counts[row['state']] += 1
+    print(', '.join(f'{state}: {count}' for state, count in counts.items()) + f' ({len(rows)} targets)')
+    for row in rows:
+        if verbose or row['state'] == 'failed':
+            print(f"{row['name']:<28}{row['state']:<11}{row['job_id'] or '-':<16}{row['slurm_state'] or '-':<15}attempts: {row['attempts']}")
+    return counts
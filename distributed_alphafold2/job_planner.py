@@ -0,0 +1,136 @@
+import os
+import re
+
+# Length aware job planning for distribute_alphafold2.py. Every length tier gives the walltime per target and the
+# memory of a job, e.g. "500=06:00:00/40G". Targets in the shortest tier are packed into multi target jobs that run
+# one after the other in a single container session, the longer ones each get a job with the resources of their tier.
+DEFAULT_LENGTH_TIERS = ['500=06:00:00/40G', '1200=1-00:00:00/80G', 'inf=2-00:00:00/120G']
+DEFAULT_PACK_SIZE = 10
+DEFAULT_PACK_MAX_RESIDUES = 3000
+
+
+def read_fasta_length(fasta_path):
+    # Total number of residues over all records, so multimer inputs are planned by their full size
+    n_residues = 0
+    with open(fasta_path, 'r') as f:
+        for line in f:
+            if not line.startswith('>'):
+                n_residues += len(line.strip().replace('*', ''))
+    return n_residues
+
+
+def parse_length_tiers(tier_specs):
+    tiers = []
+    for tier_spec in tier_specs:
+        match = re.fullmatch(r'(\d+|inf)=([\d:-]+)/(\d+[KMGT]?)', tier_spec.strip())
+        if match is None:
+            raise Exception(f"Could not parse length tier '{tier_spec}', expected max_length=time/memory EX: 500=06:00:00/40G")
+        max_length = float('inf') if match.group(1) == 'inf' else int(match.group(1))
+        tiers.append({'max_length': max_length, 'time': match.group(2), 'mem': match.group(3)})
+    tiers.sort(key=lambda tier: tier['max_length'])
+    if tiers[-1]['max_length'] != float('inf'):
+        tiers.append({'max_length': float('inf'), 'time': tiers[-1]['time'], 'mem': tiers[-1]['mem']})
+    return tiers
+
+
+def slurm_time_to_minutes(slurm_time):
+    days, _, clock = slurm_time.rpartition('-')
+    fields = [int(field) for field in clock.split(':')]
+    # Slurm reads MM, MM:SS and HH:MM:SS (and D-HH, D-HH:MM, D-HH:MM:SS with a day prefix)
+    if days:
+        fields += [0] * (3 - len(fields))
+        hours, minutes, seconds = fields
+    elif len(fields) == 3:
+        hours, minutes, seconds = fields
+    else:
+        hours, minutes, seconds = 0, fields[0], fields[1] if len(fields) > 1 else 0
+    return int(days or 0) * 24 * 60 + hours * 60 + minutes + (1 if seconds else 0)
+
+
+def minutes_to_slurm_time(minutes):
+    days, minutes = divmod(int(minutes), 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{days}-{hours:02d}:{minutes:02d}:00'
+
+
+def pack_targets(targets, pack_size, pack_max_residues):
+    # First fit decreasing: longest targets first, each into the first pack that still has room
+    packs = []
+    for target in sorted(targets, key=lambda target: target['length'], reverse=True):
+        for pack in packs:
+            if len(pack) < pack_size and sum(packed['length'] for packed in pack) + target['length'] <= pack_max_residues:
+                pack.append(target)
+                break
+        else:
+            packs.append([target])
+    return packs
+
+
+def plan_jobs(targets, tiers, alpha_out_dir, pack_size, pack_max_residues):
+    # targets need 'name', 'length', 'fasta_file' and 'out_dir'. Every job gets the targets it runs, its time and
+    # memory, and the FASTA_FILE value, working directory and output directory its run script is filled in with.
+    assign_tiers(targets, tiers)
+    jobs = []
+    n_packs = 0
+    for tier_index, tier in enumerate(tiers):
+        tier_targets = [target for target in targets if target['tier'] == tier_index]
+        if tier_index == 0 and pack_size > 1:
+            groups = pack_targets(tier_targets, pack_size, pack_max_residues)
+        else:
+            groups = [[target] for target in tier_targets]
+        for group in groups:
+            job = {
+                'tier': tier_index,
+                'targets': group,
+                'time': minutes_to_slurm_time(slurm_time_to_minutes(tier['time']) * len(group)),
+                'mem': tier['mem'],
+            }
+            if len(group) == 1:
+                job.update({'name': group[0]['name'], 'work_dir': group[0]['out_dir'], 'out_dir': group[0]['out_dir']})
+            else:
+                n_packs += 1
+                # AlphaFold2 writes every target of a packed job to <alpha_out_dir>/<fasta name>/, its own directory
+                job.update({'name': f'pack_{n_packs:04d}', 'work_dir': alpha_out_dir, 'out_dir': alpha_out_dir})
+            job['fasta_file'] = fasta_paths_value(job, alpha_out_dir)
+            jobs.append(job)
+    return jobs
+
+
+def assign_tiers(targets, tiers):
+    for target in targets:
+        target['tier'] = next(i for i, tier in enumerate(tiers) if target['length'] <= tier['max_length'])
+    return targets
+
+
+def apply_job_resources(run_script_content, time=None, mem=None):
+    # Overrides the #SBATCH --time and --mem lines of the run script template
+    for option, value in (('time', time), ('mem', mem)):
+        if value is None:
+            continue
+        directive = f'#SBATCH --{option}={value}'
+        if re.search(rf'^#SBATCH --{option}=.*$', run_script_content, flags=re.MULTILINE):
+            run_script_content = re.sub(rf'^#SBATCH --{option}=.*$', directive, run_script_content, flags=re.MULTILINE)
+        else:
+            run_script_content = re.sub(r'^(#!.*\n)', rf'\1{directive}\n', run_script_content, count=1)
+    return run_script_content
+
+
+def print_job_plan(jobs, tiers):
+    print(f"{'job':<28}{'tier':>8}{'targets':>9}{'residues':>10}{'time':>14}{'mem':>7}  fasta files")
+    for job in jobs:
+        max_length = tiers[job['tier']]['max_length']
+        tier_label = f"<={max_length}" if max_length != float('inf') else 'longest'
+        residues = sum(target['length'] for target in job['targets'])
+        names = ', '.join(target['name'] for target in job['targets'])
+        print(f"{job['name']:<28}{tier_label:>8}{len(job['targets']):>9}{residues:>10}{job['time']:>14}{job['mem']:>7}  {names}")
+    n_targets = sum(len(job['targets']) for job in jobs)
+    print(f"\n{n_targets} fasta files in {len(jobs)} jobs.")
+
+
+def fasta_paths_value(job, alpha_out_dir):
+    # The run script binds the working directory to /etc and passes --fasta_paths=/etc/$FASTA_FILE, so a packed job
+    # binds the AlphaFold2 output directory and lists every fasta file relative to it
+    if len(job['targets']) == 1:
+        return job['targets'][0]['fasta_file']
+    fasta_files = [os.path.relpath(os.path.join(target['out_dir'], target['fasta_file']), alpha_out_dir) for target in job['targets']]
+    return ',/etc/'.join(fasta_files)
@@ -0,0 +1,97 @@
+from contextlib import contextmanager
+import os
+import json
+import time
+
+# Opt-in metrics shared by the search and the distributor. Enabling them puts the metrics file into the
+# environment, so worker processes and their children append to the same JSON lines file (one short write per
+# record, which O_APPEND keeps whole). Every record has the stage, its wall time in seconds and stage specific
+# fields; subprocess records also carry the CPU time, max RSS and bytes read of the child from wait4.
+METRICS_ENV_VAR = 'DISTRIBUTED_ALPHAFOLD2_METRICS'
+
+
+def enable_metrics(metrics_file):
+    # Every run starts a new metrics file so the summary only covers this run
+    metrics_file = os.path.abspath(metrics_file)
+    open(metrics_file, 'w').close()
+    os.environ[METRICS_ENV_VAR] = metrics_file
+    return metrics_file
+
+
+def metrics_enabled():
+    return METRICS_ENV_VAR in os.environ
+
+
+def record_metric(stage, seconds, **fields):
+    metrics_file = os.environ.get(METRICS_ENV_VAR)
+    if metrics_file is None:
+        return None
+    record = {'time': time.time(), 'pid': os.getpid(), 'stage': stage, 'seconds': seconds}
+    record.update(fields)
+    fd = os.open(metrics_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record, default=str) + '\n').encode())
+    finally:
+        os.close(fd)
+    return record
+
+
+@contextmanager
+def stage_timer(stage, **fields):
+    # The yielded dict can be filled with fields that are only known at the end of the stage
+    if not metrics_enabled():
+        yield {}
+        return
+    started = time.perf_counter()
+    extra_fields = {}
+    try:
+        yield extra_fields
+    finally:
+        fields.update(extra_fields)
+        record_metric(stage, time.perf_counter() - started, **fields)
+
+
+def wait_process(process, started, stage='subprocess', **fields):
+    # Waits with wait4 to get the resource usage of exactly this child, and keeps Popen's returncode up to date
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    record_metric(stage, time.perf_counter() - started, returncode=process.returncode,
+                  user_seconds=rusage.ru_utime, system_seconds=rusage.ru_stime,
+                  max_rss_mb=rusage.ru_maxrss / 1024, bytes_read=rusage.ru_inblock * 512, **fields)
+    return process.returncode
+
+
+def summarize_metrics(metrics_file):
+    stages = {}
+    with open(metrics_file, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            stages.setdefault(record['stage'], []).append(record)
+
+    summary = []
+    for stage, records in stages.items():
+        seconds = sorted(record['seconds'] for record in records)
+        summary.append({
+            'stage': stage,
+            'count': len(records),
+            'total_seconds': sum(seconds),
+            'mean_seconds': sum(seconds) / len(seconds),
+            'p95_seconds': seconds[min(len(seconds) - 1, int(0.95 * len(seconds)))],
+            'max_seconds': seconds[-1],
+            'cpu_seconds': sum(record.get('user_seconds', 0) + record.get('system_seconds', 0) for record in records),
+            'max_rss_mb': max((record.get('max_rss_mb', 0) for record in records), default=0),
+            'files': sum(record.get('files', 0) for record in records),
+            'bytes_read': sum(record.get('bytes_read', 0) for record in records),
+        })
+    return summary
+
+
+def print_metrics_summary(metrics_file):
+    if not os.path.exists(metrics_file):
+        return None
+    print(f"\n{'stage':<22}{'count':>8}{'total s':>11}{'mean s':>10}{'p95 s':>10}{'max s':>10}{'cpu s':>11}{'max rss MB':>12}{'files':>10}{'MB read':>10}")
+    for row in summarize_metrics(metrics_file):
+        print(f"{row['stage']:<22}{row['count']:>8}{row['total_seconds']:>11.2f}{row['mean_seconds']:>10.3f}{row['p95_seconds']:>10.3f}{row['max_seconds']:>10.3f}"
+              f"{row['cpu_seconds']:>11.2f}{row['max_rss_mb']:>12.1f}{row['files']:>10}{row['bytes_read'] / 2 ** 20:>10.1f}")
+    print(f"Metrics written to {metrics_file}")
+    return None
@@ -0,0 +1,158 @@
+from pathlib import Path
+import os
+import re
+import json
+import fcntl
+import hashlib
+import tempfile
+
+# A proteome index is built once per proteome directory and is only rebuilt when the fingerprint of the
+# directory (names, sizes and mtimes of the PDB files) changes. It lives in a hidden directory next to the
+# structures so proteome_dir.glob("*.pdb") never picks it up.
+INDEX_DIR_NAME = '.proteome_index'
+INDEX_FILE_NAME = 'index.json'
+INDEX_VERSION = 1
+# Database lists, caches and packs next to the index are named after the first 16 characters of the fingerprint
+FINGERPRINT_FILE_PATTERN = re.compile(r'_([0-9a-f]{16})[._]')
+
+
+def scan_proteome_dir(proteome_dir):
+    pdb_stats = []
+    with os.scandir(proteome_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.pdb') and entry.is_file():
+                stat = entry.stat()
+                pdb_stats.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return pdb_stats
+
+
+def proteome_fingerprint(pdb_stats):
+    fingerprint = hashlib.sha1()
+    for file_name, size, mtime_ns in sorted(pdb_stats):
+        fingerprint.update(f'{file_name}\t{size}\t{mtime_ns}\n'.encode())
+    return fingerprint.hexdigest()
+
+
+def count_pdb_residues(pdb_path):
+    n_residues = 0
+    with open(pdb_path, 'r') as f:
+        for line in f:
+            if line.startswith('ATOM') and line[12:16].strip() == 'CA':
+                n_residues += 1
+            elif line.startswith('ENDMDL'):
+                break
+    return n_residues
+
+
+def get_index_dir(proteome_dir):
+    index_dir = Path(proteome_dir) / INDEX_DIR_NAME
+    try:
+        index_dir.mkdir(exist_ok=True)
+        if os.access(index_dir, os.W_OK):
+            return index_dir
+    except PermissionError:
+        pass
+    # Read only proteome trees get their index in the user cache instead
+    cache_root = Path(os.getenv('XDG_CACHE_HOME', Path.home() / '.cache')) / 'fatcat_tmalign' / 'proteome_index'
+    index_dir = cache_root / hashlib.sha1(str(Path(proteome_dir).resolve()).encode()).hexdigest()
+    index_dir.mkdir(parents=True, exist_ok=True)
+    return index_dir
+
+
+def load_proteome_index(proteome_dir):
+    index_file = get_index_dir(proteome_dir) / INDEX_FILE_NAME
+    if not index_file.exists():
+        return None
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+    except (json.JSONDecodeError, OSError):
+        return None
+    if index.get('version') != INDEX_VERSION:
+        return None
+    return index
+
+
+def build_proteome_index(proteome_dir, pdb_stats, previous_index=None):
+    # Residue counts of structures whose size and mtime did not change are reused from the previous index
+    previous_entries = {}
+    if previous_index is not None:
+        previous_entries = {entry['file']: entry for entry in previous_index['entries']}
+
+    entries = []
+    for file_name, size, mtime_ns in pdb_stats:
+        previous_entry = previous_entries.get(file_name)
+        if previous_entry is not None and previous_entry['size'] == size and previous_entry['mtime_ns'] == mtime_ns:
+            n_residues = previous_entry['n_residues']
+        else:
+            n_residues = count_pdb_residues(Path(proteome_dir) / file_name)
+        entries.append({
+            'name': file_name.split('.')[0],
+            'file': file_name,
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'n_residues': n_residues,
+        })
+
+    return {
+        'version': INDEX_VERSION,
+        'proteome_dir': str(Path(proteome_dir).resolve()),
+        'fingerprint': proteome_fingerprint(pdb_stats),
+        'entries': entries,
+    }
+
+
+def write_atomically(path, content):
+    # Readers either see the old or the new file, never a partially written one
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        # mkstemp creates private files, but the index is shared by everyone searching the proteome
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def get_proteome_index(proteome_dir):
+    pdb_stats = scan_proteome_dir(proteome_dir)
+    fingerprint = proteome_fingerprint(pdb_stats)
+
+    index = load_proteome_index(proteome_dir)
+    if index is not None and index['fingerprint'] == fingerprint:
+        return index
+
+    index_dir = get_index_dir(proteome_dir)
+    with open(index_dir / '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # Another process may have rebuilt the index while this one was waiting for the lock
+        index = load_proteome_index(proteome_dir)
+        if index is not None and index['fingerprint'] == fingerprint:
+            return index
+        index = build_proteome_index(proteome_dir, pdb_stats, index)
+        write_atomically(index_dir / INDEX_FILE_NAME, json.dumps(index))
+        prune_superseded_files(index_dir, index)
+    return index
+
+
+def prune_superseded_files(index_dir, index):
+    # Removes the files of earlier fingerprints, called under the index lock. Hidden files are still being written.
+    for index_file in Path(index_dir).iterdir():
+        match = FINGERPRINT_FILE_PATTERN.search(index_file.name)
+        if not index_file.name.startswith('.') and match is not None and match.group(1) != index['fingerprint'][:16]:
+            index_file.unlink(missing_ok=True)
+    return None
+
+
+def get_database_file(proteome_dir, index, db_entries=None, label='all'):
+    # Database lists are named after the fingerprint, so they are written once and then only read
+    db_file = get_index_dir(proteome_dir) / f"proteome_database_{index['fingerprint'][:16]}_{label}.txt"
+    if not db_file.exists():
+        if db_entries is None:
+            db_entries = [entry['name'] for entry in index['entries']]
+        write_atomically(db_file, ''.join(f'{pdb_name}\n' for pdb_name in db_entries))
+    return db_file
@@ -0,0 +1,216 @@
+from pathlib import Path
+import os
+import json
+import fcntl
+import shutil
+import socket
+import tempfile
+from proteome_index import INDEX_DIR_NAME, INDEX_FILE_NAME, get_index_dir, get_proteome_index, prune_superseded_files, write_atomically
+from metrics import stage_timer
+
+# Staging copies every proteome once per node into local scratch (or /dev/shm) before it is searched, so the
+# searches read the structures from local storage instead of the shared filesystem. Every proteome is packed
+# once per fingerprint into a single file next to its index (all PDB files back to back, with an index of their
+# offsets), so staging it on a node is one large sequential read. Staged copies keep the names, sizes and mtimes of
+# the originals and therefore the fingerprint and the proteome index. Every search that uses a staged copy holds a
+# reference to it, the last one to release it removes the copy and its lock file.
+STAGING_DIR_NAME = 'fatcat_tmalign_staging'
+PACK_VERSION = 1
+PACK_READ_SIZE = 64 * 2 ** 20
+
+
+def get_pack_files(proteome_dir, index):
+    index_dir = get_index_dir(proteome_dir)
+    return index_dir / f"proteome_pack_{index['fingerprint'][:16]}.pack", index_dir / f"proteome_pack_{index['fingerprint'][:16]}.json"
+
+
+def load_pack_index(pack_index_file, index):
+    if not pack_index_file.exists():
+        return None
+    with open(pack_index_file, 'r') as f:
+        pack_index = json.load(f)
+    if pack_index.get('version') != PACK_VERSION or pack_index.get('fingerprint') != index['fingerprint']:
+        return None
+    return pack_index
+
+
+def get_proteome_pack(proteome_dir, index):
+    # Packed once per fingerprint under the index lock. Packs of earlier fingerprints are removed here and whenever
+    # the index is rebuilt, so proteomes that are no longer staged do not keep them.
+    pack_file, pack_index_file = get_pack_files(proteome_dir, index)
+    pack_index = load_pack_index(pack_index_file, index)
+    if pack_index is not None and pack_file.exists():
+        return pack_file, pack_index
+
+    index_dir = get_index_dir(proteome_dir)
+    with open(index_dir / '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        pack_index = load_pack_index(pack_index_file, index)
+        if pack_index is not None and pack_file.exists():
+            return pack_file, pack_index
+        with stage_timer('pack', proteome=Path(proteome_dir).name, files=len(index['entries'])) as fields:
+            pack_index = write_proteome_pack(proteome_dir, index, pack_file)
+            fields['bytes'] = pack_index['size']
+        write_atomically(pack_index_file, json.dumps(pack_index))
+        prune_superseded_files(index_dir, index)
+    return pack_file, pack_index
+
+
+def write_proteome_pack(proteome_dir, index, pack_file):
+    members = []
+    offset = 0
+    fd, tmp_path = tempfile.mkstemp(dir=pack_file.parent, prefix=f'.{pack_file.name}.')
+    try:
+        with os.fdopen(fd, 'wb') as pack:
+            for entry in index['entries']:
+                with open(Path(proteome_dir) / entry['file'], 'rb') as f:
+                    content = f.read()
+                pack.write(content)
+                members.append({'file': entry['file'], 'offset': offset, 'size': len(content), 'mtime_ns': entry['mtime_ns']})
+                offset += len(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, pack_file)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return {'version': PACK_VERSION, 'fingerprint': index['fingerprint'], 'size': offset, 'members': members}
+
+
+def unpack_proteome(pack_file, pack_index, staged_dir):
+    # Reads the pack front to back in large blocks and writes the members out as they come
+    staged_dir.mkdir(parents=True)
+    members = iter(pack_index['members'])
+    member = next(members, None)
+    member_file, written = None, 0
+    with open(pack_file, 'rb') as pack:
+        while member is not None:
+            block = memoryview(pack.read(PACK_READ_SIZE))
+            if not block and member['size'] > written:
+                raise Exception(f"The proteome pack '{pack_file}' is shorter than its index, remove it so it is packed again.")
+            while member is not None and (block or member['size'] == written):
+                if member_file is None:
+                    member_file, written = open(staged_dir / member['file'], 'wb'), 0
+                n_bytes = min(len(block), member['size'] - written)
+                member_file.write(block[:n_bytes])
+                block, written = block[n_bytes:], written + n_bytes
+                if written == member['size']:
+                    member_file.close()
+                    os.utime(staged_dir / member['file'], ns=(member['mtime_ns'], member['mtime_ns']))
+                    member_file, member, written = None, next(members, None), 0
+    return staged_dir
+
+
+def copy_index_files(proteome_dir, index, staged_dir):
+    # The staged copy gets the index of the original, so it is never rebuilt and keeps the order of its entries,
+    # together with the descriptor and CA coordinate caches of the same fingerprint
+    staged_index_dir = staged_dir / INDEX_DIR_NAME
+    staged_index_dir.mkdir(exist_ok=True)
+    write_atomically(staged_index_dir / INDEX_FILE_NAME, json.dumps(dict(index, proteome_dir=str(staged_dir))))
+    for cache_file in get_index_dir(proteome_dir).glob(f"*_{index['fingerprint'][:16]}.npy"):
+        shutil.copyfile(cache_file, staged_index_dir / cache_file.name)
+    return None
+
+
+def change_reference(refs_dir, change):
+    # One reference file per process holds how often that process currently uses the staged copy
+    ref_file = refs_dir / f'{socket.gethostname()}_{os.getpid()}'
+    count = int(ref_file.read_text()) + change if ref_file.exists() else max(change, 0)
+    if count > 0:
+        ref_file.write_text(str(count))
+    else:
+        ref_file.unlink(missing_ok=True)
+    return count
+
+
+def prune_references(refs_dir):
+    # References of processes on this node that ended without releasing them (killed jobs) are dropped
+    hostname = socket.gethostname()
+    for ref_file in refs_dir.iterdir():
+        ref_hostname, _, pid = ref_file.name.rpartition('_')
+        if ref_hostname != hostname or not pid.isdigit():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            ref_file.unlink(missing_ok=True)
+        except PermissionError:
+            pass
+    return None
+
+
+def lock_stage(staging_root, stage_name):
+    # The last release removes the lock file, a process that locked the removed file retries on the new one
+    lock_path = staging_root / f'{stage_name}.lock'
+    while True:
+        lock_file = open(lock_path, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_path)):
+                return lock_file
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+
+
+def stage_proteome(proteome_dir, stage_dir):
+    proteome_dir = Path(proteome_dir)
+    index = get_proteome_index(proteome_dir)
+    staging_root = Path(stage_dir) / STAGING_DIR_NAME
+    staging_root.mkdir(parents=True, exist_ok=True)
+    stage_name = f"{proteome_dir.name}_{index['fingerprint'][:16]}"
+    staged_dir = staging_root / stage_name / proteome_dir.name
+    refs_dir = staging_root / f'{stage_name}.refs'
+
+    with lock_stage(staging_root, stage_name):
+        complete_marker = staging_root / stage_name / '.complete'
+        if not complete_marker.exists():
+            # A copy without the marker was interrupted while it was unpacked
+            shutil.rmtree(staging_root / stage_name, ignore_errors=True)
+            pack_file, pack_index = get_proteome_pack(proteome_dir, index)
+            try:
+                with stage_timer('stage', proteome=proteome_dir.name, files=len(pack_index['members']), bytes=pack_index['size']):
+                    unpack_proteome(pack_file, pack_index, staged_dir)
+                    copy_index_files(proteome_dir, index, staged_dir)
+            except BaseException:
+                shutil.rmtree(staging_root / stage_name, ignore_errors=True)
+                raise
+            complete_marker.touch()
+        refs_dir.mkdir(exist_ok=True)
+        change_reference(refs_dir, 1)
+    return staged_dir
+
+
+def release_proteome(staged_dir):
+    staged_dir = Path(staged_dir)
+    staging_root = staged_dir.parent.parent
+    stage_name = staged_dir.parent.name
+    refs_dir = staging_root / f'{stage_name}.refs'
+
+    with lock_stage(staging_root, stage_name):
+        if refs_dir.exists():
+            change_reference(refs_dir, -1)
+            prune_references(refs_dir)
+        if not refs_dir.exists() or not any(refs_dir.iterdir()):
+            shutil.rmtree(staging_root / stage_name, ignore_errors=True)
+            shutil.rmtree(refs_dir, ignore_errors=True)
+            (staging_root / f'{stage_name}.lock').unlink(missing_ok=True)
+    return None
+
+
+def stage_proteomes(proteome_dirs, stage_dir):
+    # Returns the staged copies in the order of proteome_dirs, copies staged before a failure are released again
+    staged_dirs = []
+    try:
+        for proteome_dir in proteome_dirs:
+            staged_dirs.append(stage_proteome(proteome_dir, stage_dir))
+    except BaseException:
+        release_proteomes(staged_dirs)
+        raise
+    return staged_dirs
+
+
+def release_proteomes(staged_dirs):
+    for staged_dir in staged_dirs:
+        release_proteome(staged_dir)
+    return None
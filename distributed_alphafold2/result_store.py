@@ -0,0 +1,64 @@
+from pathlib import Path
+import os
+import json
+import hashlib
+import pandas as pd
+from proteome_index import write_atomically
+
+# Finished (query, proteome) searches are checkpointed here as soon as they complete. Every result is keyed by the
+# content of the query PDB, the fingerprint of the proteome and the versions of the search tools, so a rerun
+# only searches the pairs that are missing and any change to a query, a proteome or a tool invalidates its results.
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def tool_version(*executables):
+    # The tools do not report a reliable version, so the hash of the installed executables stands in for it
+    version = hashlib.sha256()
+    for executable in executables:
+        if os.path.exists(executable):
+            version.update(file_sha256(executable).encode())
+    return version.hexdigest()[:16]
+
+
+def fatcat_version(fatcat_install_dir):
+    fatcat_main_dir = Path(fatcat_install_dir) / 'FATCATMain'
+    return tool_version(fatcat_main_dir / 'FATCATSearch.pl', fatcat_main_dir / 'FATCAT')
+
+
+def tm_align_version(tm_align_install_dir):
+    return tool_version(Path(tm_align_install_dir) / 'USalign')
+
+
+def result_key(query_hash, proteome_fingerprint, tool_versions, search_options=None):
+    key = {
+        'query': query_hash,
+        'proteome': proteome_fingerprint,
+        'tools': tool_versions,
+        'options': search_options or {},
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def result_path(result_store, query_pdb, proteome_name, key):
+    return Path(result_store) / proteome_name / f'{Path(query_pdb).stem}_{key[:16]}.csv'
+
+
+def load_result(result_store, query_pdb, proteome_name, key):
+    path = result_path(result_store, query_pdb, proteome_name, key)
+    if not path.exists():
+        return None
+    return pd.read_csv(path, float_precision='round_trip')
+
+
+def save_result(result_store, query_pdb, proteome_name, key, result_df):
+    path = result_path(result_store, query_pdb, proteome_name, key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write_atomically(path, result_df.to_csv(index=False))
+    return path
@@ -0,0 +1,87 @@
+from pathlib import Path
+import os
+import pandas as pd
+
+# Results are written one query at a time as soon as the query is finished, so only one query's results are ever
+# held in memory. The csv output is appended to, the parquet and arrow outputs are directories partitioned as
+# <output>/proteome=<proteome>/query=<query>/part-0.<ext> so one proteome or one query can be read back on its own.
+OUTPUT_FORMATS = ('csv', 'parquet', 'arrow')
+OUTPUT_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+PARTITION_COLUMNS = ['proteome', 'query']
+RESULT_DTYPES = {
+    'query': 'string',
+    'prot_pdb': 'string',
+    'p_val': 'float64',
+    'rmsd': 'float64',
+    'identity': 'float64',
+    'similarity': 'float64',
+    'score': 'float64',
+    'afp': 'float64',
+    'proteome': 'string',
+    'TM1': 'float64',
+    'TM2': 'float64',
+    'RMSD': 'float64',
+    'ID1': 'float64',
+    'ID2': 'float64',
+    'IDali': 'float64',
+    'L1': 'float64',
+    'L2': 'float64',
+    'Lali': 'float64',
+}
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The parquet and arrow output formats require pyarrow, install it with: pip install pyarrow")
+    return pyarrow
+
+
+def to_typed_frame(result_df):
+    dtypes = {column: dtype for column, dtype in RESULT_DTYPES.items() if column in result_df.columns}
+    return result_df.astype(dtypes)
+
+
+def write_query_results(output_name, output_format, query_name, result_df):
+    if output_format == 'csv':
+        result_df.to_csv(output_name, mode='a', header=not os.path.exists(output_name), index=False)
+        return
+
+    pyarrow = import_pyarrow()
+    result_df = to_typed_frame(result_df)
+    for proteome_name, proteome_df in result_df.groupby('proteome', sort=False):
+        partition_dir = Path(output_name) / f'proteome={proteome_name}' / f'query={query_name}'
+        partition_dir.mkdir(parents=True, exist_ok=True)
+        table = pyarrow.Table.from_pandas(proteome_df.drop(columns=PARTITION_COLUMNS), preserve_index=False)
+        part_file = partition_dir / f'part-0{OUTPUT_EXTENSIONS[output_format]}'
+        if output_format == 'parquet':
+            pyarrow.parquet.write_table(table, part_file)
+        else:
+            pyarrow.feather.write_feather(table, part_file)
+
+
+def read_results(output_name, output_format, proteome=None, query=None):
+    if output_format == 'csv':
+        result_df = pd.read_csv(output_name, float_precision='round_trip')
+        if proteome is not None:
+            result_df = result_df[result_df['proteome'] == proteome]
+        if query is not None:
+            result_df = result_df[result_df['query'] == query]
+        return result_df.reset_index(drop=True)
+
+    pyarrow = import_pyarrow()
+    # Only the partitions of the requested proteome and query are opened
+    partitioning = pyarrow.dataset.partitioning(pyarrow.schema([('proteome', pyarrow.string()), ('query', pyarrow.string())]), flavor='hive')
+    dataset = pyarrow.dataset.dataset(output_name, format='parquet' if output_format == 'parquet' else 'ipc', partitioning=partitioning)
+    filter_expression = None
+    for column, value in (('proteome', proteome), ('query', query)):
+        if value is not None:
+            expression = pyarrow.dataset.field(column) == value
+            filter_expression = expression if filter_expression is None else filter_expression & expression
+    result_df = dataset.to_table(filter=filter_expression).to_pandas()
+    columns = [column for column in RESULT_DTYPES if column in result_df.columns]
+    return result_df[columns]
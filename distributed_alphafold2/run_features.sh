@@ -0,0 +1,43 @@
+#!/bin/bash
+#SBATCH -p general
+#SBATCH -q public
+#SBATCH --time=1-00:00:00
+#SBATCH --cpus-per-task=16
+#SBATCH --mem=64G
+#SBATCH --mail-type=FAIL
+#SBATCH --mail-user=my_username_VAR@asu.edu
+#SBATCH --job-name="my_job_name_VAR"
+
+
+#set the environment PATH
+export PYTHONNOUSERSITE=True
+# module load singularity/3.8.0
+export ALPHAFOLD_DATA_PATH=/data/alphafold/db_20230619
+export USER_ALPHAFOLD_DIR=/home/$(whoami)/alphafold2
+export FASTA_FILE=my_fasta_file_VAR
+
+#CPU stage: jackhmmer/hhblits/hhsearch database search, stops after writing features.pkl
+#FEATURES_ONLY_FLAG has to be the flag of your AlphaFold2 build that stops after the data pipeline
+export FEATURES_ONLY_FLAG=--features_only
+
+#Run the command
+singularity run \
+ -B $ALPHAFOLD_DATA_PATH:/data \
+ -B .:/etc \
+ --pwd  /app/alphafold my_sif_file_VAR \
+ --fasta_paths=/etc/$FASTA_FILE  \
+ --uniref90_database_path=/data/uniref90/uniref90.fasta  \
+ --data_dir=/data \
+ --mgnify_database_path=/data/mgnify/mgy_clusters.fa   \
+ --bfd_database_path=/data/bfd/bfd_metaclust_clu_complete_id30_c90_final_seq.sorted_opt \
+ --uniclust30_database_path=/data/uniclust30/uniclust30_2018_08/uniclust30_2018_08 \
+ --pdb70_database_path=/data/pdb70/pdb70  \
+ --template_mmcif_dir=/data/pdb_mmcif/mmcif_files  \
+ --obsolete_pdbs_path=/data/pdb_mmcif/obsolete.dat \
+ --max_template_date=2022-02-09   \
+ --output_dir=my_alphafold_out_dir_VAR  \
+ --model_preset=monomer \
+ --db_preset=full_dbs \
+ --jackhmmer_n_cpu=$SLURM_CPUS_PER_TASK \
+ --hhblits_n_cpu=$SLURM_CPUS_PER_TASK \
+ $FEATURES_ONLY_FLAG
@@ -0,0 +1,16 @@
+#!/bin/bash
+#SBATCH -p general
+#SBATCH -q public
+#SBATCH --time=0-04:00:00
+#SBATCH --cpus-per-task=16
+#SBATCH --mem=32G
+#SBATCH --mail-type=FAIL
+#SBATCH --mail-user=my_username_VAR@asu.edu
+#SBATCH --job-name="my_job_name_VAR"
+
+
+#set the environment PATH
+export PYTHONNOUSERSITE=True
+
+#Run the command
+my_search_command_VAR
@@ -0,0 +1,152 @@
+from pathlib import Path
+import os
+import sys
+import json
+import shlex
+import pandas as pd
+from proteome_index import write_atomically
+from distribute_alphafold2 import submit_sbatch
+
+# Cluster mode of the structure homology search. The screen is planned as (query chunk, proteome, shard) work
+# units, which run as one Slurm job array. Every unit saves its partial result in the cluster directory of the work
+# directory, and a reduce job that depends on the array merges the partial results into the final output.
+CLUSTER_DIR_NAME = 'cluster'
+PLAN_FILE_NAME = 'cluster_plan.json'
+PLAN_VERSION = 1
+DEFAULT_QUERY_CHUNK_SIZE = 50
+DEFAULT_RUN_SCRIPT = Path(__file__).resolve().parent / 'run_search.sh'
+# Unit results hold several queries, this column keeps the query file every row belongs to until the reduce step
+UNIT_QUERY_COLUMN = 'query_file'
+
+
+def get_cluster_dir(work_dir):
+    cluster_dir = Path(work_dir) / CLUSTER_DIR_NAME
+    (cluster_dir / 'units').mkdir(parents=True, exist_ok=True)
+    (cluster_dir / 'logs').mkdir(parents=True, exist_ok=True)
+    return cluster_dir
+
+
+def plan_search_units(query_pdbs, proteome_dirs, shard_counts, query_chunk_size):
+    # Units of the same query chunk are next to each other, so the reduce job can merge one chunk at a time
+    query_chunks = [query_pdbs[start:start + query_chunk_size] for start in range(0, len(query_pdbs), query_chunk_size)]
+    units = []
+    for chunk, chunk_query_pdbs in enumerate(query_chunks):
+        for proteome_dir in proteome_dirs:
+            for shard in range(shard_counts[proteome_dir.name]):
+                units.append({
+                    'index': len(units),
+                    'chunk': chunk,
+                    'queries': [str(query_pdb) for query_pdb in chunk_query_pdbs],
+                    'proteome_dir': str(proteome_dir),
+                    'shard': shard,
+                })
+    return units
+
+
+def write_cluster_plan(cluster_dir, plan):
+    # Unit results are kept when the same screen is planned again, so a resubmission only runs the missing units,
+    # a different plan starts over because its unit indices mean other units
+    plan_file = Path(cluster_dir) / PLAN_FILE_NAME
+    plan_content = json.dumps(dict(plan, version=PLAN_VERSION), indent=1, default=str)
+    if plan_file.exists() and plan_file.read_text() == plan_content:
+        return plan_file
+    for unit_result in (Path(cluster_dir) / 'units').glob('unit_*.csv'):
+        unit_result.unlink()
+    write_atomically(plan_file, plan_content)
+    return plan_file
+
+
+def load_cluster_plan(plan_file):
+    with open(plan_file, 'r') as f:
+        plan = json.load(f)
+    if plan.get('version') != PLAN_VERSION:
+        raise Exception(f"Cluster plan '{plan_file}' was written by another version of the search, plan the screen again.")
+    return plan
+
+
+def unit_result_path(cluster_dir, unit_index):
+    return Path(cluster_dir) / 'units' / f'unit_{unit_index}.csv'
+
+
+def save_unit_result(cluster_dir, unit_index, result_df):
+    # Written atomically, a unit only counts as finished once its result file exists
+    return write_atomically(unit_result_path(cluster_dir, unit_index), result_df.to_csv(index=False))
+
+
+def load_unit_result(cluster_dir, unit_index):
+    return pd.read_csv(unit_result_path(cluster_dir, unit_index), float_precision='round_trip')
+
+
+def missing_units(cluster_dir, units):
+    return [unit for unit in units if not unit_result_path(cluster_dir, unit['index']).exists()]
+
+
+def print_cluster_plan(plan):
+    n_chunks = len({unit['chunk'] for unit in plan['units']})
+    n_queries = sum(len(query_pdbs) for query_pdbs in {unit['chunk']: unit['queries'] for unit in plan['units']}.values())
+    print(f"{len(plan['units'])} work units: {n_queries} queries in {n_chunks} chunks x {len(plan['proteome_dirs'])} proteomes "
+          f"(up to {plan['shards']} shards each).")
+    for unit in plan['units']:
+        print(f"unit {unit['index']}: chunk {unit['chunk']} ({len(unit['queries'])} queries) x {Path(unit['proteome_dir']).name} shard {unit['shard']}")
+    return None
+
+
+def generate_cluster_script(cluster_dir, run_script, job_name, search_command):
+    # The run script template is filled like the AlphaFold2 templates, its #SBATCH lines set the resources of the units
+    with open(run_script, 'r') as f:
+        run_script_content = f.read()
+    username = os.getenv('USER') or os.getenv('USERNAME')
+    run_script_content = run_script_content.replace('my_username_VAR', username)
+    run_script_content = run_script_content.replace('my_job_name_VAR', job_name)
+    run_script_content = run_script_content.replace('my_search_command_VAR', search_command)
+
+    script_path = Path(cluster_dir) / f'run_{job_name}.sh'
+    with open(script_path, 'w') as f:
+        f.write(run_script_content)
+    return script_path
+
+
+def submit_cluster_search(cluster_dir, plan_file, units, run_script, array_throttle=None, max_array_size=1000, dry_run=False):
+    search_script = Path(__file__).resolve().parent / 'fatcat_tmalign_proteome_search.py'
+    # Paths are quoted for the shell, the task index and CPU count are expanded by it
+    search_invocation = ' '.join(shlex.quote(str(path)) for path in (sys.executable, search_script))
+    unit_command = (f'{search_invocation} --run_unit {shlex.quote(str(plan_file))} '
+                    '--unit_index $((SLURM_ARRAY_TASK_ID + ${ARRAY_OFFSET:-0})) -w ${SLURM_CPUS_PER_TASK:-1}')
+    reduce_command = f'{search_invocation} --reduce {shlex.quote(str(plan_file))}'
+    unit_script = generate_cluster_script(cluster_dir, run_script, 'search_units', unit_command)
+    reduce_script = generate_cluster_script(cluster_dir, run_script, 'search_reduce', reduce_command)
+    if dry_run:
+        print(f"Dry run, nothing submitted. The units run with {unit_script} and are merged by {reduce_script}.")
+        return None
+
+    # Units that finished in an earlier submission of the same plan are not run again
+    unit_indices = [unit['index'] for unit in missing_units(cluster_dir, units)]
+    job_ids = []
+    log_file = Path(cluster_dir) / 'logs' / 'unit_%A_%a.out'
+    for chunk_indices in chunk_array_indices(unit_indices, max_array_size):
+        # Array task ids are relative to ARRAY_OFFSET, a resubmission only lists the units that are still missing
+        task_ids = [index - chunk_indices[0] for index in chunk_indices]
+        array_range = f'0-{task_ids[-1]}' if task_ids[-1] + 1 == len(task_ids) else ','.join(str(task_id) for task_id in task_ids)
+        array_range += f'%{array_throttle}' if array_throttle else ''
+        sbatch_args = [f'--array={array_range}', f'--export=ALL,ARRAY_OFFSET={chunk_indices[0]}', f'--output={log_file}']
+        job_ids.append(submit_sbatch(str(unit_script), cluster_dir, sbatch_args))
+        print(f"Submitted array job {job_ids[-1]} for {len(chunk_indices)} work units.")
+
+    # The reduce job only needs one core and starts once every unit finished successfully
+    sbatch_args = ['--cpus-per-task=1', f"--output={Path(cluster_dir) / 'logs' / 'reduce_%j.out'}"]
+    if job_ids:
+        sbatch_args += [f"--dependency=afterok:{':'.join(job_ids)}", '--kill-on-invalid-dep=yes']
+    reduce_job_id = submit_sbatch(str(reduce_script), cluster_dir, sbatch_args)
+    print(f"Submitted reduce job {reduce_job_id}.")
+    return job_ids, reduce_job_id
+
+
+def chunk_array_indices(unit_indices, max_array_size):
+    # Slurm rejects array task ids of max_array_size or above, so a chunk spans at most max_array_size unit
+    # indices. Counting the units instead would let the gaps of a resubmission push task ids past the limit.
+    chunks = []
+    for index in unit_indices:
+        if not chunks or index - chunks[-1][0] >= max_array_size:
+            chunks.append([])
+        chunks[-1].append(index)
+    return chunks
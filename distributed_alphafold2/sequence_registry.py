@@ -0,0 +1,139 @@
+from pathlib import Path
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+from proteome_index import write_atomically
+
+# Content addressed registry of the sequences distributed to an AlphaFold2 output directory. Every normalized
+# sequence hash maps to the one canonical fasta name that is predicted and to the aliases with the same sequence,
+# which are never submitted and get the canonical result linked or copied in once it is finished.
+REGISTRY_DIR_NAME = '.sequence_registry'
+REGISTRY_FILE_NAME = 'registry.json'
+REGISTRY_VERSION = 1
+ALIAS_MODES = ('symlink', 'copy')
+
+
+def read_fasta_sequences(fasta_path):
+    sequences = []
+    with open(fasta_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                sequences.append('')
+            elif line:
+                if not sequences:
+                    sequences.append('')
+                sequences[-1] += line
+    return sequences
+
+
+def normalize_sequence(sequences):
+    # Case, whitespace and stop codons do not change the prediction; the chain order of multimers does
+    return ':'.join(''.join(sequence.split()).upper().rstrip('*') for sequence in sequences)
+
+
+def sequence_hash(fasta_path):
+    return hashlib.sha256(normalize_sequence(read_fasta_sequences(fasta_path)).encode()).hexdigest()
+
+
+def get_registry_dir(alpha_out_dir):
+    registry_dir = Path(alpha_out_dir) / REGISTRY_DIR_NAME
+    registry_dir.mkdir(parents=True, exist_ok=True)
+    return registry_dir
+
+
+def load_registry(alpha_out_dir):
+    registry_file = Path(alpha_out_dir) / REGISTRY_DIR_NAME / REGISTRY_FILE_NAME
+    if not registry_file.exists():
+        return {'version': REGISTRY_VERSION, 'sequences': {}}
+    with open(registry_file, 'r') as f:
+        registry = json.load(f)
+    if registry.get('version') != REGISTRY_VERSION:
+        raise Exception(f"Sequence registry '{registry_file}' has an unsupported version, move it away to start a new one.")
+    return registry
+
+
+def save_registry(alpha_out_dir, registry):
+    write_atomically(get_registry_dir(alpha_out_dir) / REGISTRY_FILE_NAME, json.dumps(registry, indent=1, sort_keys=True))
+
+
+def register_targets(alpha_out_dir, targets, dry_run=False):
+    # Splits targets (dicts with 'name' and 'source_fasta') into the unique ones to submit and the aliases of
+    # sequences that are already registered, either earlier in this batch or by an earlier run into alpha_out_dir
+    registry_dir = Path(alpha_out_dir) / REGISTRY_DIR_NAME
+    if dry_run and not registry_dir.exists():
+        return assign_canonicals(load_registry(alpha_out_dir), targets)
+
+    with open(get_registry_dir(alpha_out_dir) / '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        registry = load_registry(alpha_out_dir)
+        unique_targets, alias_targets = assign_canonicals(registry, targets)
+        if not dry_run:
+            save_registry(alpha_out_dir, registry)
+    return unique_targets, alias_targets
+
+
+def assign_canonicals(registry, targets):
+    sequences = registry['sequences']
+    # Sequence hash of every registered canonical and alias name, so a target only touches the entry of its own
+    # earlier sequence instead of scanning the whole registry
+    name_hashes = {name: seq_hash for seq_hash, entry in sequences.items() for name in (entry['canonical'], *entry['aliases'])}
+    unique_targets, alias_targets = [], []
+    for target in targets:
+        seq_hash = sequence_hash(target['source_fasta'])
+        target['sequence_hash'] = seq_hash
+        previous_hash = name_hashes.get(target['name'])
+        if previous_hash is not None and previous_hash != seq_hash:
+            # A name whose fasta changed since it was registered is moved to its new sequence
+            previous_entry = sequences[previous_hash]
+            if previous_entry['canonical'] != target['name']:
+                previous_entry['aliases'].remove(target['name'])
+            elif previous_entry['aliases']:
+                previous_entry['canonical'] = previous_entry['aliases'].pop(0)
+            else:
+                del sequences[previous_hash]
+        name_hashes[target['name']] = seq_hash
+
+        entry = sequences.setdefault(seq_hash, {'canonical': target['name'], 'aliases': []})
+        if entry['canonical'] == target['name']:
+            unique_targets.append(target)
+        else:
+            if previous_hash != seq_hash:
+                entry['aliases'].append(target['name'])
+            target['canonical'] = entry['canonical']
+            alias_targets.append(target)
+    return unique_targets, alias_targets
+
+
+def find_result_dir(alpha_out_dir, fasta_name, result_file='ranked_0.pdb'):
+    # AlphaFold2 writes to <output_dir>/<fasta name>/, which is <alpha_out_dir>/<name>/<name>/ for single jobs and
+    # <alpha_out_dir>/<name>/ for packed jobs
+    for result_dir in (Path(alpha_out_dir) / fasta_name / fasta_name, Path(alpha_out_dir) / fasta_name):
+        if (result_dir / result_file).exists():
+            return result_dir
+    return None
+
+
+def populate_aliases(alpha_out_dir, alias_mode='symlink'):
+    # Links or copies the result of every finished canonical sequence into the directories of its aliases
+    registry = load_registry(alpha_out_dir)
+    populated = []
+    for entry in registry['sequences'].values():
+        if not entry['aliases']:
+            continue
+        canonical_result_dir = find_result_dir(alpha_out_dir, entry['canonical'])
+        if canonical_result_dir is None:
+            continue
+        for alias in entry['aliases']:
+            alias_result_dir = Path(alpha_out_dir) / alias / alias
+            if alias_result_dir.exists() or alias_result_dir.is_symlink():
+                continue
+            alias_result_dir.parent.mkdir(parents=True, exist_ok=True)
+            if alias_mode == 'symlink':
+                os.symlink(os.path.relpath(canonical_result_dir, alias_result_dir.parent), alias_result_dir, target_is_directory=True)
+            else:
+                shutil.copytree(canonical_result_dir, alias_result_dir, symlinks=True)
+            populated.append(alias)
+    return populated
@@ -0,0 +1,129 @@
+from pathlib import Path
+import fcntl
+import numpy as np
+from proteome_index import get_index_dir
+
+# Cheap per structure descriptors used to rule out hopeless (query, structure) pairs before any alignment is run.
+# Every descriptor row holds the chain length, the radius of gyration, the helix/strand/coil fractions estimated
+# from CA geometry and a normalized histogram of CA-CA distances. The descriptors of a proteome are stored as one
+# .npy matrix next to its index (same row order as the index entries) and memory mapped when searching.
+DISTANCE_BINS = np.arange(0.0, 42.5, 2.5, dtype=np.float32)
+N_HISTOGRAM_BINS = len(DISTANCE_BINS)
+LENGTH, RADIUS_OF_GYRATION, HELIX, STRAND, COIL = range(5)
+HISTOGRAM = slice(5, 5 + N_HISTOGRAM_BINS)
+DESCRIPTOR_SIZE = 5 + N_HISTOGRAM_BINS
+MAX_HISTOGRAM_RESIDUES = 1000
+
+
+RESIDUE_CODES = {
+    'ALA': 'A', 'ARG': 'R', 'ASN': 'N', 'ASP': 'D', 'CYS': 'C', 'GLN': 'Q', 'GLU': 'E', 'GLY': 'G', 'HIS': 'H', 'ILE': 'I',
+    'LEU': 'L', 'LYS': 'K', 'MET': 'M', 'PHE': 'F', 'PRO': 'P', 'SER': 'S', 'THR': 'T', 'TRP': 'W', 'TYR': 'Y', 'VAL': 'V',
+    'MSE': 'M',
+}
+
+
+def read_ca_atoms(pdb_path):
+    # CA coordinates and one letter residue codes (as bytes, X for unknown residues) of the first model
+    coordinates = []
+    residues = []
+    with open(pdb_path, 'r') as f:
+        for line in f:
+            if line.startswith('ATOM') and line[12:16].strip() == 'CA' and line[16] in (' ', 'A'):
+                coordinates.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+                residues.append(ord(RESIDUE_CODES.get(line[17:20], 'X')))
+            elif line.startswith('ENDMDL'):
+                break
+    return np.array(coordinates, dtype=np.float32).reshape(-1, 3), np.array(residues, dtype=np.uint8)
+
+
+def read_ca_coordinates(pdb_path):
+    return read_ca_atoms(pdb_path)[0]
+
+
+def secondary_structure_fractions(coordinates):
+    # CA-only assignment in the spirit of P-SEA: helices and strands have characteristic i->i+2, i->i+3 and
+    # i->i+4 CA distances
+    n_residues = len(coordinates)
+    if n_residues < 5:
+        return 0.0, 0.0, 1.0
+    d2 = np.linalg.norm(coordinates[2:] - coordinates[:-2], axis=1)[:n_residues - 4]
+    d3 = np.linalg.norm(coordinates[3:] - coordinates[:-3], axis=1)[:n_residues - 4]
+    d4 = np.linalg.norm(coordinates[4:] - coordinates[:-4], axis=1)
+    helix = (np.abs(d2 - 5.5) < 0.5) & (np.abs(d3 - 5.3) < 0.5) & (np.abs(d4 - 6.4) < 0.6)
+    strand = (np.abs(d2 - 6.4) < 0.7) & (np.abs(d3 - 9.9) < 0.9) & (np.abs(d4 - 12.4) < 1.1)
+    helix_fraction = float(helix.sum()) / n_residues
+    strand_fraction = float(strand.sum()) / n_residues
+    return helix_fraction, strand_fraction, 1.0 - helix_fraction - strand_fraction
+
+
+def distance_histogram(coordinates):
+    if len(coordinates) > MAX_HISTOGRAM_RESIDUES:
+        coordinates = coordinates[np.linspace(0, len(coordinates) - 1, MAX_HISTOGRAM_RESIDUES).astype(int)]
+    if len(coordinates) < 2:
+        return np.zeros(N_HISTOGRAM_BINS, dtype=np.float32)
+    distances = np.linalg.norm(coordinates[:, None, :] - coordinates[None, :, :], axis=-1)
+    distances = distances[np.triu_indices(len(coordinates), k=1)]
+    # Distances beyond the last bin edge are counted in the last bin
+    counts = np.bincount(np.minimum(np.digitize(distances, DISTANCE_BINS) - 1, N_HISTOGRAM_BINS - 1), minlength=N_HISTOGRAM_BINS)
+    return (counts / counts.sum()).astype(np.float32)
+
+
+def compute_descriptor(pdb_path):
+    coordinates = read_ca_coordinates(pdb_path)
+    descriptor = np.zeros(DESCRIPTOR_SIZE, dtype=np.float32)
+    descriptor[LENGTH] = len(coordinates)
+    if len(coordinates):
+        descriptor[RADIUS_OF_GYRATION] = np.sqrt(((coordinates - coordinates.mean(axis=0)) ** 2).sum(axis=1).mean())
+    descriptor[HELIX], descriptor[STRAND], descriptor[COIL] = secondary_structure_fractions(coordinates)
+    descriptor[HISTOGRAM] = distance_histogram(coordinates)
+    return descriptor
+
+
+def get_proteome_descriptors(proteome_dir, index):
+    descriptor_file = get_index_dir(proteome_dir) / f"descriptors_{index['fingerprint'][:16]}.npy"
+    if not descriptor_file.exists():
+        with open(descriptor_file.parent / '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not descriptor_file.exists():
+                descriptors = np.zeros((len(index['entries']), DESCRIPTOR_SIZE), dtype=np.float32)
+                for row, entry in enumerate(index['entries']):
+                    descriptors[row] = compute_descriptor(Path(proteome_dir) / entry['file'])
+                for stale_descriptor_file in descriptor_file.parent.glob('descriptors_*.npy'):
+                    stale_descriptor_file.unlink()
+                tmp_file = descriptor_file.parent / f'.{descriptor_file.stem}.tmp.npy'
+                np.save(tmp_file, descriptors)
+                tmp_file.replace(descriptor_file)
+    return np.load(descriptor_file, mmap_mode='r')
+
+
+def descriptor_similarity(query_descriptor, descriptors):
+    # Histogram intersection of the CA distance fingerprints, 1 for identical distance distributions
+    return np.minimum(descriptors[:, HISTOGRAM], query_descriptor[HISTOGRAM]).sum(axis=1)
+
+
+def length_ratio(query_descriptor, descriptors):
+    lengths = descriptors[:, LENGTH]
+    return np.minimum(lengths, query_descriptor[LENGTH]) / np.maximum(np.maximum(lengths, query_descriptor[LENGTH]), 1)
+
+
+def radius_of_gyration_ratio(query_descriptor, descriptors):
+    radii = descriptors[:, RADIUS_OF_GYRATION]
+    return np.minimum(radii, query_descriptor[RADIUS_OF_GYRATION]) / np.maximum(np.maximum(radii, query_descriptor[RADIUS_OF_GYRATION]), 1e-6)
+
+
+def secondary_structure_distance(query_descriptor, descriptors):
+    # Fraction of residues whose helix/strand/coil state would have to change, 0 for the same composition
+    return 0.5 * np.abs(descriptors[:, HELIX:COIL + 1] - query_descriptor[HELIX:COIL + 1]).sum(axis=1)
+
+
+def prefilter_candidates(query_descriptor, descriptors, db_entries, min_length_ratio=None, min_similarity=None, min_rg_ratio=None, max_ss_distance=None):
+    keep = np.ones(len(db_entries), dtype=bool)
+    if min_length_ratio is not None:
+        keep &= length_ratio(query_descriptor, descriptors) >= min_length_ratio
+    if min_rg_ratio is not None:
+        keep &= radius_of_gyration_ratio(query_descriptor, descriptors) >= min_rg_ratio
+    if max_ss_distance is not None:
+        keep &= secondary_structure_distance(query_descriptor, descriptors) <= max_ss_distance
+    if min_similarity is not None:
+        keep &= descriptor_similarity(query_descriptor, descriptors) >= min_similarity
+    return [db_entries[row] for row in np.flatnonzero(keep)]
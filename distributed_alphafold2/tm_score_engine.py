@@ -0,0 +1,279 @@
+from pathlib import Path
+import fcntl
+import numpy as np
+from proteome_index import get_index_dir
+from structure_descriptors import read_ca_atoms
+
+# In process TM-score engine, an alternative to starting a USalign run for every TM-Align search. The CA atoms of a
+# proteome are read once and cached as .npy arrays next to its index (coordinates and residue codes of all
+# structures back to back, with the offset of every structure), and every query is scored against the structures
+# with batched, vectorized Kabsch superpositions. The residue correspondence is not found by dynamic programming
+# like in TM-align: every gapless threading of the two chains that aligns at least half of the shorter one is
+# scored (this includes the fixed residue number correspondence of models of the same sequence), and the best
+# threadings are refined with the TM-score superposition search of TM-align. The scores are estimates, they match
+# USalign for structures that align without gaps and are a lower bound for alignments that need gaps.
+TM_ENGINES = ('usalign', 'numpy')
+TM_ENGINE_VERSION = 1
+CACHE_PARTS = ('coordinates', 'residues', 'offsets')
+# Threadings of every target refined with the TM-score search, and the rounds of that search
+N_SEED_SHIFTS = 3
+N_ITERATIONS = 6
+# Fragments of an alignment the TM-score search starts from, as (start, length) fractions of the aligned pairs
+SEED_FRAGMENTS = np.array([(0, 1), (0, 0.5), (0.25, 0.5), (0.5, 0.5), (0, 0.25), (0.25, 0.25), (0.5, 0.25), (0.75, 0.25)])
+MIN_SEED_PAIRS = 4
+# Upper bound of aligned pairs held at once by a batch, which keeps a batch at a few hundred MB
+MAX_BATCH_PAIRS = 2 ** 20
+
+
+def get_cache_files(proteome_dir, index):
+    index_dir = get_index_dir(proteome_dir)
+    return [index_dir / f"ca_{part}_{index['fingerprint'][:16]}.npy" for part in CACHE_PARTS]
+
+
+def get_proteome_ca_cache(proteome_dir, index):
+    # Built once per fingerprint under the index lock (same row order as the index entries), caches of earlier
+    # fingerprints are removed
+    cache_files = get_cache_files(proteome_dir, index)
+    if not all(cache_file.exists() for cache_file in cache_files):
+        index_dir = cache_files[0].parent
+        with open(index_dir / '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not all(cache_file.exists() for cache_file in cache_files):
+                structures = [read_ca_atoms(Path(proteome_dir) / entry['file']) for entry in index['entries']]
+                offsets = np.zeros(len(structures) + 1, dtype=np.int64)
+                offsets[1:] = np.cumsum([len(coordinates) for coordinates, _ in structures])
+                cache = {
+                    'coordinates': np.concatenate([coordinates for coordinates, _ in structures] + [np.zeros((0, 3), dtype=np.float32)]),
+                    'residues': np.concatenate([residues for _, residues in structures] + [np.zeros(0, dtype=np.uint8)]),
+                    'offsets': offsets,
+                }
+                for stale_cache_file in index_dir.glob('ca_*.npy'):
+                    if stale_cache_file not in cache_files:
+                        stale_cache_file.unlink()
+                for part, cache_file in zip(CACHE_PARTS, cache_files):
+                    tmp_file = index_dir / f'.{cache_file.stem}.tmp.npy'
+                    np.save(tmp_file, cache[part])
+                    tmp_file.replace(cache_file)
+    return [np.load(cache_file, mmap_mode='r') for cache_file in cache_files]
+
+
+def load_proteome_targets(proteome_dir, index, db_names):
+    # (file name, CA coordinates, residue codes) of the structures named in a database list, in its order
+    coordinates, residues, offsets = get_proteome_ca_cache(proteome_dir, index)
+    rows = {entry['name']: row for row, entry in enumerate(index['entries'])}
+    targets = []
+    for name in db_names:
+        row = rows[name]
+        start, stop = offsets[row], offsets[row + 1]
+        targets.append((index['entries'][row]['file'], np.asarray(coordinates[start:stop], dtype=np.float64), np.asarray(residues[start:stop])))
+    return targets
+
+
+def tm_d0(length):
+    # d0 of the TM-score normalized by this length, as in TM-align
+    length = np.asarray(length, dtype=np.float64)
+    return np.maximum(np.where(length > 21, 1.24 * np.cbrt(np.maximum(length - 15, 0)) - 1.8, 0.5), 0.5)
+
+
+def search_cutoff(d0):
+    return np.clip(d0, 4.5, 8.0)
+
+
+def superpose(x, y, weights):
+    # Weighted Kabsch for a batch of (P, 3) point sets, returns the rotations and translations moving every x onto its y
+    weight_sums = np.maximum(weights.sum(axis=1), 1e-12)[:, None]
+    x_centers = (weights[:, None] @ x)[:, 0] / weight_sums
+    y_centers = (weights[:, None] @ y)[:, 0] / weight_sums
+    covariances = np.swapaxes(x, 1, 2) @ (weights[..., None] * y) - weight_sums[..., None] * x_centers[:, :, None] * y_centers[:, None, :]
+    return kabsch_rotations(covariances, x_centers, y_centers)
+
+
+def kabsch_rotations(covariances, x_centers, y_centers):
+    u, _, vt = np.linalg.svd(covariances)
+    # Reflections are turned into proper rotations by flipping the axis of the smallest singular value
+    signs = np.where(np.linalg.det(u @ vt) < 0, -1.0, 1.0)
+    vt[:, 2] *= signs[:, None]
+    rotations = np.swapaxes(vt, 1, 2) @ np.swapaxes(u, 1, 2)
+    translations = y_centers - (rotations @ x_centers[..., None])[..., 0]
+    return rotations, translations
+
+
+def threading_superpositions(query, target, shifts):
+    # Superpositions on all pairs of every threading from running sums and cross correlations of the coordinates,
+    # without gathering the pairs
+    starts = np.maximum(0, -shifts)
+    stops = np.minimum(len(query), len(target) - shifts)
+    n_pairs = (stops - starts)[:, None]
+    query_sums = np.concatenate([np.zeros((1, 3)), np.cumsum(query, axis=0)])
+    target_sums = np.concatenate([np.zeros((1, 3)), np.cumsum(target, axis=0)])
+    x_sums = query_sums[stops] - query_sums[starts]
+    y_sums = target_sums[stops + shifts] - target_sums[starts + shifts]
+    # products[:, m, n] is the sum of query[i, m] * target[i + shift, n] over the pairs of each threading
+    lags = shifts + len(query) - 1
+    products = np.empty((len(shifts), 3, 3))
+    for m in range(3):
+        for n in range(3):
+            products[:, m, n] = np.correlate(target[:, n], query[:, m], 'full')[lags]
+    covariances = products - x_sums[:, :, None] * y_sums[:, None, :] / n_pairs[..., None]
+    return kabsch_rotations(covariances, x_sums / n_pairs, y_sums / n_pairs)
+
+
+def pair_distances(x, y, rotations, translations):
+    differences = x @ np.swapaxes(rotations, 1, 2) + (translations[:, None] - y)
+    return np.sqrt(np.einsum('bpi,bpi->bp', differences, differences))
+
+
+def tm_scores(distances, valid, d0, norm_length):
+    d0 = np.reshape(d0, (-1, 1))
+    return (valid / (1 + (distances / d0) ** 2)).sum(axis=1) / np.reshape(norm_length, -1)
+
+
+def close_pairs(distances, valid, cutoff):
+    # Pairs within the cutoff, and at least the three closest pairs so the next superposition is defined
+    masked = np.where(valid, distances, np.inf)
+    third = min(2, masked.shape[1] - 1)
+    third_distances = np.partition(masked, third, axis=1)[:, third]
+    return (valid & (masked <= np.maximum(cutoff, third_distances)[:, None])).astype(np.float64)
+
+
+def threading_alignments(query_length, target_length, shifts, width):
+    # Query residue i is aligned to target residue i + shift, the rows are padded to width pairs
+    starts = np.maximum(0, -shifts)
+    lengths = np.minimum(query_length, target_length - shifts) - starts
+    positions = np.arange(width)
+    valid = positions[None] < lengths[:, None]
+    query_index = np.where(valid, starts[:, None] + positions[None], 0)
+    target_index = np.where(valid, query_index + shifts[:, None], 0)
+    return query_index, target_index, valid
+
+
+def threading_scores(query, target, d0, cutoff):
+    # Coarse TM-scores of every gapless threading that aligns at least half of the shorter chain, each from a
+    # superposition on all of its pairs and one on its close pairs
+    min_length = min(len(query), len(target))
+    min_aligned = min(max(min_length // 2, 5), min_length)
+    shifts = np.arange(min_aligned - len(query), len(target) - min_aligned + 1)
+    scores = np.empty(len(shifts))
+    step = max(1, MAX_BATCH_PAIRS // min_length)
+    for start in range(0, len(shifts), step):
+        query_index, target_index, valid = threading_alignments(len(query), len(target), shifts[start:start + step], min_length)
+        x, y = query[query_index], target[target_index]
+        rotations, translations = threading_superpositions(query, target, shifts[start:start + step])
+        distances = pair_distances(x, y, rotations, translations)
+        best_scores = tm_scores(distances, valid, d0, min_length)
+        rotations, translations = superpose(x, y, close_pairs(distances, valid, cutoff))
+        distances = pair_distances(x, y, rotations, translations)
+        scores[start:start + step] = np.maximum(best_scores, tm_scores(distances, valid, d0, min_length))
+    return shifts, scores
+
+
+def tm_score_search(x, y, valid, d0, cutoff, norm_length):
+    # TM-score search of TM-align on fixed alignments: superpositions seeded from the whole alignment and from
+    # fragments of it, each improved by superposing the pairs closer than the cutoff. Returns the best TM-score
+    # of every alignment with its rotation and translation
+    n_alignments, width = valid.shape
+    n_seeds = len(SEED_FRAGMENTS)
+    n_pairs = valid.sum(axis=1)
+    starts = np.floor(SEED_FRAGMENTS[:, 0][None] * n_pairs[:, None]).astype(np.int64)
+    lengths = np.maximum(np.floor(SEED_FRAGMENTS[:, 1][None] * n_pairs[:, None]).astype(np.int64), MIN_SEED_PAIRS)
+    positions = np.arange(width)[None, None]
+    seeds = (positions >= starts[..., None]) & (positions < (starts + lengths)[..., None]) & valid[:, None]
+    # Fragments too short to superpose start from the whole alignment
+    seeds = np.where(seeds.sum(axis=2, keepdims=True) >= 3, seeds, valid[:, None])
+
+    x, y, valid = np.repeat(x, n_seeds, axis=0), np.repeat(y, n_seeds, axis=0), np.repeat(valid, n_seeds, axis=0)
+    d0, cutoff, norm_length = np.repeat(d0, n_seeds), np.repeat(cutoff, n_seeds), np.repeat(norm_length, n_seeds)
+    weights = seeds.reshape(-1, width).astype(np.float64)
+    best_scores = np.full(len(valid), -1.0)
+    best_rotations = np.zeros((len(valid), 3, 3))
+    best_translations = np.zeros((len(valid), 3))
+    for _ in range(N_ITERATIONS):
+        rotations, translations = superpose(x, y, weights)
+        distances = pair_distances(x, y, rotations, translations)
+        scores = tm_scores(distances, valid, d0, norm_length)
+        better = scores > best_scores
+        best_scores[better], best_rotations[better], best_translations[better] = scores[better], rotations[better], translations[better]
+        weights = close_pairs(distances, valid, cutoff)
+
+    best = np.arange(n_alignments) * n_seeds + best_scores.reshape(n_alignments, n_seeds).argmax(axis=1)
+    return best_scores[best], best_rotations[best], best_translations[best]
+
+
+def refine_alignments(alignments, d0, cutoff, norm_length):
+    # Runs the TM-score search on (x, y) aligned pairs in batches of similar length, so little of a batch is padding
+    scores = np.zeros(len(alignments))
+    rotations = np.zeros((len(alignments), 3, 3))
+    translations = np.zeros((len(alignments), 3))
+    order = np.argsort([len(x) for x, _ in alignments], kind='stable')
+    start = 0
+    while start < len(order):
+        # Sorted by length, the last alignment of a batch is its widest
+        stop = start + 1
+        while stop < len(order) and (stop - start + 1) * len(alignments[order[stop]][0]) * len(SEED_FRAGMENTS) <= MAX_BATCH_PAIRS:
+            stop += 1
+        batch = order[start:stop]
+        width = len(alignments[batch[-1]][0])
+        x, y = np.zeros((len(batch), width, 3)), np.zeros((len(batch), width, 3))
+        valid = np.zeros((len(batch), width), dtype=bool)
+        for row, alignment in enumerate(batch):
+            n_pairs = len(alignments[alignment][0])
+            x[row, :n_pairs], y[row, :n_pairs] = alignments[alignment]
+            valid[row, :n_pairs] = True
+        scores[batch], rotations[batch], translations[batch] = tm_score_search(x, y, valid, d0[batch], cutoff[batch], norm_length[batch])
+        start = stop
+    return scores, rotations, translations
+
+
+def score_query(query, query_residues, targets):
+    # Scores the query CA atoms against every (file, coordinates, residues) target, returns the TM1, TM2, RMSD,
+    # ID1, ID2, IDali, L1, L2 and Lali columns of USalign -outfmt 2 for every target (None for structures with
+    # fewer than three residues, which USalign cannot align either)
+    query = np.asarray(query, dtype=np.float64)
+    rows = [None] * len(targets)
+    if len(query) < 3:
+        return rows
+
+    # The best threadings of every target are refined with the d0 of the shorter chain, like TM-align searches
+    candidates = []
+    for position, (_, target, _) in enumerate(targets):
+        if len(target) < 3:
+            continue
+        d0 = tm_d0(min(len(query), len(target)))
+        shifts, scores = threading_scores(query, target, d0, search_cutoff(d0))
+        for shift in shifts[np.argsort(-scores, kind='stable')[:N_SEED_SHIFTS]]:
+            query_index = np.arange(max(0, -shift), min(len(query), len(target) - shift))
+            candidates.append((position, query_index, query_index + shift))
+    if not candidates:
+        return rows
+    alignments = [(query[query_index], targets[position][1][target_index]) for position, query_index, target_index in candidates]
+    min_lengths = np.array([min(len(query), len(targets[position][1])) for position, _, _ in candidates], dtype=np.float64)
+    scores, rotations, translations = refine_alignments(alignments, tm_d0(min_lengths), search_cutoff(tm_d0(min_lengths)), min_lengths)
+    best = {}
+    for candidate, (position, _, _) in enumerate(candidates):
+        if position not in best or scores[candidate] > scores[best[position]]:
+            best[position] = candidate
+    chosen = [best[position] for position in sorted(best)]
+
+    # TM1 and TM2 get their own superpositions of the chosen alignment, normalized by the query and target length
+    chosen_alignments = [alignments[candidate] for candidate in chosen]
+    query_lengths = np.full(len(chosen), len(query), dtype=np.float64)
+    target_lengths = np.array([len(targets[candidates[candidate][0]][1]) for candidate in chosen], dtype=np.float64)
+    tm1, _, _ = refine_alignments(chosen_alignments, tm_d0(query_lengths), search_cutoff(tm_d0(query_lengths)), query_lengths)
+    tm2, _, _ = refine_alignments(chosen_alignments, tm_d0(target_lengths), search_cutoff(tm_d0(target_lengths)), target_lengths)
+
+    for row, candidate in enumerate(chosen):
+        position, query_index, target_index = candidates[candidate]
+        x, y = alignments[candidate]
+        # Like TM-align, the aligned length, RMSD and identities count the pairs within the search distance
+        distances = pair_distances(x[None], y[None], rotations[candidate][None], translations[candidate][None])[0]
+        close = distances <= 1.5 * min_lengths[candidate] ** 0.3 + 3.5
+        n_aligned = int(close.sum())
+        rmsd = 0.0
+        if n_aligned >= 3:
+            close_rotations, close_translations = superpose(x[close][None], y[close][None], np.ones((1, n_aligned)))
+            rmsd = float(np.sqrt((pair_distances(x[close][None], y[close][None], close_rotations, close_translations)[0] ** 2).mean()))
+        n_identical = int((query_residues[query_index][close] == targets[position][2][target_index][close]).sum())
+        rows[position] = (round(float(tm1[row]), 4), round(float(tm2[row]), 4), round(rmsd, 2), round(n_identical / len(query), 3),
+                          round(n_identical / float(target_lengths[row]), 3), round(n_identical / n_aligned, 3) if n_aligned else 0.0,
+                          len(query), int(target_lengths[row]), n_aligned)
+    return rows
@@ -0,0 +1,127 @@
+from concurrent.futures import FIRST_COMPLETED
+import os
+import asyncio
+import heapq
+import itertools
+import signal
+import subprocess
+import time
+from metrics import record_metric
+
+# Asyncio scheduler for the FATCAT and TM-Align runs. The tools run as subprocesses of the main process, so their
+# number can be capped per tool (FATCAT is a Perl driver spawning many short lived children, USalign one long CPU
+# bound process) and every run can be pinned to its own core. Waiting runs of a tool start largest first, so the
+# biggest proteomes do not end up as stragglers at the end of the screen. Every tool runs in its own session, when
+# the search is interrupted the whole process group of every running tool is stopped before the scheduler returns.
+SCHEDULERS = ('pool', 'asyncio')
+
+
+def schedule_tool_runs(tasks, run_task, collect, workers, tool_workers=None, task_size=None, pin_cpus=False):
+    # run_task(task, cpus) is a coroutine returning (task, aln_info), collect(task, aln_info) returns the follow up
+    # tasks and the finished results like for execute_search_tasks
+    tool_workers = tool_workers or {}
+    task_size = task_size or (lambda task: 0)
+    free_cpus = sorted(os.sched_getaffinity(0)) if pin_cpus else None
+    if pin_cpus:
+        # Every running tool gets a core of its own, so there are never more runs than cores
+        workers = min(workers, len(free_cpus))
+    loop = asyncio.new_event_loop()
+    waiting = {}
+    tool_running = {}
+    running = {}
+    order = itertools.count()
+
+    def add_task(task):
+        heapq.heappush(waiting.setdefault(task['tool'], []), (-task_size(task), next(order), task))
+
+    def start_tasks():
+        while len(running) < workers:
+            ready_tools = [tool for tool, queue in waiting.items() if queue and tool_running.get(tool, 0) < tool_workers.get(tool, workers)]
+            if not ready_tools:
+                return None
+            # The largest waiting task among the tools that still have a free slot
+            tool = min(ready_tools, key=lambda tool: waiting[tool][0][:2])
+            _, _, task = heapq.heappop(waiting[tool])
+            cpus = {free_cpus.pop(0)} if pin_cpus else None
+            running[loop.create_task(run_task(task, cpus))] = (tool, cpus)
+            tool_running[tool] = tool_running.get(tool, 0) + 1
+        return None
+
+    try:
+        for task in tasks:
+            add_task(task)
+        start_tasks()
+        while running:
+            done, _ = loop.run_until_complete(asyncio.wait(running, return_when=FIRST_COMPLETED))
+            finished = []
+            for future in done:
+                tool, cpus = running.pop(future)
+                tool_running[tool] -= 1
+                if cpus:
+                    free_cpus.extend(cpus)
+                follow_up_tasks, future_finished = collect(*future.result())
+                for task in follow_up_tasks:
+                    add_task(task)
+                finished += future_finished
+            # Freed slots are filled before the finished results are handed out and written
+            start_tasks()
+            yield from finished
+    finally:
+        # Reached on Ctrl-C, on errors and when the caller stops early, the cancelled runs stop their tools
+        for future in running:
+            future.cancel()
+        if running:
+            loop.run_until_complete(asyncio.gather(*running, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+
+
+async def run_tool_process(invocation, task_dir, tool_name, result_file, stream_output=False, raw_output_file=None, cpus=None):
+    # Without stream_output the output goes to result_file, with it the output lines are returned (and only
+    # written to raw_output_file on request), like run_tool_to_file and stream_tool_output
+    started = time.perf_counter()
+    preexec_fn = (lambda: os.sched_setaffinity(0, cpus)) if cpus else None
+    stderr_path = task_dir / f'{tool_name.lower()}_stderr.log'
+    output_path = raw_output_file if stream_output else result_file
+    with open(stderr_path, 'w+') as stderr_file:
+        output_file = open(output_path, 'w') if output_path is not None else None
+        try:
+            process = await asyncio.create_subprocess_exec(*invocation, stdout=subprocess.PIPE if stream_output else output_file, stderr=stderr_file,
+                                                           cwd=task_dir, start_new_session=True, preexec_fn=preexec_fn)
+            lines = []
+            try:
+                if stream_output:
+                    async for line in process.stdout:
+                        lines.append(line.decode())
+                        if output_file is not None:
+                            output_file.write(lines[-1])
+                return_code = await process.wait()
+            except BaseException:
+                await stop_process_group(process)
+                raise
+        finally:
+            if output_file is not None:
+                output_file.close()
+
+        record_metric('subprocess', time.perf_counter() - started, returncode=return_code, tool=tool_name, task_dir=task_dir,
+                      streamed=stream_output, cpus=sorted(cpus) if cpus else None)
+        if return_code != 0:
+            stderr_file.seek(0)
+            print(f"An error occurred while running {tool_name} search: {stderr_file.read()}")
+            raise subprocess.CalledProcessError(return_code, invocation)
+    return lines
+
+
+async def stop_process_group(process, grace_seconds=5):
+    # The tool leads its own process group, which also holds everything it spawned
+    for stop_signal in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, stop_signal)
+        except ProcessLookupError:
+            pass
+        try:
+            await asyncio.wait_for(process.wait(), grace_seconds)
+            return None
+        except asyncio.TimeoutError:
+            continue
+    return None
@@ -0,0 +1,101 @@
+from pathlib import Path
+import os
+import sys
+import random
+import pytest
+
+# The scripts import each other by module name, as when they are run from distributed_alphafold2/
+SCRIPT_DIR = Path(__file__).resolve().parent.parent / 'distributed_alphafold2'
+sys.path.insert(0, str(SCRIPT_DIR))
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+# sbatch logs every call and prints job ids counting up from 1000. It rejects as many submissions as the reject
+# file says, and with SLURM_STUB_RUN set it runs the submitted script right away, array tasks one after the other.
+SBATCH_STUB = f'''#!{sys.executable}
+import os, sys, subprocess
+stub_dir = os.environ['SLURM_STUB_DIR']
+args = sys.argv[1:]
+reject_file = os.path.join(stub_dir, 'reject')
+if os.path.exists(reject_file):
+    with open(reject_file) as f:
+        n_rejects = int(f.read())
+    if n_rejects > 0:
+        with open(reject_file, 'w') as f:
+            f.write(str(n_rejects - 1))
+        sys.exit('sbatch: error: QOSMaxSubmitJobPerUserLimit')
+log_file = os.path.join(stub_dir, 'sbatch.log')
+job_id = 1000 + (sum(1 for _ in open(log_file)) if os.path.exists(log_file) else 0)
+with open(log_file, 'a') as f:
+    f.write(os.getcwd() + '\\t' + '\\t'.join(args) + '\\n')
+
+if os.environ.get('SLURM_STUB_RUN'):
+    env = dict(os.environ)
+    tasks = [None]
+    for arg in args[:-1]:
+        if arg.startswith('--array='):
+            tasks = []
+            for part in arg.split('=', 1)[1].split('%')[0].split(','):
+                first, _, last = part.partition('-')
+                tasks += range(int(first), int(last or first) + 1)
+        if arg.startswith('--export=') and 'ARRAY_OFFSET=' in arg:
+            env['ARRAY_OFFSET'] = arg.split('ARRAY_OFFSET=')[1].split(',')[0]
+    for task in tasks:
+        if task is not None:
+            env['SLURM_ARRAY_TASK_ID'] = str(task)
+        completed = subprocess.run(['bash', args[-1]], env=env, capture_output=True, text=True)
+        if completed.returncode:
+            sys.exit(completed.stdout + completed.stderr)
+print(job_id)
+'''
+
+# squeue and sacct print what the test wrote to squeue.txt and sacct.txt
+QUERY_STUB = f'''#!{sys.executable}
+import os, sys
+output_file = os.path.join(os.environ['SLURM_STUB_DIR'], os.path.basename(sys.argv[0]) + '.txt')
+if os.path.exists(output_file):
+    sys.stdout.write(open(output_file).read())
+'''
+
+
+def write_executable(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    os.chmod(path, 0o755)
+    return path
+
+
+@pytest.fixture
+def slurm(tmp_path, monkeypatch):
+    stub_dir = tmp_path / 'slurm'
+    for command, content in (('sbatch', SBATCH_STUB), ('squeue', QUERY_STUB), ('sacct', QUERY_STUB)):
+        write_executable(stub_dir / 'bin' / command, content)
+    monkeypatch.setenv('PATH', f"{stub_dir / 'bin'}{os.pathsep}{os.environ.get('PATH', '')}")
+    monkeypatch.setenv('SLURM_STUB_DIR', str(stub_dir))
+    monkeypatch.setenv('USER', 'tester')
+    return stub_dir
+
+
+def sbatch_calls(stub_dir):
+    # (working directory, sbatch arguments) of every accepted submission
+    log_file = stub_dir / 'sbatch.log'
+    if not log_file.exists():
+        return []
+    return [(fields[0], fields[1:]) for fields in (line.rstrip('\n').split('\t') for line in open(log_file))]
+
+
+@pytest.fixture
+def fasta_dir(tmp_path):
+    fasta_dir = tmp_path / 'fasta'
+    fasta_dir.mkdir()
+    rng = random.Random(0)
+    for i in range(3):
+        sequence = ''.join(rng.choice(AMINO_ACIDS) for _ in range(rng.randint(50, 300)))
+        (fasta_dir / f'target_{i:06d}.fasta').write_text(f'>target_{i:06d}\n{sequence}\n')
+    return fasta_dir
+
+
+@pytest.fixture
+def sif_file(tmp_path):
+    sif_file = tmp_path / 'alphafold.sif'
+    sif_file.touch()
+    return sif_file
@@ -0,0 +1,48 @@
+import json
+from copy_alphafold_output_to_query_dir import copy_alphafold_output_to_query_dir, PLDDT_FILE_NAME
+
+MONOMER_RANKING = {'plddts': {'model_1_pred_0': 71.5, 'model_2_pred_0': 88.25}, 'order': ['model_2_pred_0', 'model_1_pred_0']}
+MULTIMER_RANKING = {'iptm+ptm': {'model_1_multimer_v3_pred_0': 0.41, 'model_4_multimer_v3_pred_0': 0.83},
+                    'order': ['model_4_multimer_v3_pred_0', 'model_1_multimer_v3_pred_0']}
+
+
+def write_model(model_path, plddts):
+    with open(model_path, 'w') as f:
+        for residue, plddt in enumerate(plddts, start=1):
+            f.write(f"ATOM  {residue:>5}  CA  ALA A{residue:>4}    {residue:>8.3f}{0:>8.3f}{0:>8.3f}  1.00{plddt:>6.2f}           C\n")
+        f.write('END\n')
+
+
+def write_prediction(alpha_out_dir, name, ranking, plddts):
+    model_dir = alpha_out_dir / name / name
+    model_dir.mkdir(parents=True)
+    write_model(model_dir / 'ranked_0.pdb', plddts)
+    write_model(model_dir / f"relaxed_{ranking['order'][0]}.pdb", plddts)
+    (model_dir / 'ranking_debug.json').write_text(json.dumps(ranking))
+
+
+def read_sidecar(query_file_dir):
+    lines = (query_file_dir / PLDDT_FILE_NAME).read_text().splitlines()
+    return {line.split(',')[0]: line.split(',')[1:] for line in lines[1:]}
+
+
+def test_plddt_sidecar_of_monomer_and_multimer_models(tmp_path):
+    # Multimer rankings have no pLDDTs, their mean pLDDT is read from the B-factors of the CA atoms
+    alpha_out_dir, query_file_dir = tmp_path / 'out', tmp_path / 'query'
+    write_prediction(alpha_out_dir, 'monomer', MONOMER_RANKING, [80.0, 90.0])
+    write_prediction(alpha_out_dir, 'multimer', MULTIMER_RANKING, [60.0, 70.0])
+
+    for select_model in ('ranked_0', 'ranking_debug'):
+        copy_alphafold_output_to_query_dir(query_file_dir, alpha_out_dir, select_model=select_model, plddt_sidecar=True)
+        assert read_sidecar(query_file_dir) == {'monomer': ['model_2_pred_0', '88.25', '88.25'],
+                                                'multimer': ['model_4_multimer_v3_pred_0', '65.0', '0.83']}
+        assert (query_file_dir / 'multimer.pdb').read_text() == (alpha_out_dir / 'multimer' / 'multimer' / 'ranked_0.pdb').read_text()
+
+
+def test_plddt_sidecar_without_ranking(tmp_path):
+    alpha_out_dir, query_file_dir = tmp_path / 'out', tmp_path / 'query'
+    (alpha_out_dir / 'target' / 'target').mkdir(parents=True)
+    write_model(alpha_out_dir / 'target' / 'target' / 'ranked_0.pdb', [50.0, 75.0])
+
+    copy_alphafold_output_to_query_dir(query_file_dir, alpha_out_dir, plddt_sidecar=True)
+    assert read_sidecar(query_file_dir) == {'target': ['ranked_0', '62.5', '62.5']}
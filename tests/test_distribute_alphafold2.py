@@ -0,0 +1,178 @@
+import os
+import sys
+import subprocess
+from conftest import SCRIPT_DIR, sbatch_calls
+import distribute_alphafold2
+from distribute_alphafold2 import distribute_alphafold_to_all_fasta_files
+from job_ledger import open_ledger, get_targets
+
+RUN_SCRIPT = str(SCRIPT_DIR / 'run.sh')
+FEATURE_SCRIPT = str(SCRIPT_DIR / 'run_features.sh')
+INFERENCE_SCRIPT = str(SCRIPT_DIR / 'run_inference.sh')
+TARGETS = ['target_000000', 'target_000001', 'target_000002']
+
+
+def distribute(fasta_dir, alpha_out_dir, sif_file, run_script=RUN_SCRIPT, **submission_settings):
+    return distribute_alphafold_to_all_fasta_files(str(fasta_dir), str(alpha_out_dir), False, str(sif_file), run_script, os.getcwd(), **submission_settings)
+
+
+def run_distribute(*args):
+    return subprocess.run([sys.executable, str(SCRIPT_DIR / 'distribute_alphafold2.py'), *args], capture_output=True, text=True)
+
+
+def ledger_rows(alpha_out_dir):
+    return {row['name']: dict(row) for row in get_targets(open_ledger(alpha_out_dir))}
+
+
+def test_batch_submission(slurm, fasta_dir, sif_file, tmp_path):
+    alpha_out_dir = tmp_path / 'out'
+    distribute(fasta_dir, alpha_out_dir, sif_file)
+
+    assert sbatch_calls(slurm) == [(str(alpha_out_dir / name), ['--parsable', f'run_{name}.sh']) for name in TARGETS]
+    run_script = (alpha_out_dir / TARGETS[0] / f'run_{TARGETS[0]}.sh').read_text()
+    assert 'tester@asu.edu' in run_script and f'FASTA_FILE={TARGETS[0]}.fasta' in run_script
+
+
+def test_array_submission(slurm, fasta_dir, sif_file, tmp_path):
+    alpha_out_dir = tmp_path / 'out'
+    distribute(fasta_dir, alpha_out_dir, sif_file, array=True, array_throttle=4, max_array_size=2)
+
+    calls = sbatch_calls(slurm)
+    assert [call[1][:3] for call in calls] == [['--parsable', '--array=0-1%4', '--export=ALL,ARRAY_OFFSET=0'],
+                                               ['--parsable', '--array=0-0%4', '--export=ALL,ARRAY_OFFSET=2']]
+    assert all(call[0] == str(alpha_out_dir) and call[1][-1] == str(alpha_out_dir / 'run_alphafold_array.sh') for call in calls)
+    manifest = (alpha_out_dir / 'array_manifest.tsv').read_text().splitlines()
+    assert [line.split('\t')[:2] for line in manifest] == [[str(task), f'{name}.fasta'] for task, name in enumerate(TARGETS)]
+    array_script = (alpha_out_dir / 'run_alphafold_array.sh').read_text()
+    assert 'ARRAY_INDEX=$((SLURM_ARRAY_TASK_ID + ${ARRAY_OFFSET:-0}))' in array_script
+
+
+def write_features(alpha_out_dir, name):
+    (alpha_out_dir / name / name).mkdir(parents=True)
+    (alpha_out_dir / name / name / 'features.pkl').touch()
+
+
+def test_feature_and_inference_jobs(slurm, fasta_dir, sif_file, tmp_path):
+    # Every target gets a CPU feature job and a GPU inference job that waits for it, the target whose features.pkl
+    # already exists only gets the inference job
+    alpha_out_dir = tmp_path / 'out'
+    write_features(alpha_out_dir, TARGETS[1])
+    distribute(fasta_dir, alpha_out_dir, sif_file, run_script=INFERENCE_SCRIPT, feature_script=FEATURE_SCRIPT)
+
+    work_dirs = [str(alpha_out_dir / name) for name in TARGETS]
+    assert sbatch_calls(slurm) == [
+        (work_dirs[0], ['--parsable', f'{work_dirs[0]}/run_features_{TARGETS[0]}.sh']),
+        (work_dirs[0], ['--parsable', '--dependency=afterok:1000', '--kill-on-invalid-dep=yes', f'{work_dirs[0]}/run_{TARGETS[0]}.sh']),
+        (work_dirs[1], ['--parsable', f'{work_dirs[1]}/run_{TARGETS[1]}.sh']),
+        (work_dirs[2], ['--parsable', f'{work_dirs[2]}/run_features_{TARGETS[2]}.sh']),
+        (work_dirs[2], ['--parsable', '--dependency=afterok:1003', '--kill-on-invalid-dep=yes', f'{work_dirs[2]}/run_{TARGETS[2]}.sh']),
+    ]
+    assert 'CPU stage' in (alpha_out_dir / TARGETS[0] / f'run_features_{TARGETS[0]}.sh').read_text()
+    assert 'GPU stage' in (alpha_out_dir / TARGETS[0] / f'run_{TARGETS[0]}.sh').read_text()
+    # The ledger tracks the inference jobs, they write the models
+    rows = ledger_rows(alpha_out_dir)
+    assert [rows[name]['job_id'] for name in TARGETS] == ['1001', '1002', '1004']
+
+
+def test_feature_and_inference_arrays(slurm, fasta_dir, sif_file, tmp_path):
+    # Task i of the inference array waits for task i of the feature array
+    alpha_out_dir = tmp_path / 'out'
+    write_features(alpha_out_dir, TARGETS[1])
+    distribute(fasta_dir, alpha_out_dir, sif_file, run_script=INFERENCE_SCRIPT, feature_script=FEATURE_SCRIPT, array=True)
+
+    assert sbatch_calls(slurm) == [
+        (str(alpha_out_dir), ['--parsable', '--array=0-1', '--export=ALL,ARRAY_OFFSET=0', f'{alpha_out_dir}/run_alphafold_array_features.sh']),
+        (str(alpha_out_dir), ['--parsable', '--array=0-1', '--export=ALL,ARRAY_OFFSET=0', '--dependency=aftercorr:1000', '--kill-on-invalid-dep=yes',
+                              f'{alpha_out_dir}/run_alphafold_array_inference.sh']),
+        (str(alpha_out_dir), ['--parsable', '--array=0-0', '--export=ALL,ARRAY_OFFSET=0', f'{alpha_out_dir}/run_alphafold_array_inference_precomputed.sh']),
+    ]
+    for suffix in ('features', 'inference'):
+        manifest = (alpha_out_dir / f'array_manifest_{suffix}.tsv').read_text().splitlines()
+        assert [line.split('\t')[1] for line in manifest] == [f'{TARGETS[0]}.fasta', f'{TARGETS[2]}.fasta']
+    assert 'CPU stage' in (alpha_out_dir / 'run_alphafold_array_features.sh').read_text()
+    rows = ledger_rows(alpha_out_dir)
+    assert [rows[name]['job_id'] for name in TARGETS] == ['1001_0', '1002_0', '1001_1']
+
+
+def test_ledger_records_submitted_jobs(slurm, fasta_dir, sif_file, tmp_path):
+    alpha_out_dir = tmp_path / 'out'
+    distribute(fasta_dir, alpha_out_dir, sif_file)
+    rows = ledger_rows(alpha_out_dir)
+    assert [(rows[name]['state'], rows[name]['job_id'], rows[name]['attempts']) for name in TARGETS] == \
+           [('submitted', '1000', 1), ('submitted', '1001', 1), ('submitted', '1002', 1)]
+
+    # Submitted targets are skipped when the same directory is distributed again
+    distribute(fasta_dir, alpha_out_dir, sif_file)
+    assert len(sbatch_calls(slurm)) == 3
+
+    # Array tasks are recorded as <job id>_<task id>
+    array_out_dir = tmp_path / 'array_out'
+    distribute(fasta_dir, array_out_dir, sif_file, array=True, max_array_size=2)
+    rows = ledger_rows(array_out_dir)
+    assert [rows[name]['job_id'] for name in TARGETS] == ['1003_0', '1003_1', '1004_0']
+
+
+def test_dry_run_without_ledger(slurm, fasta_dir, sif_file, tmp_path):
+    alpha_out_dir = tmp_path / 'out'
+    completed = run_distribute('-f', str(fasta_dir), '-o', str(alpha_out_dir), '-s', str(sif_file), '-r', RUN_SCRIPT, '--dry_run')
+
+    assert completed.returncode == 0, completed.stdout
+    assert all(f'{name}: ' in completed.stdout for name in TARGETS)
+    assert not alpha_out_dir.exists()
+    assert sbatch_calls(slurm) == []
+
+
+def test_daemon_gives_up_after_max_retries(slurm, fasta_dir, sif_file, tmp_path):
+    alpha_out_dir = tmp_path / 'out'
+    # Every job fails
+    (slurm / 'sacct.txt').write_text(''.join(f'{job_id}|FAILED\n' for job_id in range(1000, 1010)))
+    completed = run_distribute('-f', str(fasta_dir), '-o', str(alpha_out_dir), '-s', str(sif_file), '-r', RUN_SCRIPT,
+                               '--max_in_flight', '2', '--poll_interval', '0', '--max_retries', '1', '--retry_backoff', '0')
+
+    assert completed.returncode == 1
+    assert f"Gave up on 3 targets: {', '.join(TARGETS)}." in completed.stdout
+    assert 'distributed successfully' not in completed.stdout
+    assert len(sbatch_calls(slurm)) == 6
+    rows = ledger_rows(alpha_out_dir)
+    assert [(rows[name]['state'], rows[name]['attempts']) for name in TARGETS] == [('failed', 2)] * 3
+
+
+def test_daemon_retries_failed_and_rejected_jobs(slurm, fasta_dir, sif_file, tmp_path, monkeypatch):
+    alpha_out_dir = tmp_path / 'out'
+    # The first submission is rejected, the first job that starts fails, every later job writes its model
+    (slurm / 'reject').write_text('1')
+    (slurm / 'sacct.txt').write_text('1000|FAILED\n')
+
+    def finish_jobs(seconds):
+        for row in get_targets(open_ledger(alpha_out_dir), ('submitted',)):
+            if row['job_id'] != '1000':
+                (alpha_out_dir / row['name'] / row['name']).mkdir(exist_ok=True)
+                (alpha_out_dir / row['name'] / row['name'] / 'ranked_0.pdb').touch()
+    monkeypatch.setattr(distribute_alphafold2.time, 'sleep', finish_jobs)
+
+    throttle = {'max_in_flight': 1, 'poll_interval': 0, 'max_retries': 1, 'retry_backoff': 0}
+    assert distribute(fasta_dir, alpha_out_dir, sif_file, throttle=throttle) == []
+
+    calls = sbatch_calls(slurm)
+    assert [call[0] for call in calls] == [str(alpha_out_dir / name) for name in (TARGETS[1], TARGETS[2], TARGETS[0], TARGETS[1])]
+    rows = ledger_rows(alpha_out_dir)
+    assert [(rows[name]['state'], rows[name]['attempts']) for name in TARGETS] == [('done', 1), ('done', 2), ('done', 1)]
+
+
+def test_daemon_counts_feature_and_inference_jobs(slurm, fasta_dir, sif_file, tmp_path, monkeypatch):
+    alpha_out_dir = tmp_path / 'out'
+    write_features(alpha_out_dir, TARGETS[1])
+    polls = []
+
+    def finish_jobs(seconds):
+        polls.append(len(sbatch_calls(slurm)))
+        for row in get_targets(open_ledger(alpha_out_dir), ('submitted',)):
+            (alpha_out_dir / row['name'] / row['name']).mkdir(exist_ok=True)
+            for result_file in ('features.pkl', 'ranked_0.pdb'):
+                (alpha_out_dir / row['name'] / row['name'] / result_file).touch()
+    monkeypatch.setattr(distribute_alphafold2.time, 'sleep', finish_jobs)
+
+    # The first target takes two jobs and the second one, whose features exist, one job, the third waits for them
+    throttle = {'max_in_flight': 3, 'poll_interval': 0, 'max_retries': 0, 'retry_backoff': 0}
+    assert distribute(fasta_dir, alpha_out_dir, sif_file, run_script=INFERENCE_SCRIPT, feature_script=FEATURE_SCRIPT, throttle=throttle) == []
+    assert polls[:2] == [3, 5]
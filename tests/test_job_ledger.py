@@ -0,0 +1,73 @@
+from job_ledger import open_ledger, get_targets, record_planned, record_submitted, select_targets_to_submit, reconcile_ledger, print_ledger_status
+
+JOB_IDS = {'queued': '1000', 'pending_task': '1001_0', 'cancelled_task': '1001_1', 'failed': '1002', 'completed': '1003', 'finished': '1004'}
+
+
+def make_targets(alpha_out_dir, names):
+    return [{'name': name, 'fasta_file': f'{name}.fasta', 'out_dir': str(alpha_out_dir / name)} for name in names]
+
+
+def write_model(alpha_out_dir, name):
+    (alpha_out_dir / name / name).mkdir(parents=True)
+    (alpha_out_dir / name / name / 'ranked_0.pdb').touch()
+
+
+def test_reconcile_ledger(slurm, tmp_path):
+    alpha_out_dir = tmp_path / 'out'
+    alpha_out_dir.mkdir()
+    connection = open_ledger(alpha_out_dir)
+    record_planned(connection, make_targets(alpha_out_dir, [*JOB_IDS, 'never_submitted']))
+    record_submitted(connection, {name: job_id for name, job_id in JOB_IDS.items()})
+    (slurm / 'squeue.txt').write_text('1000|RUNNING\n1001_0|PENDING\n999|RUNNING\n')
+    (slurm / 'sacct.txt').write_text('1001_1|CANCELLED by 4242\n1002|TIMEOUT\n1003|COMPLETED\n1004|COMPLETED\n')
+    write_model(alpha_out_dir, 'finished')
+
+    changed = reconcile_ledger(connection, alpha_out_dir)
+
+    states = {row['name']: (row['state'], row['slurm_state']) for row in get_targets(connection)}
+    assert states == {
+        'queued': ('running', 'RUNNING'),
+        'pending_task': ('submitted', 'PENDING'),
+        'cancelled_task': ('failed', 'CANCELLED'),
+        'failed': ('failed', 'TIMEOUT'),
+        # A job that completed without writing ranked_0.pdb did not produce a model
+        'completed': ('failed', 'COMPLETED'),
+        'finished': ('done', 'COMPLETED'),
+        'never_submitted': ('planned', None),
+    }
+    assert set(changed) == set(JOB_IDS)
+    assert print_ledger_status(connection) == {'planned': 1, 'submitted': 1, 'running': 1, 'done': 1, 'failed': 3}
+
+
+def test_reconcile_ledger_without_slurm(slurm, tmp_path, monkeypatch):
+    # Off the cluster squeue and sacct do not exist, only finished models change the ledger
+    monkeypatch.setenv('PATH', '')
+    alpha_out_dir = tmp_path / 'out'
+    alpha_out_dir.mkdir()
+    connection = open_ledger(alpha_out_dir)
+    record_planned(connection, make_targets(alpha_out_dir, ['queued', 'finished']))
+    record_submitted(connection, {'queued': '1000', 'finished': '1001'})
+    write_model(alpha_out_dir, 'finished')
+
+    assert reconcile_ledger(connection, alpha_out_dir) == {'finished': ('done', None)}
+
+
+def test_select_targets_to_submit(tmp_path):
+    alpha_out_dir = tmp_path / 'out'
+    alpha_out_dir.mkdir()
+    targets = make_targets(alpha_out_dir, ['new', 'submitted', 'failed', 'on_disk'])
+    write_model(alpha_out_dir, 'on_disk')
+
+    # A dry run in a fresh output directory has no ledger
+    to_submit, skipped = select_targets_to_submit(None, alpha_out_dir, targets)
+    assert [target['name'] for target in to_submit] == ['new', 'submitted', 'failed']
+    assert [target['name'] for target in skipped] == ['on_disk']
+
+    connection = open_ledger(alpha_out_dir)
+    record_planned(connection, targets[1:3])
+    record_submitted(connection, {'submitted': '1000'})
+    connection.execute("UPDATE targets SET state = 'failed' WHERE name = 'failed'")
+    to_submit, skipped = select_targets_to_submit(connection, alpha_out_dir, targets)
+    assert [target['name'] for target in to_submit] == ['new', 'failed']
+    assert [target['name'] for target in skipped] == ['submitted', 'on_disk']
+    assert select_targets_to_submit(connection, alpha_out_dir, targets, force_overwrite=True) == (targets, [])
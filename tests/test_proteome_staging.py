@@ -0,0 +1,29 @@
+import os
+from benchmark import make_synthetic_structures
+from proteome_index import get_index_dir, get_proteome_index
+from proteome_staging import STAGING_DIR_NAME, get_pack_files, stage_proteome, release_proteome
+
+
+def test_release_removes_stage_and_lock(tmp_path):
+    proteome_dir = make_synthetic_structures(tmp_path / 'proteome', 3, 'AF-', seed=0)
+    first_dir, second_dir = stage_proteome(proteome_dir, tmp_path / 'stage'), stage_proteome(proteome_dir, tmp_path / 'stage')
+    assert first_dir == second_dir and sorted(path.name for path in first_dir.glob('*.pdb')) == sorted(path.name for path in proteome_dir.glob('*.pdb'))
+
+    staging_root = tmp_path / 'stage' / STAGING_DIR_NAME
+    release_proteome(first_dir)
+    assert first_dir.exists()
+    release_proteome(second_dir)
+    assert list(staging_root.iterdir()) == []
+
+
+def test_rebuilt_index_prunes_superseded_packs(tmp_path):
+    proteome_dir = make_synthetic_structures(tmp_path / 'proteome', 3, 'AF-', seed=0)
+    old_index = get_proteome_index(proteome_dir)
+    release_proteome(stage_proteome(proteome_dir, tmp_path / 'stage'))
+    assert all(path.exists() for path in get_pack_files(proteome_dir, old_index))
+
+    # The proteome changes and is searched without staging
+    os.utime(next(proteome_dir.glob('*.pdb')), ns=(1, 1))
+    new_index = get_proteome_index(proteome_dir)
+    assert new_index['fingerprint'] != old_index['fingerprint']
+    assert sorted(path.name for path in get_index_dir(proteome_dir).iterdir()) == ['.lock', 'index.json']
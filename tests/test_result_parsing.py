@@ -0,0 +1,11 @@
+import pandas as pd
+from fatcat_tmalign_proteome_search import TMALIGN_DTYPES, FATCAT_DTYPES, parse_tmalign_lines, parse_fatcat_lines
+
+
+def test_empty_results_keep_float_columns():
+    tm_align_line = 'query.pdb:A\tAF-1.pdb:A\t0.5\t0.6\t2.1\t0.3\t0.3\t0.4\t100\t120\t90\n'
+    for df in (parse_tmalign_lines([]), parse_tmalign_lines(['#PDBchain1\tPDBchain2\tTM1\n'])):
+        assert df.empty and df.dtypes[list(TMALIGN_DTYPES)].eq('float64').all()
+        assert pd.concat([df, parse_tmalign_lines([tm_align_line])]).dtypes[list(TMALIGN_DTYPES)].eq('float64').all()
+    df = parse_fatcat_lines([])
+    assert df.empty and df.dtypes[list(FATCAT_DTYPES)].eq('float64').all()
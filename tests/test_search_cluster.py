@@ -0,0 +1,54 @@
+import sys
+import subprocess
+import pandas as pd
+from conftest import SCRIPT_DIR, sbatch_calls
+from benchmark import install_search_stubs, make_synthetic_structures
+from search_cluster import chunk_array_indices, unit_result_path
+
+
+def test_chunk_array_indices():
+    assert chunk_array_indices(list(range(7)), 3) == [[0, 1, 2], [3, 4, 5], [6]]
+    # Task ids relative to the first unit of a chunk stay below the maximum array size
+    assert chunk_array_indices([0, 2, 3, 4, 5, 6], 5) == [[0, 2, 3, 4], [5, 6]]
+    assert chunk_array_indices([4, 9, 10], 5) == [[4], [9, 10]]
+    assert chunk_array_indices([], 5) == []
+
+
+def test_cluster_round_trip(slurm, tmp_path, monkeypatch):
+    fatcat_install_dir, tm_align_install_dir = install_search_stubs(tmp_path)
+    query_dir = make_synthetic_structures(tmp_path / 'queries', 3, 'query_', seed=1)
+    for seed, proteome in enumerate(('proteome_a', 'proteome_b')):
+        make_synthetic_structures(tmp_path / 'proteomes' / proteome, 5, 'AF-', seed=seed + 2)
+
+    def search(output_name, *args):
+        invocation = [sys.executable, str(SCRIPT_DIR / 'fatcat_tmalign_proteome_search.py'), '-q', str(query_dir), '-p', str(tmp_path / 'proteomes'),
+                      '-f', str(fatcat_install_dir), '-t', str(tm_align_install_dir), '-o', str(output_name), '-w', '1', *args]
+        completed = subprocess.run(invocation, capture_output=True, text=True)
+        assert completed.returncode == 0, completed.stdout + completed.stderr
+        return pd.read_csv(output_name)
+
+    local_df = search(tmp_path / 'local.csv')
+
+    # The stub sbatch runs every work unit and then the reduce job, 2 query chunks x 2 proteomes x 2 shards = 8 units.
+    # The work directory has a space in it, the paths in the job scripts are quoted
+    monkeypatch.setenv('SLURM_STUB_RUN', '1')
+    cluster_args = ['--cluster', '--work_dir', str(tmp_path / 'work dir'), '--shards', '2', '--query_chunk_size', '2', '--max_array_size', '3']
+    cluster_df = search(tmp_path / 'cluster.csv', *cluster_args)
+    pd.testing.assert_frame_equal(cluster_df, local_df)
+
+    calls = [args for _, args in sbatch_calls(slurm)]
+    assert [args[1:3] for args in calls[:3]] == [['--array=0-2', '--export=ALL,ARRAY_OFFSET=0'], ['--array=0-2', '--export=ALL,ARRAY_OFFSET=3'],
+                                                 ['--array=0-1', '--export=ALL,ARRAY_OFFSET=6']]
+    assert '--dependency=afterok:1000:1001:1002' in calls[3]
+
+    # A resubmission of the same plan only runs the units without a result
+    cluster_dir = tmp_path / 'work dir' / 'cluster'
+    for unit_index in (1, 3, 4, 7):
+        unit_result_path(cluster_dir, unit_index).unlink()
+    cluster_df = search(tmp_path / 'cluster.csv', *cluster_args, '--force_overwrite')
+    pd.testing.assert_frame_equal(cluster_df, local_df)
+
+    calls = [args for _, args in sbatch_calls(slurm)][4:]
+    assert [args[1:3] for args in calls[:3]] == [['--array=0,2', '--export=ALL,ARRAY_OFFSET=1'], ['--array=0-0', '--export=ALL,ARRAY_OFFSET=4'],
+                                                 ['--array=0-0', '--export=ALL,ARRAY_OFFSET=7']]
+    assert '--dependency=afterok:1004:1005:1006' in calls[3]
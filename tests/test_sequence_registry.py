@@ -0,0 +1,29 @@
+from sequence_registry import register_targets, load_registry
+
+
+def write_targets(fasta_dir, sequences):
+    fasta_dir.mkdir(exist_ok=True)
+    targets = []
+    for name, sequence in sequences.items():
+        (fasta_dir / f'{name}.fasta').write_text(f'>{name}\n{sequence}\n')
+        targets.append({'name': name, 'source_fasta': str(fasta_dir / f'{name}.fasta')})
+    return targets
+
+
+def registered_names(alpha_out_dir):
+    return sorted((entry['canonical'], entry['aliases']) for entry in load_registry(alpha_out_dir)['sequences'].values())
+
+
+def test_register_targets(tmp_path):
+    alpha_out_dir = tmp_path / 'out'
+    targets = write_targets(tmp_path / 'fasta', {'a': 'MKV', 'b': 'mkv*', 'c': 'MKV', 'd': 'GGG'})
+    unique_targets, alias_targets = register_targets(alpha_out_dir, targets)
+    assert [target['name'] for target in unique_targets] == ['a', 'd']
+    assert [(target['name'], target['canonical']) for target in alias_targets] == [('b', 'a'), ('c', 'a')]
+
+    # A later run sees the earlier sequences, names whose fasta changed move to their new sequence
+    targets = write_targets(tmp_path / 'fasta', {'a': 'PPP', 'c': 'MKV', 'e': 'GGG'})
+    unique_targets, alias_targets = register_targets(alpha_out_dir, targets)
+    assert [target['name'] for target in unique_targets] == ['a']
+    assert [(target['name'], target['canonical']) for target in alias_targets] == [('c', 'b'), ('e', 'd')]
+    assert registered_names(alpha_out_dir) == [('a', []), ('b', ['c']), ('d', ['e'])]
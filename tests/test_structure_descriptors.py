@@ -0,0 +1,23 @@
+import numpy as np
+from structure_descriptors import DESCRIPTOR_SIZE, LENGTH, RADIUS_OF_GYRATION, HELIX, STRAND, COIL, HISTOGRAM, prefilter_candidates
+
+
+def make_descriptor(length, radius_of_gyration, helix, strand):
+    descriptor = np.zeros(DESCRIPTOR_SIZE, dtype=np.float32)
+    descriptor[LENGTH], descriptor[RADIUS_OF_GYRATION] = length, radius_of_gyration
+    descriptor[HELIX], descriptor[STRAND], descriptor[COIL] = helix, strand, 1 - helix - strand
+    descriptor[HISTOGRAM] = 1 / (HISTOGRAM.stop - HISTOGRAM.start)
+    return descriptor
+
+
+def test_prefilter_candidates():
+    query = make_descriptor(100, 15.0, 0.6, 0.1)
+    descriptors = np.array([make_descriptor(100, 15.0, 0.6, 0.1), make_descriptor(40, 15.0, 0.6, 0.1),
+                            make_descriptor(100, 30.0, 0.6, 0.1), make_descriptor(100, 15.0, 0.0, 0.5)])
+    names = ['same', 'short', 'extended', 'all_beta']
+
+    assert prefilter_candidates(query, descriptors, names) == names
+    assert prefilter_candidates(query, descriptors, names, min_length_ratio=0.5) == ['same', 'extended', 'all_beta']
+    assert prefilter_candidates(query, descriptors, names, min_rg_ratio=0.7) == ['same', 'short', 'all_beta']
+    assert prefilter_candidates(query, descriptors, names, max_ss_distance=0.3) == ['same', 'short', 'extended']
+    assert prefilter_candidates(query, descriptors, names, min_length_ratio=0.5, min_rg_ratio=0.7, max_ss_distance=0.3, min_similarity=0.99) == ['same']